@@ -10,6 +10,7 @@ import math
 import os
 
 from madminer.delphes import DelphesReader
+from helpers import incremental, kinematics
 import argparse
 
 logging.basicConfig(
@@ -33,9 +34,22 @@ parser.add_argument("-p","--process_code",help="Choose from signal_sm, signal_su
 parser.add_argument("-b","--batch_index",help="batch_index")
 parser.add_argument("-supp_id","--supp_id",help="Index of non_SM benchmark that events were generated at")
 parser.add_argument("-dr","--delphes_run",action="store_true",help="Whether Delphes has been run on the events or not")
-parser.add_argument("-start","--start",help="MadGraph run start index")
-parser.add_argument("-stop","--stop",help="Madgraph run stop index")
+parser.add_argument("-start","--start",type=int,help="MadGraph run start index")
+parser.add_argument("-stop","--stop",type=int,help="Madgraph run stop index")
+parser.add_argument("-engine","--engine",default="loop",choices=["loop","fused","adaptive","columnar"],help="Evaluate observables event by event (loop), event by event in a single pass with early rejection (fused), the same with cuts reordered by their measured cost and selectivity (adaptive), or as arrays over all events (columnar)")
+parser.add_argument("-chunk_size","--chunk_size",type=int,default=None,help="Read the Delphes ROOT files in chunks of this many events to limit memory use")
+parser.add_argument("-n_workers","--n_workers",type=int,default=1,help="Number of processes that parse the runs in parallel")
+parser.add_argument("-cache","--cache",action="store_true",help="Cache the parsed Delphes branches next to each ROOT file and reuse them on reruns")
+parser.add_argument("-delphes_workers","--delphes_workers",type=int,default=1,help="Number of Delphes processes that run at the same time (one log per run in delpheslogs/)")
+parser.add_argument("-keep_hepmc","--keep_hepmc",action="store_true",help="Decompress the HepMC files to disk for Delphes and keep them (for debugging) instead of piping them into Delphes")
+parser.add_argument("-prefetch","--prefetch",type=int,default=0,help="Read and decompress the inputs of up to this many runs ahead in the background while the current run is parsed (the decompressed LHE files are deleted after use)")
+parser.add_argument("-xml_lhe","--xml_lhe",action="store_true",help="Read the LHE weights event by event with MadMiner's XML parser instead of the much faster bulk reader (the weights are the same)")
+parser.add_argument("-stream_output","--stream_output",action="store_true",help="Append the events of every run to the batch file as soon as it is parsed (not shuffled, 03b does that), instead of keeping all runs in memory and writing the shuffled batch file at the end")
+parser.add_argument("-regions","--regions",nargs="+",default=None,help="Selection regions (see REGION_CUTS) to evaluate in the same pass over the runs; the events of every region are written to <output>_<region>.h5 instead of the m_aa window being applied to all events")
+parser.add_argument("-incremental","--incremental",action="store_true",help="Only run Delphes and the parse on the runs in the batch directory (within -start and -stop, if given) that are new or changed since the last call, and rebuild the batch file from the per-run results")
 args = parser.parse_args()
+if args.regions and args.incremental:
+    parser.error("--regions cannot be combined with --incremental")
     
 mg_dir = workflow["madgraph"]["dir"]
 delphes = DelphesReader(workflow["morphing_setup"])
@@ -53,7 +67,25 @@ else:
     sampled_from_benchmark = f"morphing_basis_vector_{args.supp_id}"
     
     
-for run_id in range(int(args.start), int(args.stop)+1):   
+if args.process_code != "signal_supp":
+    output_filename = "{delphes_output_data}_{process_code}_batch_{batch_index}.h5".format(delphes_output_data=workflow["delphes"]["output_file"], process_code=args.process_code, batch_index=args.batch_index)
+else:
+    output_filename = "{delphes_output_data}_{process_code}_{supp_id}_batch_{batch_index}.h5".format(delphes_output_data=workflow["delphes"]["output_file"], process_code=args.process_code, batch_index=args.batch_index, supp_id = args.supp_id)
+
+delphes_options = dict(
+    delphes_directory=mg_dir + "/HEPTools/Delphes-3.5.0/", # For latest madgraph version.
+    delphes_card="cards/delphes_card_HLLHC.tcl",
+    log_file=f"delpheslogs/delphes_{args.process_code}_batch{args.batch_index}{'_mb' + str(args.supp_id) if args.supp_id else ''}.log",
+    n_workers=args.delphes_workers,
+    stream_hepmc=not args.keep_hepmc,
+    delete_unzipped_hepmc=not args.keep_hepmc,
+)
+
+
+# in incremental mode the runs are found and added in step 4 instead
+run_ids = [] if args.incremental else range(args.start, args.stop+1)
+
+for run_id in run_ids:   
     
     # background events have not gone through MadSpin
     if "background" in args.process_code:
@@ -85,125 +117,186 @@ for run_id in range(int(args.start), int(args.stop)+1):
 
 if args.delphes_run: 
     print("Delphes has already been run.")
-else:
-    delphes.run_delphes(
-        delphes_directory=mg_dir + "/HEPTools/Delphes-3.5.0/", # For latest madgraph version.
-        delphes_card="cards/delphes_card_HLLHC.tcl",
-        log_file=f"delpheslogs/delphes_{args.process_code}_batch{args.batch_index}{'_mb' + str(args.supp_id) if args.supp_id else ''}.log",
-    )
+elif not args.incremental:
+    delphes.run_delphes(**delphes_options)
+
+
+def uses(*collections):
+    # declares the particle lists (l, a, j, met) that an observable function and its columnar version read, so that
+    # the Delphes branches of the others are skipped; intermediates passed as arguments count on their own
+    def declare(function):
+        function.collections = collections
+        return function
+    return declare
+
+def columnar(function):
+    # registers the decorated function as the version of function that --engine columnar uses
+    def register(columnar_function):
+        function.columnar = columnar_function
+        return columnar_function
+    return register
+
+
 """
 CUSTOM FUNCTIONS TO ISOLATE THE BJETS
+These are registered as intermediates, so they are computed once per event and shared by all observables below
 """
 
-def count_bjets(l,a,j,met):
-    btag_sum = 0
-    for jet in j:
-        btag_sum += jet.b_tag
-    return btag_sum
-
-def get_hardest_b_pt(l,a,j,met):
-    for jet in j:
-        if jet.b_tag == 1:
-            return jet.pt
-    return np.nan
-
-def get_second_b_pt(l,a,j,met):
-    num_bs = 0
-    for jet in j:
-        if jet.b_tag == 1:
-            num_bs += 1
-        if num_bs == 2:
-            return jet.pt
-    return np.nan
-
-def get_hardest_b_eta(l,a,j,met):
-    for jet in j:
-        if jet.b_tag == 1:
-            return jet.eta
-    return np.nan
-
-def get_second_b_eta(l,a,j,met):
-    num_bs = 0
-    for jet in j:
-        if jet.b_tag == 1:
-            num_bs += 1
-        if num_bs == 2:
-            return jet.eta
-    return np.nan
-
-def get_two_bjets(j):
-    num_bjets_found = 0
-    for jet in j:
-        if jet.b_tag == 1:
-            num_bjets_found += 1
-            if num_bjets_found == 1:
-                hardest_b = jet
-            elif num_bjets_found == 2:
-                second_b = jet
-                return (True, hardest_b, second_b)
-    return (False, False, False)
-
-def get_bb_deltaR(l,a,j,met):
-    found, hardest_b, second_b = get_two_bjets(j)
-    if found:
-        return hardest_b.deltaR(second_b)
-    else:
-        return np.nan
-    
-def get_b0a0_deltaR(l,a,j,met):
-    found, hardest_b, second_b = get_two_bjets(j)
-    if found:
-        return hardest_b.deltaR(a[0])
-    else:
-        return np.nan
-    
-def get_b0a1_deltaR(l,a,j,met):
-    found, hardest_b, second_b = get_two_bjets(j)
-    if found:
-        return hardest_b.deltaR(a[1])
-    else:
-        return np.nan
-    
-def get_b1a0_deltaR(l,a,j,met):
-    found, hardest_b, second_b = get_two_bjets(j)
-    if found:
-        return second_b.deltaR(a[0])
-    else:
-        return np.nan  
+@uses("j")
+def get_bjets(l,a,j,met):
+    return [jet for jet in j if jet.b_tag == 1]
+
+@uses()
+def get_two_bjets(l,a,j,met,bjets):
+    # raises an IndexError (-> observable is NaN) if there are fewer than two b-jets
+    return bjets[0], bjets[1]
+
+
+"""
+COLUMNAR VERSIONS OF THE CUSTOM FUNCTIONS, USED WITH --engine columnar
+j[j.b_tag] selects the b-jets of every event, and a particle that is missing in an event gives NaN
+"""
+
+@columnar(get_bjets)
+def get_bjets_columnar(l,a,j,met):
+    return j[j.b_tag]
+
+@columnar(get_two_bjets)
+def get_two_bjets_columnar(l,a,j,met,bjets):
+    bjets = bjets[bjets.count() >= 2]
+    return bjets[0], bjets[1]
+
+
+# two b-jets need at least two jets, so events with fewer are dropped before any particles are built
+get_two_bjets.min_multiplicities = {"j": 2}
+
+
+"""
+PAIR OBSERVABLES
+Event by event they use the MadMinerParticle arithmetic; the columnar versions compute deltaR and pair pTs for all
+events at once with the compiled kernels in helpers/kinematics.py, and masses from the summed four-vectors (missing
+particles give NaN)
+"""
+
+def as_array(values):
+    return np.ma.filled(np.ma.asarray(values, dtype=np.float64), np.nan)
+
+def deltaR_columnar(p1, p2):
+    return kinematics.delta_r(as_array(p1.eta), as_array(p1.phi), as_array(p2.eta), as_array(p2.phi))
+
+def mass_columnar(*particles):
+    # summed as four-vectors like the MadMinerParticles of the event loop, in the same precision, so that the masses
+    # agree with it also for nearly collinear pairs
+    return as_array(sum(particles[1:], particles[0]).m)
+
+def pt_columnar(p1, p2):
+    return kinematics.pair_pt(as_array(p1.pt), as_array(p1.phi), as_array(p2.pt), as_array(p2.phi))
+
+@uses()
+def get_bb_deltaR(l,a,j,met,bb_pair):
+    return bb_pair[0].deltaR(bb_pair[1])
+
+@columnar(get_bb_deltaR)
+def get_bb_deltaR_columnar(l,a,j,met,bb_pair):
+    return deltaR_columnar(bb_pair[0], bb_pair[1])
+
+@uses("a")
+def get_aa_deltaR(l,a,j,met):
+    return a[0].deltaR(a[1])
+
+@columnar(get_aa_deltaR)
+def get_aa_deltaR_columnar(l,a,j,met):
+    return deltaR_columnar(a[0], a[1])
+
+@uses("a")
+def get_b0a0_deltaR(l,a,j,met,bb_pair):
+    return bb_pair[0].deltaR(a[0])
+
+@columnar(get_b0a0_deltaR)
+def get_b0a0_deltaR_columnar(l,a,j,met,bb_pair):
+    return deltaR_columnar(bb_pair[0], a[0])
+
+@uses("a")
+def get_b0a1_deltaR(l,a,j,met,bb_pair):
+    return bb_pair[0].deltaR(a[1])
+
+@columnar(get_b0a1_deltaR)
+def get_b0a1_deltaR_columnar(l,a,j,met,bb_pair):
+    return deltaR_columnar(bb_pair[0], a[1])
+
+@uses("a")
+def get_b1a0_deltaR(l,a,j,met,bb_pair):
+    return bb_pair[1].deltaR(a[0])
+
+@columnar(get_b1a0_deltaR)
+def get_b1a0_deltaR_columnar(l,a,j,met,bb_pair):
+    return deltaR_columnar(bb_pair[1], a[0])
+
+@uses("a")
+def get_b1a1_deltaR(l,a,j,met,bb_pair):
+    return bb_pair[1].deltaR(a[1])
+
+@columnar(get_b1a1_deltaR)
+def get_b1a1_deltaR_columnar(l,a,j,met,bb_pair):
+    return deltaR_columnar(bb_pair[1], a[1])
+
+@uses("a")
+def get_m_tot(l,a,j,met,bb):
+    return (bb+a[0]+a[1]).m
+
+@columnar(get_m_tot)
+def get_m_tot_columnar(l,a,j,met,bb_pair):
+    return mass_columnar(bb_pair[0], bb_pair[1], a[0], a[1])
+
+@uses()
+def get_pt_bb(l,a,j,met,bb):
+    return bb.pt
+
+@columnar(get_pt_bb)
+def get_pt_bb_columnar(l,a,j,met,bb_pair):
+    return pt_columnar(bb_pair[0], bb_pair[1])
+
+@uses("a")
+def get_pt_aa(l,a,j,met,aa):
+    return aa.pt
+
+@columnar(get_pt_aa)
+def get_pt_aa_columnar(l,a,j,met):
+    return pt_columnar(a[0], a[1])
+
+@uses()
+def get_m_bb(l,a,j,met,bb):
+    return bb.m
+
+@columnar(get_m_bb)
+def get_m_bb_columnar(l,a,j,met,bb_pair):
+    return mass_columnar(bb_pair[0], bb_pair[1])
+
+@uses("a")
+def get_m_aa(l,a,j,met,aa):
+    return aa.m
+
+@columnar(get_m_aa)
+def get_m_aa_columnar(l,a,j,met):
+    return mass_columnar(a[0], a[1])
+
 
-def get_b1a1_deltaR(l,a,j,met):
-    found, hardest_b, second_b = get_two_bjets(j)
-    if found:
-        return second_b.deltaR(a[1])
-    else:
-        return np.nan
-    
-def get_mbb(l,a,j,met):
-    found, hardest_b, second_b = get_two_bjets(j)
-    if found:
-        return (hardest_b+second_b).m
-    else:
-        return np.nan
-    
-def get_ptbb(l,a,j,met):
-    found, hardest_b, second_b = get_two_bjets(j)
-    if found:
-        return (hardest_b+second_b).pt
-    else:
-        return np.nan
-    
-def get_mtot(l,a,j,met):
-    found, hardest_b, second_b = get_two_bjets(j)
-    if found:
-        return (hardest_b+second_b+a[0]+a[1]).m
-    else:
-        return np.nan
-    
         
 """
 MAIN ANALYSIS
 """
 
+def add_intermediates(delphes):
+    
+    # b-jets, computed once per event
+    delphes.add_intermediate( "bjets", get_bjets )
+    delphes.add_intermediate( "bb_pair", get_two_bjets )
+    delphes.add_intermediate( "bb", "bb_pair[0]+bb_pair[1]" )
+    
+    # diphoton system
+    delphes.add_intermediate( "aa", "a[0]+a[1]" )
+
+
 def add_observables(delphes):
     
     # photons
@@ -213,29 +306,37 @@ def add_observables(delphes):
     delphes.add_observable( "a1_eta", "a[1].eta", required=True )
     
     # b-jets
-    delphes.add_observable_from_function( "num_bjets", count_bjets, required=True )
-    delphes.add_observable_from_function( "b0_pt", get_hardest_b_pt, required=True )
-    delphes.add_observable_from_function( "b0_eta", get_hardest_b_eta, required=True )
-    delphes.add_observable_from_function( "b1_pt", get_second_b_pt, required=True )
-    delphes.add_observable_from_function( "b1_eta", get_second_b_eta, required=True )
+    delphes.add_observable( "num_bjets", "len(bjets)", required=True )
+    delphes.add_observable( "b0_pt", "bjets[0].pt", required=True )
+    delphes.add_observable( "b0_eta", "bjets[0].eta", required=True )
+    delphes.add_observable( "b1_pt", "bjets[1].pt", required=True )
+    delphes.add_observable( "b1_eta", "bjets[1].eta", required=True )
     
     # deltaR
     delphes.add_observable_from_function( "bb_deltaR", get_bb_deltaR, required=True )
-    delphes.add_observable( "aa_deltaR", "a[0].deltaR(a[1])", required=True )
+    delphes.add_observable_from_function( "aa_deltaR", get_aa_deltaR, required=True )
     delphes.add_observable_from_function( "b0a0_deltaR", get_b0a0_deltaR, required=True )
     delphes.add_observable_from_function( "b0a1_deltaR", get_b0a1_deltaR, required=True )
     delphes.add_observable_from_function( "b1a0_deltaR", get_b1a0_deltaR, required=True )
     delphes.add_observable_from_function( "b1a1_deltaR", get_b1a1_deltaR, required=True )
 
     # misc
-    delphes.add_observable_from_function( "m_tot", get_mtot, required=True )
-    delphes.add_observable_from_function( "pt_bb", get_ptbb, required=True )
-    delphes.add_observable( "pt_aa", "(a[0]+a[1]).pt", required=True )
-    delphes.add_observable_from_function( "m_bb", get_mbb, required=True )
-    delphes.add_observable( "m_aa", "(a[0]+a[1]).m", required=True )
+    delphes.add_observable_from_function( "m_tot", get_m_tot, required=True )
+    delphes.add_observable_from_function( "pt_bb", get_pt_bb, required=True )
+    delphes.add_observable_from_function( "pt_aa", get_pt_aa, required=True )
+    delphes.add_observable_from_function( "m_bb", get_m_bb, required=True )
+    delphes.add_observable_from_function( "m_aa", get_m_aa, required=True )
 
 
-def add_cuts_and_efficiencies(delphes, region=None):
+# Selection regions: cuts on top of the common ones below, which replace the m_aa window. The signal region is the
+# usual analysis selection, the sidebands around it are used to estimate the continuum background
+REGION_CUTS = {
+    "signal": ['abs(m_aa-125)<3'],
+    "sideband": ['abs(m_aa-125)>5', 'abs(m_aa-125)<25'],
+    "inclusive": [],
+}
+
+def add_cuts_and_efficiencies(delphes, regions=None):
 
 
     # pt cuts
@@ -262,21 +363,113 @@ def add_cuts_and_efficiencies(delphes, region=None):
     # Higgs mass window 
 
     delphes.add_cut('abs(m_bb-125)<25')
-    delphes.add_cut('abs(m_aa-125)<3') 
+    if not regions:
+        delphes.add_cut('abs(m_aa-125)<3') 
 
     # misc
     delphes.add_cut('num_bjets==2') 
     delphes.add_cut('aa_deltaR<2')
+
+    # every region needs at least one cut to exist, "inclusive" gets one that always passes
+    for region in regions or []:
+        for cut in REGION_CUTS[region] or ['True']:
+            delphes.add_cut(cut, region=region)
                                    
 
+add_intermediates(delphes)
 add_observables(delphes)
-add_cuts_and_efficiencies(delphes)
+add_cuts_and_efficiencies(delphes, args.regions)
     
+def run_incremental():
+    """
+    Decides per run directory whether Delphes, the parse, or nothing has to be run (see helpers/incremental.py), runs
+    Delphes on the runs that need it, parses every changed run into its own file, and rebuilds the batch file from the
+    per-run files if any of them changed. Runs that need a parse are parsed one after the other.
+    """
+
+    fingerprint = incremental.analysis_fingerprint(delphes)
+
+    plans = []
+    for loc_dir in incremental.find_run_dirs(path_to_events_dir, decayed="background" not in args.process_code, start=args.start, stop=args.stop):
+        files = dict(
+            hepmc=f"{loc_dir}/tag_1_pythia8_events.hepmc.gz",
+            lhe=f"{loc_dir}/unweighted_events.lhe.gz",
+            delphes=f"{loc_dir}/tag_1_pythia8_events_delphes.root",
+        )
+        state = incremental.load_state(loc_dir)
+        action, reason = incremental.plan_run(state, files["hepmc"], files["lhe"], files["delphes"], fingerprint)
+        print(f"{loc_dir}: {action or 'nothing to do'} ({reason})")
+        plans.append((loc_dir, files, state, action))
+
+    # Delphes, for all runs at once so that --delphes_workers applies
+    delphes_runs = [plan for plan in plans if plan[3] == incremental.RUN_DELPHES]
+    if delphes_runs:
+        delphes_reader = DelphesReader(workflow["morphing_setup"])
+        for _, files, _, _ in delphes_runs:
+            delphes_reader.add_sample(lhe_filename=files["lhe"], hepmc_filename=files["hepmc"], weights="lhe", sampled_from_benchmark=sampled_from_benchmark, is_background=is_background, k_factor=1.0)
+        try:
+            delphes_reader.run_delphes(**delphes_options)
+        finally:
+            # record the runs that finished, even if others failed
+            for i, (loc_dir, files, state, _) in enumerate(delphes_runs):
+                if delphes_reader.delphes_sample_filenames[i] is not None:
+                    state["hepmc"] = incremental.file_signature(files["hepmc"])
+                    state["delphes"] = incremental.file_signature(files["delphes"])
+                    incremental.save_state(loc_dir, state)
+
+    # Parse, one run at a time into its own file
+    n_parsed = 0
+    for loc_dir, files, state, action in plans:
+        if action is None:
+            continue
+
+        run_reader = DelphesReader(workflow["morphing_setup"])
+        run_reader.add_sample(lhe_filename=files["lhe"], hepmc_filename=files["hepmc"] if os.path.exists(files["hepmc"]) else None, delphes_filename=files["delphes"], weights="lhe", sampled_from_benchmark=sampled_from_benchmark, is_background=is_background, k_factor=1.0)
+        add_intermediates(run_reader)
+        add_observables(run_reader)
+        add_cuts_and_efficiencies(run_reader)
+        run_reader.analyse_delphes_samples(engine=args.engine, chunk_size=args.chunk_size, cache=args.cache, stream_lhe_weights=not args.xml_lhe)
+
+        events_filename = f"{loc_dir}/{incremental.EVENTS_FILENAME}"
+        if os.path.exists(events_filename):
+            os.remove(events_filename)
+        n_events = 0 if run_reader.observations is None else len(next(iter(run_reader.observations.values())))
+        run_reader.save(events_filename)
+
+        state["parsed"] = dict(
+            delphes=incremental.file_signature(files["delphes"]),
+            lhe=incremental.file_signature(files["lhe"]),
+            fingerprint=fingerprint,
+            events_file=events_filename,
+            events=incremental.file_signature(events_filename),
+            n_events=n_events,
+        )
+        incremental.save_state(loc_dir, state)
+        n_parsed += 1
+
+    # Batch file, from all runs with events
+    events_files = []
+    for loc_dir, _, _, _ in plans:
+        parsed = incremental.load_state(loc_dir).get("parsed")
+        if parsed is not None and parsed["n_events"] > 0:
+            events_files.append(parsed["events_file"])
+
+    if not events_files:
+        print("No run has events passing the cuts, not writing", output_filename)
+    elif incremental.update_batch_file(events_files, output_filename, force=n_parsed > 0):
+        print(f"Rebuilt {output_filename} from {len(events_files)} runs ({n_parsed} parsed now)")
+    else:
+        print(f"{output_filename} is up to date")
+
+
 # 4. Run analysis
-delphes.analyse_delphes_samples()
+if args.incremental:
+    run_incremental()
+elif args.stream_output:
+    # 5. The events of every run are appended to the .h5 file as soon as it is parsed (not shuffled, 03b does that)
+    delphes.analyse_delphes_samples(engine=args.engine, chunk_size=args.chunk_size, n_workers=args.n_workers, cache=args.cache, prefetch=args.prefetch, stream_lhe_weights=not args.xml_lhe, output_filename=output_filename)
+else:
+    delphes.analyse_delphes_samples(engine=args.engine, chunk_size=args.chunk_size, n_workers=args.n_workers, cache=args.cache, prefetch=args.prefetch, stream_lhe_weights=not args.xml_lhe)
 
-# 5. Save results into new .h5 file
-if args.process_code != "signal_supp":
-    delphes.save("{delphes_output_data}_{process_code}_batch_{batch_index}.h5".format(delphes_output_data=workflow["delphes"]["output_file"], process_code=args.process_code, batch_index=args.batch_index))
-else: 
-    delphes.save("{delphes_output_data}_{process_code}_{supp_id}_batch_{batch_index}.h5".format(delphes_output_data=workflow["delphes"]["output_file"], process_code=args.process_code, batch_index=args.batch_index, supp_id = args.supp_id))
+    # 5. Save results into new .h5 file
+    delphes.save(output_filename)
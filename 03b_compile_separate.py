@@ -7,8 +7,10 @@ import logging
 import numpy as np
 import matplotlib
 import math
+import os
 
-from madminer.sampling import combine_and_shuffle
+from helpers.shuffle import add_compile_arguments, compile_batches
+from helpers.manifest import find_batches
 import argparse
 
 logging.basicConfig(
@@ -27,65 +29,59 @@ with open("workflow.yaml", "r") as file:
     
 parser = argparse.ArgumentParser()
 parser.add_argument("-p","--process_code",help="process_code: signal_sm, signal_bsm, or background",default="Choose signal_sm, signal_bsm, or background")
-parser.add_argument("-n","--num_batch",help="num_background_batches",default=80,type=int)
+parser.add_argument("-n","--num_batch",help="Only use the background batches with an index below this (default: all batch files found)",default=None,type=int)
+add_compile_arguments(parser)
 
 args = parser.parse_args()   
 
-# batch indices for the SM benchmark (10 batches: 0-9)
-signal_sm_batches = list(range(10))  # 0,1,2,3,4,5,6,7,8,9
-
-# {morphing basis: batch indices} for non-SM benchmarks (5 batches each: 0-4)
-signal_bsm_batches = {1:list(range(5)), 2:list(range(5)), 3:list(range(5)), 4:list(range(5)), 5:list(range(5)), 6:list(range(5)), 7:list(range(5)), 8:list(range(5)), 9:list(range(5))}  # 5 batches each for all morphing points
+storage_dir = workflow["delphes"]["long_term_storage_dir"]
 
 if args.process_code == "signal_sm":
     # Process only SM signal batches
-    to_combine = []
-    for i in signal_sm_batches:
-        to_combine.append('{long_term_storage_dir}/delphes_signal_sm_batch_{batch_num}.h5'.format(long_term_storage_dir=workflow["delphes"]["long_term_storage_dir"], batch_num=i))
+    to_combine = find_batches(storage_dir, "delphes_signal_sm")
 
-    combine_and_shuffle(
+    compile_batches(
+        args,
         to_combine,
-        '{long_term_storage_dir}/delphes_signal_sm_shuffled_14TeV.h5'.format(long_term_storage_dir=workflow["delphes"]["long_term_storage_dir"])
+        os.path.join(storage_dir, 'delphes_signal_sm_shuffled_14TeV.h5')
     )
 
 elif args.process_code == "signal_bsm":
     # Process only BSM signal batches
     to_combine = []
     for supp_id in range(1, 10): # signal supp
-        for i in signal_bsm_batches[supp_id]:
-            to_combine.append('{long_term_storage_dir}/delphes_signal_supp_{supp_id}_batch_{batch_num}.h5'.format(long_term_storage_dir=workflow["delphes"]["long_term_storage_dir"], batch_num=i, supp_id=supp_id))
+        to_combine += find_batches(storage_dir, f"delphes_signal_supp_{supp_id}")
 
-    combine_and_shuffle(
+    compile_batches(
+        args,
         to_combine,
-        '{long_term_storage_dir}/delphes_signal_bsm_shuffled_14TeV.h5'.format(long_term_storage_dir=workflow["delphes"]["long_term_storage_dir"])
+        os.path.join(storage_dir, 'delphes_signal_bsm_shuffled_14TeV.h5')
     )
 
 elif args.process_code == "signal_all":
     # Process both SM and BSM signal batches
     to_combine = []
     # Add SM signal batches
-    for i in signal_sm_batches:
-        to_combine.append('{long_term_storage_dir}/delphes_signal_sm_batch_{batch_num}.h5'.format(long_term_storage_dir=workflow["delphes"]["long_term_storage_dir"], batch_num=i))
+    to_combine += find_batches(storage_dir, "delphes_signal_sm")
     # Add BSM signal batches
     for supp_id in range(1, 10): # signal supp
-        for i in signal_bsm_batches[supp_id]:
-            to_combine.append('{long_term_storage_dir}/delphes_signal_supp_{supp_id}_batch_{batch_num}.h5'.format(long_term_storage_dir=workflow["delphes"]["long_term_storage_dir"], batch_num=i, supp_id=supp_id))
+        to_combine += find_batches(storage_dir, f"delphes_signal_supp_{supp_id}")
 
-    combine_and_shuffle(
+    compile_batches(
+        args,
         to_combine,
-        '{long_term_storage_dir}/delphes_s_shuffled_14TeV.h5'.format(long_term_storage_dir=workflow["delphes"]["long_term_storage_dir"])
+        os.path.join(storage_dir, 'delphes_s_shuffled_14TeV.h5')
     )
 
 elif args.process_code == "background": # i.e. background only
-    to_combine = []
-    k_factors_background = [1 for x in range(args.num_batch)]  
+    to_combine = find_batches(storage_dir, "delphes_background", stop=args.num_batch)
+    k_factors_background = [1 for _ in to_combine]
 
-    print(f"Adding in {args.num_batch} batches of background...")
-    for i in range(args.num_batch):
-        to_combine.append('{long_term_storage_dir}/delphes_background_batch_{batch_num}.h5'.format(long_term_storage_dir=workflow["delphes"]["long_term_storage_dir"], batch_num=i))
-    combine_and_shuffle(
+    print(f"Adding in {len(to_combine)} batches of background...")
+    compile_batches(
+        args,
         to_combine,
-        '{long_term_storage_dir}/delphes_b0_shuffled_14TeV.h5'.format(long_term_storage_dir=workflow["delphes"]["long_term_storage_dir"]),
+        os.path.join(storage_dir, 'delphes_b0_shuffled_14TeV.h5'),
         k_factors=k_factors_background
     )
 
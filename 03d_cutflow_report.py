@@ -0,0 +1,178 @@
+#!/usr/bin/env python3
+"""
+Script to aggregate the cutflow and timing reports written by 03a_read_delphes.py.
+Usage: python 03d_cutflow_report.py <report files or directories> [--output summary.json]
+
+Every call of delphes.save() in 03a writes a <output>_report.json file next to the .h5 file, with one report per
+Delphes run of the batch. This script sums them over all given files (directories are searched for *_report.json)
+and prints where the time went and how many events pass each cut. Cuts of selection regions (03a --regions) are
+listed with their region, and the events of each region are counted as well.
+"""
+
+import argparse
+import json
+from collections import OrderedDict
+from pathlib import Path
+
+
+def find_report_files(paths):
+    """Report files given directly or found in the given directories."""
+    report_files = []
+    for path in paths:
+        path = Path(path)
+        if path.is_dir():
+            report_files += sorted(path.glob("*_report.json"))
+        else:
+            report_files.append(path)
+    return list(OrderedDict.fromkeys(path.resolve() for path in report_files))
+
+
+def add_times(total, times):
+    for name, seconds in times.items():
+        total[name] = total.get(name, 0.0) + seconds
+
+
+def aggregate_reports(reports):
+    """
+    Sums the counts and times of the sample reports. Observables and cuts are matched by position, and all reports have
+    to list the same ones (same names, required flags and regions) in the same order.
+    """
+    summary = OrderedDict(
+        [
+            ("n_samples", len(reports)),
+            ("engines", sorted({report.get("engine", "unknown") for report in reports})),
+            ("n_events", 0),
+            ("n_passed_prefilter", 0),
+            ("n_passed_required", 0),
+            ("n_passed", 0),
+            ("time_total", 0.0),
+            ("time_lhe_weights", 0.0),
+            ("time_io_wait", 0.0),
+            ("time_prefetch", 0.0),
+            ("time_read", {}),
+            ("time_decode", {}),
+            ("time_particles", {}),
+            ("observables", []),
+            ("cuts", []),
+            ("n_passed_regions", OrderedDict()),
+        ]
+    )
+
+    for report in reports:
+        for key in [
+            "n_events",
+            "n_passed_prefilter",
+            "n_passed_required",
+            "n_passed",
+            "time_total",
+            "time_lhe_weights",
+            "time_io_wait",
+            "time_prefetch",
+        ]:
+            summary[key] += report.get(key, 0)
+        for key in ["time_read", "time_decode", "time_particles"]:
+            add_times(summary[key], report.get(key, {}))
+        for region, n_passed in report.get("n_passed_regions", {}).items():
+            summary["n_passed_regions"][region] = summary["n_passed_regions"].get(region, 0) + n_passed
+
+        for key, fields in [
+            ("observables", ["name", "is_required"]),
+            ("cuts", ["expression", "is_required", "region"]),
+        ]:
+            if not summary[key]:
+                summary[key] = [{field: entry.get(field) for field in fields} for entry in report[key]]
+            if [[entry.get(field) for field in fields] for entry in summary[key]] != [
+                [entry.get(field) for field in fields] for entry in report[key]
+            ]:
+                raise RuntimeError(f"Report of {report.get('delphes_file')} has different {key} than the others")
+
+            for total, entry in zip(summary[key], report[key]):
+                for field, value in entry.items():
+                    if field not in fields:
+                        total[field] = total.get(field, 0) + value
+
+    return summary
+
+
+def fraction(n, n_total):
+    return n / n_total if n_total > 0 else 0.0
+
+
+def print_times(title, times, time_total, n_max=None):
+    if not times:
+        return
+    print(f"\n{title}")
+    for name, seconds in sorted(times.items(), key=lambda item: -item[1])[:n_max]:
+        print(f"  {name:40.40s} {seconds:10.2f} s  {100 * fraction(seconds, time_total):5.1f} %")
+
+
+def print_summary(summary, n_max=None):
+    n_events = summary["n_events"]
+    time_total = summary["time_total"] + summary["time_lhe_weights"]
+
+    print(f"Samples: {summary['n_samples']} (engines: {', '.join(summary['engines'])})")
+    print(f"Events read: {n_events:,}")
+    print(f"Events with enough particles for the required observables: {summary['n_passed_prefilter']:,}")
+    print(f"Events with all required observables: {summary['n_passed_required']:,}")
+    print(f"Events passing everything: {summary['n_passed']:,} ({100 * fraction(summary['n_passed'], n_events):.2f} %)")
+    for region, n_passed in summary["n_passed_regions"].items():
+        print(f"  in region {region}: {n_passed:,} ({100 * fraction(n_passed, n_events):.2f} %)")
+    print(f"Time: {summary['time_total']:.1f} s parsing Delphes files, {summary['time_lhe_weights']:.1f} s LHE weights")
+    if summary["time_prefetch"] > 0:
+        print(
+            f"Time waiting for inputs: {summary['time_io_wait']:.1f} s "
+            f"(prefetched in the background in {summary['time_prefetch']:.1f} s)"
+        )
+
+    print_times("Time reading in bulk (cache, chunks)", summary["time_read"], time_total)
+    print_times("Time decoding Delphes collections", summary["time_decode"], time_total)
+    print_times("Time building particles", summary["time_particles"], time_total)
+    print_times(
+        "Time per observable", OrderedDict((o["name"], o["time"]) for o in summary["observables"]), time_total, n_max
+    )
+
+    print("\nCutflow")
+    print(f"  {'cut':40.40s} {'alone':>8s} {'cumulative':>11s} {'time':>10s}")
+    for cut in summary["cuts"]:
+        label = cut["expression"] if cut.get("region") is None else f"[{cut['region']}] {cut['expression']}"
+        print(
+            f"  {label:40.40s} {100 * fraction(cut['n_passed'], n_events):7.2f}% "
+            f"{100 * fraction(cut['n_passed_cumulative'], n_events):10.2f}% {cut['time']:10.2f} s"
+        )
+
+    if summary["cuts"]:
+        most_selective = min(summary["cuts"], key=lambda cut: cut["n_passed"])
+        print(f"\nMost selective cut: {most_selective['expression']}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Aggregate the cutflow and timing reports of 03a_read_delphes.py")
+    parser.add_argument("paths", nargs="+", help="Report files (*_report.json) or directories containing them")
+    parser.add_argument("-o", "--output", default=None, help="Save the aggregated report to this JSON file")
+    parser.add_argument("-n", "--n_max", type=int, default=None, help="Only list the N slowest observables")
+
+    args = parser.parse_args()
+
+    report_files = find_report_files(args.paths)
+    if not report_files:
+        print(f"No report files found in {', '.join(args.paths)}")
+        return
+
+    reports = []
+    for report_file in report_files:
+        with open(report_file, "r") as file:
+            reports += json.load(file)
+
+    print(f"Aggregating {len(reports)} sample reports from {len(report_files)} files")
+    print("=" * 60)
+
+    summary = aggregate_reports(reports)
+    print_summary(summary, args.n_max)
+
+    if args.output is not None:
+        with open(args.output, "w") as file:
+            json.dump(summary, file, indent=2)
+
+
+if __name__ == "__main__":
+    main()
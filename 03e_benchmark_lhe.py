@@ -0,0 +1,128 @@
+#!/usr/bin/env python3
+"""
+Script to compare the streaming LHE weight reader (changed_code/lhe_stream.py) with MadMiner's parse_lhe_file().
+Usage: python 03e_benchmark_lhe.py <run directory or LHE file> [-s sm] [--background] [--hh]
+
+Both readers extract the benchmark weights of every event of one run, as 03a does with weights="lhe". The script
+checks that they agree and prints how long each took. With --hh, it also prints the parton-level hh observables that
+the streaming reader computes from the Higgs momenta.
+"""
+
+import argparse
+import logging
+import os
+import time
+from collections import OrderedDict
+from pathlib import Path
+
+import numpy as np
+import yaml
+
+from madminer.utils.interfaces.hdf5 import load_madminer_settings
+from madminer.utils.interfaces.lhe import parse_lhe_file
+from madminer.utils.interfaces.lhe_stream import parse_lhe_weights
+from madminer.utils.interfaces.lhe_stream import read_lhe_events
+
+
+def time_call(function, *args, **kwargs):
+    start_time = time.perf_counter()
+    result = function(*args, **kwargs)
+    return result, time.perf_counter() - start_time
+
+
+def compare_weights(reference, weights):
+    """Largest relative difference between two OrderedDicts of weights, or None if they have different entries"""
+    if list(reference) != list(weights) or any(reference[key].shape != weights[key].shape for key in reference):
+        return None
+    return max(
+        float(np.max(np.abs(weights[key] - reference[key]) / np.maximum(np.abs(reference[key]), 1e-300), initial=0.0))
+        for key in reference
+    )
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark the streaming LHE weight reader against parse_lhe_file()")
+    parser.add_argument("path", help="Run directory (containing unweighted_events.lhe.gz) or LHE file")
+    parser.add_argument("-s", "--sampling_benchmark", default="sm", help="Benchmark the events were generated at")
+    parser.add_argument("--background", action="store_true", help="The run is a background run")
+    parser.add_argument("--setup", default=None, help="MadMiner setup file (default: morphing_setup in workflow.yaml)")
+    parser.add_argument("--text", action="store_true", help="Also time parse_lhe_file() with its text parser")
+    parser.add_argument("--hh", action="store_true", help="Also compute the parton-level hh observables")
+    args = parser.parse_args()
+
+    logging.basicConfig(format="%(asctime)-5.5s %(name)-20.20s %(levelname)-7.7s %(message)s", level=logging.INFO)
+
+    lhe_file = Path(args.path)
+    if lhe_file.is_dir():
+        lhe_file = lhe_file / "unweighted_events.lhe.gz"
+    lhe_file = str(lhe_file)
+
+    setup_file = args.setup
+    if setup_file is None:
+        with open("workflow.yaml", "r") as file:
+            setup_file = yaml.safe_load(file)["morphing_setup"]
+    benchmark_names = list(load_madminer_settings(setup_file, include_nuisance_benchmarks=False)[1].keys())
+
+    kwargs = dict(
+        sampling_benchmark=args.sampling_benchmark, benchmark_names=benchmark_names, is_background=args.background
+    )
+
+    # parse_lhe_file() decompresses the LHE file next to it and reads it from there from then on, so the streaming
+    # reader runs first to be timed on the gzipped file as 03a sees it
+    unzipped_file = Path(lhe_file).with_suffix("")
+    had_unzipped_file = lhe_file.endswith(".gz") and unzipped_file.exists()
+
+    timings = OrderedDict()
+    weights, timings["streaming (gzipped)"] = time_call(parse_lhe_weights, lhe_file, **kwargs)
+
+    (_, reference), timings["parse_lhe_file (XML)"] = time_call(
+        parse_lhe_file,
+        lhe_file,
+        observables=OrderedDict(),
+        parse_events_as_xml=True,
+        systematics_dict={},
+        **kwargs,
+    )
+    if args.text:
+        # the text parser only reads uncompressed files, which parse_lhe_file() has left next to the gzipped one
+        (_, reference_text), timings["parse_lhe_file (text)"] = time_call(
+            parse_lhe_file,
+            str(unzipped_file) if lhe_file.endswith(".gz") else lhe_file,
+            observables=OrderedDict(),
+            parse_events_as_xml=False,
+            systematics_dict={},
+            **kwargs,
+        )
+
+    _, timings["streaming (unzipped)"] = time_call(parse_lhe_weights, lhe_file, **kwargs)
+
+    if args.hh:
+        (_, _, _, observations), timings["streaming with hh observables"] = time_call(
+            read_lhe_events, lhe_file, args.sampling_benchmark, hh_observables=True
+        )
+
+    if lhe_file.endswith(".gz") and not had_unzipped_file and unzipped_file.exists():
+        os.remove(unzipped_file)
+
+    n_events = len(next(iter(weights.values())))
+    print(f"\n{lhe_file}: {n_events:,} events, {len(weights)} weights per event")
+    for name, seconds in timings.items():
+        print(f"  {name:32s} {seconds:8.2f} s  {seconds / timings['parse_lhe_file (XML)']:6.3f} x XML")
+
+    difference = compare_weights(reference, weights)
+    if difference is None:
+        print("Weights DIFFER: different benchmarks or numbers of events")
+    else:
+        print(f"Weights agree with parse_lhe_file() to a relative difference of {difference:.1e}")
+    if args.text:
+        difference = compare_weights(reference, reference_text)
+        print(f"XML and text parsers of parse_lhe_file() agree to {difference:.1e}" if difference is not None else "")
+
+    if args.hh:
+        print("\nParton-level hh observables (mean, and fraction of events with exactly two Higgs bosons)")
+        for name, values in observations.items():
+            print(f"  {name:12s} {np.nanmean(values):12.4g} {np.mean(np.isfinite(values)):8.3f}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,158 @@
+#!/usr/bin/env python3
+"""
+Script to compare storage layouts of a compiled event file (the output of 03b_compile.py) for the reads of step 4.
+Usage: python 03f_benchmark_layouts.py <compiled file> [--chunk_rows 1000 10000 100000] [--compressions none lzf gzip]
+
+The file is copied once per layout (chunks of chunk_rows events, compression of the weights, see helpers/shuffle.py)
+into a temporary directory next to it. For every copy, and for the file as it is, the script times a full read of the
+events with h5py, the cross sections that helpers/test_statistics.py computes with SampleAugmenter, and a test sample
+drawn as in 04a_make_samples.py, and prints them together with the file size. With --cold, the file is dropped from
+the page cache before every read, so that the times include reading it from disk.
+"""
+
+import argparse
+import json
+import logging
+import os
+import shutil
+import tempfile
+import time
+from collections import OrderedDict
+
+import h5py
+
+from madminer import sampling
+from madminer.sampling import SampleAugmenter
+
+from helpers.shuffle import COMPRESSIONS, copy_with_layout
+
+with_blosc = True
+try:
+    import hdf5plugin  # noqa: F401 (registers the Blosc filter with h5py)
+except ImportError:
+    with_blosc = False
+
+
+def drop_from_page_cache(filename):
+    with open(filename, "rb") as file:
+        os.fsync(file.fileno())
+        os.posix_fadvise(file.fileno(), 0, 0, os.POSIX_FADV_DONTNEED)
+
+
+def read_events(filename):
+    with h5py.File(filename, "r") as file:
+        return [file[f"samples/{name}"][()] for name in ["observations", "weights", "sampling_benchmarks"]]
+
+
+def cross_sections(filename):
+    return SampleAugmenter(filename).cross_sections(theta=sampling.morphing_point((0, 0, 0)))
+
+
+def sample_test(filename, folder, n_samples):
+    return SampleAugmenter(filename).sample_test(
+        theta=sampling.morphing_point((0, 0, 0)),
+        n_samples=n_samples,
+        folder=folder,
+        filename="benchmark_test",
+        sample_only_from_closest_benchmark=True,
+    )
+
+
+def time_reads(filename, folder, n_samples, repeat, cold):
+    """Shortest time of every read over repeat runs"""
+    reads = OrderedDict(
+        [
+            ("read", lambda: read_events(filename)),
+            ("cross_sections", lambda: cross_sections(filename)),
+            ("sample_test", lambda: sample_test(filename, folder, n_samples)),
+        ]
+    )
+
+    timings = OrderedDict()
+    for name, read in reads.items():
+        times = []
+        for _ in range(repeat):
+            if cold:
+                drop_from_page_cache(filename)
+            start_time = time.perf_counter()
+            read()
+            times.append(time.perf_counter() - start_time)
+        timings[name] = min(times)
+    return timings
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Time MadMiner's reads of a compiled event file in different layouts")
+    parser.add_argument("filename", help="Compiled event file, e.g. delphes_b0_shuffled_14TeV.h5")
+    parser.add_argument("--chunk_rows", type=int, nargs="+", default=[1000, 10000, 100000], help="Chunk sizes")
+    parser.add_argument(
+        "--compressions",
+        nargs="+",
+        default=[compression for compression in COMPRESSIONS if compression != "blosc" or with_blosc],
+        help=f"Compressions of the weights ({', '.join(COMPRESSIONS)}, gzip:<level>, blosc:<level>)",
+    )
+    parser.add_argument("--n_samples", type=int, default=10000, help="Events drawn in the sample_test() read")
+    parser.add_argument("--repeat", type=int, default=3, help="Runs per read, the fastest one is kept")
+    parser.add_argument("--cold", action="store_true", help="Drop the file from the page cache before every read")
+    parser.add_argument("--tmp_dir", default=None, help="Directory for the copies (default: next to the file)")
+    parser.add_argument("-o", "--output", default=None, help="Save the results to this JSON file")
+    args = parser.parse_args()
+
+    logging.basicConfig(format="%(asctime)-5.5s %(name)-20.20s %(levelname)-7.7s %(message)s", level=logging.WARNING)
+
+    tmp_dir = tempfile.mkdtemp(prefix=".layouts_", dir=args.tmp_dir or os.path.dirname(os.path.abspath(args.filename)))
+    results = []
+
+    try:
+        layouts = [("as is", None, None)] + [
+            (f"{chunk_rows} rows, {compression}", chunk_rows, compression)
+            for chunk_rows in args.chunk_rows
+            for compression in args.compressions
+        ]
+
+        for name, chunk_rows, compression in layouts:
+            filename = args.filename
+            time_write = 0.0
+            if chunk_rows is not None:
+                filename = os.path.join(tmp_dir, f"layout_{len(results)}.h5")
+                start_time = time.perf_counter()
+                copy_with_layout(args.filename, filename, chunk_rows=chunk_rows, compression=compression)
+                time_write = time.perf_counter() - start_time
+
+            timings = time_reads(filename, tmp_dir, args.n_samples, args.repeat, args.cold)
+            results.append(
+                OrderedDict(
+                    [
+                        ("layout", name),
+                        ("chunk_rows", chunk_rows),
+                        ("compression", compression),
+                        ("size_mb", os.path.getsize(filename) / 1024**2),
+                        ("time_write", time_write),
+                    ]
+                    + [(f"time_{read}", seconds) for read, seconds in timings.items()]
+                )
+            )
+
+            if chunk_rows is not None:
+                os.remove(filename)
+
+    finally:
+        shutil.rmtree(tmp_dir, ignore_errors=True)
+
+    with h5py.File(args.filename, "r") as file:
+        n_events = len(file["samples/observations"])
+    print(f"\n{args.filename}: {n_events:,} events ({'cold' if args.cold else 'warm'} page cache)")
+    print(f"  {'layout':24s} {'size':>9s} {'write':>8s} {'read':>8s} {'xsecs':>8s} {'sample':>8s}")
+    for result in results:
+        print(
+            f"  {result['layout']:24s} {result['size_mb']:7.1f}MB {result['time_write']:7.2f}s "
+            f"{result['time_read']:7.2f}s {result['time_cross_sections']:7.2f}s {result['time_sample_test']:7.2f}s"
+        )
+
+    if args.output is not None:
+        with open(args.output, "w") as file:
+            json.dump(results, file, indent=2)
+
+
+if __name__ == "__main__":
+    main()
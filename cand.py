@@ -3,6 +3,8 @@ import awkward as ak  # Now needed for reading the data
 import uproot
 import matplotlib.pyplot as plt
 
+from helpers import kinematics
+
 # -----------------------------------------------------------------------------
 # Helpers
 # -----------------------------------------------------------------------------
@@ -10,27 +12,23 @@ import matplotlib.pyplot as plt
 def compute_candidate_kinematics(pt1, pt2, eta1, eta2, phi1, phi2):
     """
     Computes candidate four-vector kinematics from two jet inputs.
+    Works on single jets as well as on whole arrays of jet pairs (using the compiled kernels in helpers/kinematics.py).
     """
-    E1  = pt1 * np.cosh(eta1)
-    px1 = pt1 * np.cos(phi1)
-    py1 = pt1 * np.sin(phi1)
-    pz1 = pt1 * np.sinh(eta1)
-    
-    E2  = pt2 * np.cosh(eta2)
-    px2 = pt2 * np.cos(phi2)
-    py2 = pt2 * np.sin(phi2)
-    pz2 = pt2 * np.sinh(eta2)
-    
+    px1, py1, pz1, E1 = kinematics.to_cartesian(pt1, eta1, phi1, 0.0)
+    px2, py2, pz2, E2 = kinematics.to_cartesian(pt2, eta2, phi2, 0.0)
+
     E  = E1 + E2
     px, py, pz = px1 + px2, py1 + py2, pz1 + pz2
 
-    eps = 1e-12
-    candidate_pt  = np.sqrt(px**2 + py**2)
-    candidate_p = np.sqrt(px**2 + py**2 + pz**2)
-    candidate_phi = np.arctan2(py, px)
-    candidate_eta = 0.5 * np.log((candidate_p+pz + eps)/(candidate_p-pz + eps))
-    candidate_mass = np.sqrt(max(E**2 - (px**2+py**2+pz**2), 0))
-    candidate_rapidity = 0.5 * np.log((E+pz)/(E-pz)) if (E-pz)!=0 else 0.0
+    candidate_pt  = kinematics.transverse_momentum(px, py)
+    candidate_p = kinematics.momentum(px, py, pz)
+    candidate_phi = kinematics.azimuth(px, py)
+    candidate_eta = kinematics.pseudorapidity(px, py, pz)
+    candidate_mass = kinematics.invariant_mass(px, py, pz, E)
+    with np.errstate(divide="ignore", invalid="ignore"):
+        candidate_rapidity = np.where(E - pz != 0, kinematics.rapidity(pz, E), 0.0)
+    if np.ndim(candidate_rapidity) == 0:
+        candidate_rapidity = float(candidate_rapidity)
 
     return candidate_mass, candidate_pt, (E,px,py,pz), candidate_eta, candidate_phi, candidate_rapidity, candidate_p
 
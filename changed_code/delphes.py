@@ -0,0 +1,163 @@
+import logging
+
+from contextlib import contextmanager
+from pathlib import Path
+from subprocess import Popen
+from subprocess import PIPE
+
+from madminer.utils.various import unzip_file
+
+logger = logging.getLogger(__name__)
+
+
+class DelphesError(RuntimeError):
+    """Raised when the Delphes executable returns a non-zero exit code"""
+
+    def __init__(self, message, exit_code, log_file=None):
+        super().__init__(message)
+        self.exit_code = exit_code
+        self.log_file = log_file
+
+
+def run_delphes(
+    delphes_directory,
+    delphes_card_filename,
+    hepmc_sample_filename,
+    delphes_sample_filename=None,
+    initial_command=None,
+    log_file=None,
+    overwrite_existing_delphes_root_file=True,
+    delete_unzipped_file=True,
+    stream_hepmc=False,
+):
+    """
+    Runs Delphes on a HepMC sample
+
+    A gzipped HepMC sample is decompressed to a file next to it, which is deleted afterwards if delete_unzipped_file
+    is True. With stream_hepmc=True, it is instead decompressed by a gzip process that pipes the events straight into
+    the standard input of Delphes, so that the uncompressed events are never written to disk.
+    """
+
+    # Unzip event file
+    filename = Path(hepmc_sample_filename).with_suffix("")
+    extension = Path(hepmc_sample_filename).suffix
+    to_delete = None
+    streamed_filename = None
+
+    if extension == ".gz" and stream_hepmc and not filename.exists():
+        logger.debug("Streaming %s into Delphes", hepmc_sample_filename)
+        streamed_filename = str(hepmc_sample_filename)
+        hepmc_sample_filename = "-"
+
+    elif extension == ".gz":
+        logger.debug("Unzipping %s", hepmc_sample_filename)
+        if not filename.exists():
+            unzip_file(hepmc_sample_filename, filename)
+        if delete_unzipped_file:
+            to_delete = filename
+
+        hepmc_sample_filename = str(filename)
+
+    # Where to put Delphes sample
+    if delphes_sample_filename is None:
+        filename_prefix = filename.with_suffix("")
+
+        for i in range(1, 1000):
+            if i == 1:
+                filename_candidate = f"{filename_prefix}_delphes.root"
+            else:
+                filename_candidate = f"{filename_prefix}_delphes_{i}.root"
+
+            if not Path(filename_candidate).exists():
+                delphes_sample_filename = filename_candidate
+                break
+            elif overwrite_existing_delphes_root_file:
+                delphes_sample_filename = filename_candidate
+                Path(delphes_sample_filename).unlink()
+                break
+
+        assert delphes_sample_filename is not None, "Could not find filename for Delphes sample"
+        assert Path(delphes_sample_filename).exists() is not True, "Could not find filename for Delphes sample"
+
+    # Initial commands
+    if initial_command is None:
+        initial_command = ""
+    else:
+        initial_command = initial_command + "; "
+
+    # Call Delphes
+    _call_delphes(
+        f"{initial_command}{delphes_directory}/DelphesHepMC "
+        f"{delphes_card_filename} "
+        f"{delphes_sample_filename} "
+        f"{hepmc_sample_filename}",
+        log_file=log_file,
+        gzipped_input=streamed_filename,
+    )
+
+    # Delete unzipped file
+    if to_delete is not None:
+        logger.debug("Deleting %s", to_delete)
+        Path(to_delete).unlink()
+
+    return delphes_sample_filename
+
+
+def _call_delphes(cmd, log_file=None, gzipped_input=None):
+    """
+    Like madminer.utils.various.call_command(), but raises a DelphesError that knows the exit code. If gzipped_input
+    is given, that file is decompressed into the standard input of the command.
+    """
+
+    with _decompressed_stdin(gzipped_input) as stdin:
+        if log_file is not None:
+            with open(log_file, "wb") as log:
+                proc = Popen(cmd, stdin=stdin, stdout=log, stderr=log, shell=True)
+                _ = proc.communicate()
+                exitcode = proc.returncode
+        else:
+            proc = Popen(cmd, stdin=stdin, stdout=PIPE, stderr=PIPE, shell=True)
+            out, err = proc.communicate()
+            exitcode = proc.returncode
+
+    if exitcode != 0:
+        if log_file is not None:
+            raise DelphesError(
+                f"Calling command {cmd} returned exit code {exitcode}. Output in file {log_file}.", exitcode, log_file
+            )
+        else:
+            raise DelphesError(
+                f"Calling command {cmd} returned exit code {exitcode}."
+                f"\n\n"
+                f"Std output: {out}"
+                f"\n\n"
+                f"Error output: {err}"
+                f"\n\n",
+                exitcode,
+            )
+
+    return exitcode
+
+
+@contextmanager
+def _decompressed_stdin(gzipped_filename=None):
+    """
+    Yields the output of `gzip -dc gzipped_filename` as a pipe to be used as standard input of another process, or
+    None if no file is given. Decompression errors are raised when the context is left.
+    """
+
+    if gzipped_filename is None:
+        yield None
+        return
+
+    gzip = Popen(["gzip", "-dc", gzipped_filename], stdout=PIPE, stderr=PIPE)
+    try:
+        yield gzip.stdout
+    finally:
+        # Without our copy of the pipe, gzip is stopped by SIGPIPE if the other process quits before reading everything
+        gzip.stdout.close()
+        _, err = gzip.communicate()
+
+    # A negative return code means that gzip was killed by a signal, i.e. the reader stopped early
+    if gzip.returncode > 0:
+        raise RuntimeError(f"Decompressing {gzipped_filename} returned exit code {gzip.returncode}: {err}")
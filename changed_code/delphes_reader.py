@@ -0,0 +1,1626 @@
+import copy
+import json
+import logging
+import multiprocessing
+import os
+import queue
+import shutil
+import threading
+import time
+
+from collections import OrderedDict
+from contextlib import suppress
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures import ThreadPoolExecutor
+from pathlib import Path
+
+import h5py
+import numpy as np
+
+from madminer.models import Cut
+from madminer.models import Observable
+from madminer.models import NuisanceParameter
+from madminer.utils.interfaces.delphes import DelphesError
+from madminer.utils.interfaces.delphes import run_delphes
+from madminer.utils.interfaces.delphes_root import get_cache_filename
+from madminer.utils.interfaces.delphes_root import parse_delphes_root_file
+from madminer.utils.interfaces.hdf5 import load_madminer_settings
+from madminer.utils.interfaces.hdf5 import save_events
+from madminer.utils.interfaces.hdf5 import save_nuisance_setup
+from madminer.utils.interfaces.hdf5 import _load_benchmarks
+from madminer.utils.interfaces.hdf5 import _save_observables
+from madminer.utils.interfaces.hdf5 import _save_samples_summary
+from madminer.utils.interfaces.hepmc import extract_weight_order
+from madminer.utils.interfaces.lhe import parse_lhe_file
+from madminer.utils.interfaces.lhe import extract_nuisance_parameters_from_lhe_file
+from madminer.utils.interfaces.lhe_stream import parse_lhe_weights
+from madminer.utils.various import unzip_file
+from madminer.sampling import combine_and_shuffle
+
+logger = logging.getLogger(__name__)
+
+
+class DelphesReader:
+    """
+    Detector simulation with Delphes and simple calculation of observables.
+
+    After setting up the parameter space and benchmarks and running MadGraph and Pythia, all of which is organized
+    in the madminer.core.MadMiner class, the next steps are the simulation of detector effects and the calculation of
+    observables.  Different tools can be used for these tasks, please feel free to implement the detector simulation and
+    analysis routine of your choice.
+
+    This class provides an example implementation based on Delphes. Its workflow consists of the following steps:
+
+    * Initializing the class with the filename of a MadMiner HDF5 file (the output of `madminer.core.MadMiner.save()`)
+    * Adding one or multiple event samples produced by MadGraph and Pythia in `DelphesProcessor.add_sample()`.
+    * Running Delphes on the samples that require it through `DelphesProcessor.run_delphes()`.
+    * Optionally, acceptance cuts for all visible particles can be defined with `DelphesProcessor.set_acceptance()`.
+    * Defining observables through `DelphesProcessor.add_observable()` or
+      `DelphesProcessor.add_observable_from_function()`. A simple set of default observables is provided in
+      `DelphesProcessor.add_default_observables()`
+    * Optionally, cuts can be set with `DelphesProcessor.add_cut()`
+    * Calculating the observables from the Delphes ROOT files with `DelphesProcessor.analyse_delphes_samples()`
+    * Saving the results with `DelphesProcessor.save()`
+
+    Please see the tutorial for a detailed walk-through.
+
+    Parameters
+    ----------
+    filename : str or None, optional
+        Path to MadMiner file (the output of `madminer.core.MadMiner.save()`). Default value: None.
+
+    """
+
+    def __init__(self, filename):
+        # Initialize samples
+        self.hepmc_sample_filenames = []
+        self.hepmc_sample_weight_labels = []
+        self.hepmc_sampled_from_benchmark = []
+        self.hepmc_is_backgrounds = []
+        self.lhe_sample_filenames = []
+        self.lhe_sample_filenames_for_weights = []
+        self.delphes_sample_filenames = []
+        self.sample_k_factors = []
+        self.sample_systematics = []
+
+        # Initialize observables
+        self.observables = OrderedDict()
+        self.intermediates = OrderedDict()
+
+        # Initialize cuts
+        self.cuts = []
+        self.regions = OrderedDict()
+        self.region_readers = OrderedDict()
+
+        # Initialize acceptance cuts
+        self.acceptance_pt_min_e = None
+        self.acceptance_pt_min_mu = None
+        self.acceptance_pt_min_a = None
+        self.acceptance_pt_min_j = None
+        self.acceptance_eta_max_e = None
+        self.acceptance_eta_max_mu = None
+        self.acceptance_eta_max_a = None
+        self.acceptance_eta_max_j = None
+
+        # Initialize samples
+        self.reference_benchmark = None
+        self.observations = None
+        self.weights = None
+        self.events_sampling_benchmark_ids = []
+
+        # Initialize event summary
+        self.signal_events_per_benchmark = []
+        self.background_events = 0
+        self.sample_reports = []
+
+        # Information from .h5 file
+        self.filename = filename
+
+        (
+            _,
+            benchmarks,
+            _,
+            _,
+            _,
+            _,
+            _,
+            self.systematics,
+            _,
+            _,
+            _,
+            _,
+            _,
+            _,
+        ) = load_madminer_settings(filename, include_nuisance_benchmarks=False)
+
+        self.benchmark_names_phys = list(benchmarks.keys())
+        self.n_benchmarks_phys = len(benchmarks)
+
+        # Initialize nuisance parameters
+        self.nuisance_parameters = OrderedDict()
+
+    @staticmethod
+    def _check_sample_elements(this_elements, n_events=None):
+        """Sanity checks"""
+
+        # Check number of events in observables
+        for key, elems in this_elements.items():
+            this_n_events = len(elems)
+
+            if n_events is None:
+                n_events = this_n_events
+                logger.debug(f"Found {n_events} events")
+
+            if this_n_events != n_events:
+                raise RuntimeError(f"Mismatching number of events for {key}: {n_events} vs {this_n_events}")
+
+            if not np.issubdtype(elems.dtype, np.number):
+                logger.warning(f"For key {key} have non-numeric dtype {elems.dtype}.")
+
+        return n_events
+
+    def add_sample(
+        self,
+        hepmc_filename,
+        sampled_from_benchmark,
+        is_background=False,
+        delphes_filename=None,
+        lhe_filename=None,
+        k_factor=1.0,
+        weights="lhe",
+        systematics=None,
+    ):
+        """
+        Adds a sample of simulated events. A HepMC file (from Pythia) has to be provided always, since some relevant
+        information is only stored in this file. The user can optionally provide a Delphes file, in this case
+        run_delphes() does not have to be called.
+
+        By default, the weights are read out from the Delphes file and their names from the HepMC file. There are some
+        issues with current MadGraph versions that lead to Pythia not storing the weights. As work-around, MadMiner
+        supports reading weights from the LHE file (the observables still come from the Delphes file). To enable this,
+        use weights="lhe".
+
+        Parameters
+        ----------
+        hepmc_filename : str
+            Path to the HepMC event file (with extension '.hepmc' or '.hepmc.gz').
+
+        sampled_from_benchmark : str
+            Name of the benchmark that was used for sampling in this event file (the keyword `sample_benchmark`
+            of `madminer.core.MadMiner.run()`).
+
+        is_background : bool, optional
+            Whether the sample is a background sample (i.e. without benchmark reweighting).
+
+        delphes_filename : str or None, optional
+            Path to the Delphes event file (with extension '.root'). If None, the user has to call run_delphes(), which
+            will create this file. Default value: None.
+
+        lhe_filename : None or str, optional
+            Path to the LHE event file (with extension '.lhe' or '.lhe.gz'). This is only needed if weights is "lhe".
+
+        k_factor : float, optional
+            Multiplies the cross sections found in the sample. Default value: 1.
+
+        weights : {"delphes", "lhe"}, optional
+            If "delphes", the weights are read out from the Delphes ROOT file, and their names are taken from the
+            HepMC file. If "lhe" (and lhe_filename is not None), the weights are taken from the LHE file (and matched
+            with the observables from the Delphes ROOT file). The "delphes" behaviour is generally better as it
+            minimizes the risk of mismatching observables and weights, but for some MadGraph and Delphes versions
+            there are issues with weights not being saved in the HepMC and Delphes ROOT files. In this case, setting
+            weights to "lhe" and providing the unweighted LHE file from MadGraph may be an easy fix. Default value:
+            "lhe".
+
+        systematics : None or list of str, optional
+            List of systematics associated with this sample. Default value: None.
+
+        Returns
+        -------
+            None
+
+        """
+
+        # Check inputs
+        if hepmc_filename and not Path(hepmc_filename).exists():
+            raise ValueError("The specified hepmc file does not exist")
+
+        if lhe_filename and not Path(lhe_filename).exists():
+            raise ValueError("The specified lhe file does not exist")
+
+        if weights not in ["delphes", "lhe"]:
+            raise ValueError("Unknown setting for weights. Has to be 'delphes' or 'lhe'.")
+
+        if weights == "lhe" and lhe_filename is None:
+            raise ValueError("With weights = 'lhe', a LHE event file has to be provided.")
+
+        if self.systematics and lhe_filename is None:
+            raise ValueError("With systematic uncertainties, a LHE event file has to be provided.")
+
+        logger.debug("Adding event sample %s", hepmc_filename)
+
+        self.hepmc_sample_filenames.append(hepmc_filename)
+        self.hepmc_sampled_from_benchmark.append(sampled_from_benchmark)
+        self.hepmc_is_backgrounds.append(is_background)
+        self.sample_k_factors.append(k_factor)
+        self.delphes_sample_filenames.append(delphes_filename)
+        self.lhe_sample_filenames.append(lhe_filename)
+        self.sample_systematics.append(systematics)
+
+        if weights == "lhe" and lhe_filename is not None:
+            self.hepmc_sample_weight_labels.append(None)
+            self.lhe_sample_filenames_for_weights.append(lhe_filename)
+        else:
+            self.hepmc_sample_weight_labels.append(extract_weight_order(hepmc_filename, sampled_from_benchmark))
+            self.lhe_sample_filenames_for_weights.append(None)
+
+    def run_delphes(
+        self,
+        delphes_directory,
+        delphes_card,
+        initial_command=None,
+        log_file=None,
+        n_workers=1,
+        stream_hepmc=False,
+        delete_unzipped_hepmc=True,
+    ):
+        """
+        Runs the fast detector simulation Delphes on all HepMC samples added so far for which it hasn't been run yet.
+
+        With n_workers > 1, up to n_workers Delphes processes run at the same time, one per HepMC sample. Every
+        sample then writes its own log file, named after log_file with the index of the sample appended (e.g.
+        `delphes_3.log`), and a summary of the exit codes, Delphes files, and run times of all samples is logged and
+        saved next to them (`delphes_summary.json`). If some samples fail, the others still run, and a RuntimeError
+        listing the failed samples is raised at the end. The Delphes files are named as in a serial run.
+
+        Parameters
+        ----------
+        delphes_directory : str
+            Path to the Delphes directory.
+
+        delphes_card : str
+            Path to a Delphes card.
+
+        initial_command : str or None, optional
+            Initial bash commands that have to be executed before Delphes is run (e.g. to load the correct virtual
+            environment). Default value: None.
+
+        log_file : str or None, optional
+            Path to log file in which the Delphes output is saved. Default value: None.
+
+        n_workers : int, optional
+            Number of Delphes processes that run at the same time. Default value: 1.
+
+        stream_hepmc : bool, optional
+            If True, gzipped HepMC samples are decompressed on the fly and piped into Delphes, so that the uncompressed
+            events never reach the disk. Default value: False.
+
+        delete_unzipped_hepmc : bool, optional
+            Without streaming, whether the decompressed HepMC files are deleted after Delphes has run. Set this to False
+            (together with stream_hepmc=False) to keep them for debugging. Default value: True.
+
+        Returns
+        -------
+            None
+
+        """
+
+        if log_file is None:
+            log_file = "./logs/delphes.log"
+
+        pending = []
+        for i, (delphes_filename, hepmc_filename) in enumerate(
+            zip(self.delphes_sample_filenames, self.hepmc_sample_filenames)
+        ):
+            if delphes_filename is not None and Path(delphes_filename).is_file():
+                logger.debug("Delphes already run for event sample %s", hepmc_filename)
+                continue
+            elif delphes_filename is not None:
+                logger.debug(
+                    "Given Delphes file %s does not exist, running Delphes again on HepMC sample at %s",
+                    delphes_filename,
+                    hepmc_filename,
+                )
+            else:
+                logger.info("Running Delphes on HepMC sample at %s", hepmc_filename)
+
+            if n_workers > 1:
+                pending.append(i)
+                continue
+
+            delphes_sample_filename = run_delphes(
+                delphes_directory=delphes_directory,
+                delphes_card_filename=delphes_card,
+                hepmc_sample_filename=hepmc_filename,
+                initial_command=initial_command,
+                log_file=log_file,
+                delete_unzipped_file=delete_unzipped_hepmc,
+                stream_hepmc=stream_hepmc,
+            )
+
+            self.delphes_sample_filenames[i] = delphes_sample_filename
+
+        if pending:
+            self._run_delphes_concurrently(
+                pending,
+                n_workers,
+                log_file,
+                delphes_directory=delphes_directory,
+                delphes_card_filename=delphes_card,
+                initial_command=initial_command,
+                delete_unzipped_file=delete_unzipped_hepmc,
+                stream_hepmc=stream_hepmc,
+            )
+
+    def _run_delphes_concurrently(self, samples, n_workers, log_file, **delphes_kwargs):
+        # Samples with the same HepMC file would write the same Delphes file, so Delphes runs once for all of them
+        samples_by_hepmc = OrderedDict()
+        for i in samples:
+            samples_by_hepmc.setdefault(os.path.abspath(self.hepmc_sample_filenames[i]), []).append(i)
+
+        log_path = Path(log_file)
+        log_path.parent.mkdir(parents=True, exist_ok=True)
+
+        def run(i):
+            this_log_file = str(log_path.with_name(f"{log_path.stem}_{i}{log_path.suffix}"))
+            run_summary = OrderedDict(
+                [
+                    ("sample", i),
+                    ("hepmc_file", self.hepmc_sample_filenames[i]),
+                    ("delphes_file", None),
+                    ("log_file", this_log_file),
+                    ("exit_code", None),
+                    ("error", None),
+                ]
+            )
+
+            start_time = time.perf_counter()
+            try:
+                run_summary["delphes_file"] = run_delphes(
+                    hepmc_sample_filename=self.hepmc_sample_filenames[i], log_file=this_log_file, **delphes_kwargs
+                )
+                run_summary["exit_code"] = 0
+            except DelphesError as e:
+                run_summary["exit_code"] = e.exit_code
+                run_summary["error"] = str(e)
+            except Exception as e:
+                run_summary["error"] = f"{type(e).__name__}: {e}"
+            run_summary["time"] = time.perf_counter() - start_time
+
+            return run_summary
+
+        logger.info(
+            "Running Delphes on %s HepMC samples with up to %s processes at once", len(samples_by_hepmc), n_workers
+        )
+        with ThreadPoolExecutor(max_workers=min(n_workers, len(samples_by_hepmc))) as executor:
+            summary = list(executor.map(run, [indices[0] for indices in samples_by_hepmc.values()]))
+
+        failed = []
+        for run_summary, indices in zip(summary, samples_by_hepmc.values()):
+            if run_summary["exit_code"] == 0:
+                for i in indices:
+                    self.delphes_sample_filenames[i] = run_summary["delphes_file"]
+                logger.info(
+                    "  Sample %s: exit code 0 after %.0f s, %s",
+                    run_summary["sample"],
+                    run_summary["time"],
+                    run_summary["delphes_file"],
+                )
+            else:
+                failed.append(run_summary)
+                logger.error(
+                    "  Sample %s: exit code %s after %.0f s, see %s",
+                    run_summary["sample"],
+                    run_summary["exit_code"],
+                    run_summary["time"],
+                    run_summary["log_file"],
+                )
+
+        summary_file = log_path.with_name(f"{log_path.stem}_summary.json")
+        with open(summary_file, "w") as file:
+            json.dump(summary, file, indent=2)
+        logger.info("%s / %s Delphes runs succeeded", len(summary) - len(failed), len(summary))
+        logger.info("Summary of the Delphes runs saved to %s", summary_file)
+
+        if failed:
+            raise RuntimeError(
+                f"Delphes failed for {len(failed)} of {len(summary)} HepMC samples: "
+                + ", ".join(f"{run_summary['hepmc_file']} (see {run_summary['log_file']})" for run_summary in failed)
+            )
+
+    def set_acceptance(
+        self,
+        pt_min_e=None,
+        pt_min_mu=None,
+        pt_min_a=None,
+        pt_min_j=None,
+        eta_max_e=None,
+        eta_max_mu=None,
+        eta_max_a=None,
+        eta_max_j=None,
+    ):
+        """
+        Sets acceptance cuts for all visible particles. These are taken into account before observables and cuts
+        are calculated.
+
+        Parameters
+        ----------
+        pt_min_e : float or None, optional
+             Minimum electron transverse momentum in GeV. None means no acceptance cut. Default value: None.
+
+        pt_min_mu : float or None, optional
+             Minimum muon transverse momentum in GeV. None means no acceptance cut. Default value: None.
+
+        pt_min_a : float or None, optional
+             Minimum photon transverse momentum in GeV. None means no acceptance cut. Default value: None.
+
+        pt_min_j : float or None, optional
+             Minimum jet transverse momentum in GeV. None means no acceptance cut. Default value: None.
+
+        eta_max_e : float or None, optional
+             Maximum absolute electron pseudorapidity. None means no acceptance cut. Default value: None.
+
+        eta_max_mu : float or None, optional
+             Maximum absolute muon pseudorapidity. None means no acceptance cut. Default value: None.
+
+        eta_max_a : float or None, optional
+             Maximum absolute photon pseudorapidity. None means no acceptance cut. Default value: None.
+
+        eta_max_j : float or None, optional
+             Maximum absolute jet pseudorapidity. None means no acceptance cut. Default value: None.
+
+        Returns
+        -------
+            None
+
+        """
+
+        self.acceptance_pt_min_e = pt_min_e
+        self.acceptance_pt_min_mu = pt_min_mu
+        self.acceptance_pt_min_a = pt_min_a
+        self.acceptance_pt_min_j = pt_min_j
+
+        self.acceptance_eta_max_e = eta_max_e
+        self.acceptance_eta_max_mu = eta_max_mu
+        self.acceptance_eta_max_a = eta_max_a
+        self.acceptance_eta_max_j = eta_max_j
+
+    def add_observable(self, name, definition, required=False, default=None):
+        """
+        Adds an observable as a string that can be parsed by Python's `eval()` function.
+
+        Parameters
+        ----------
+        name : str
+            Name of the observable. Since this name will be used in `eval()` calls for cuts, this should not contain
+            spaces or special characters.
+
+        definition : str
+            An expression that can be parsed by Python's `eval()` function. As objects, the visible particles can be
+            used: `e`, `mu`, `j`, `a`, and `l` provide lists of electrons, muons, jets, photons, and leptons (electrons
+            and muons combined), in each case sorted by descending transverse momentum. `met` provides a missing ET
+            object. `visible` and `all` provide access to the sum of all visible particles and the sum of all visible
+            particles plus MET, respectively. In addition, `MadMinerParticle` have  properties `charge` and `pdg_id`,
+            which return the charge in units of elementary charges (i.e. an electron has `e[0].charge = -1.`), and the
+            PDG particle ID. For instance, `"abs(j[0].phi - j[1].phi)"` defines the azimuthal angle between the two
+            hardest jets.
+
+        required : bool, optional
+            Whether the observable is required. If True, an event will only be retained if this observable is
+            successfully parsed. For instance, any observable involving `"j[1]"` will only be parsed if there are at
+            least two jets passing the acceptance cuts. Default value: False.
+
+        default : float or None, optional
+            If `required=False`, this is the placeholder value for observables that cannot be parsed. None is replaced
+            with `np.nan`. Default value: None.
+
+        Returns
+        -------
+            None
+        """
+
+        if required:
+            logger.debug("Adding required observable %s = %s", name, definition)
+        else:
+            logger.debug("Adding optional observable %s = %s with default %s", name, definition, default)
+
+        self.observables[name] = Observable(
+            name=name,
+            val_expression=definition,
+            val_default=default,
+            is_required=required,
+        )
+
+    def add_observable_from_function(self, name, fn, required=False, default=None):
+        """
+        Adds an observable defined through a function.
+
+        Parameters
+        ----------
+        name : str
+            Name of the observable. Since this name will be used in `eval()` calls for cuts, this should not contain
+            spaces or special characters.
+
+        fn : function
+            A function with signature `observable(leptons, photons, jets, met)` where the input arguments are lists of
+            MadMinerParticle instances and a float is returned. The function should raise a `RuntimeError` to signal
+            that it is not defined.
+
+        required : bool, optional
+            Whether the observable is required. If True, an event will only be retained if this observable is
+            successfully parsed. For instance, any observable involving `"j[1]"` will only be parsed if there are at
+            least two jets passing the acceptance cuts. Default value: False.
+
+        default : float or None, optional
+            If `required=False`, this is the placeholder value for observables that cannot be parsed. None is replaced
+            with `np.nan`. Default value: None.
+
+        Returns
+        -------
+            None
+        """
+
+        if required:
+            logger.debug("Adding required observable %s defined through external function", name)
+        else:
+            logger.debug(
+                "Adding optional observable %s defined through external function with default %s", name, default
+            )
+
+        self.observables[name] = Observable(
+            name=name,
+            val_expression=fn,
+            val_default=default,
+            is_required=required,
+        )
+
+    def add_intermediate(self, name, definition):
+        """
+        Adds an intermediate quantity that several observables share, for instance the two leading b-jets or the
+        diphoton system. It is computed at most once per event (once per Delphes file or chunk with
+        engine="columnar") and can be used by name in observables, cuts, and intermediates defined later.
+
+        Parameters
+        ----------
+        name : str
+            Name of the intermediate. This should be a valid Python identifier that does not clash with any observable
+            or with the particle lists (e, mu, l, a, j, met).
+
+        definition : str or function
+            Either a string that can be evaluated like the definition of an observable, or a function with signature
+            `intermediate(leptons, photons, jets, met)`. Its value can be anything, e.g. a MadMinerParticle or a list
+            of them. Functions (including observable functions) get other intermediates through additional arguments
+            named after them, e.g. `observable(leptons, photons, jets, met, bjets)`, and can have a `columnar`
+            attribute with the version used by engine="columnar". A `collections` attribute listing the particle
+            lists a function reads, e.g. ("a", "j"), lets the Delphes branches of all other collections be skipped;
+            without it, all of them are read.
+
+        Returns
+        -------
+            None
+        """
+
+        logger.debug("Adding intermediate %s", name)
+
+        self.intermediates[name] = definition
+
+    def add_default_observables(
+        self,
+        n_leptons_max=2,
+        n_photons_max=2,
+        n_jets_max=2,
+        include_met=True,
+        include_visible_sum=True,
+        include_numbers=True,
+        include_charge=True,
+    ):
+        """
+        Adds a set of simple standard observables: the four-momenta (parameterized as E, pT, eta, phi) of the hardest
+        visible particles, and the missing transverse energy.
+
+        Parameters
+        ----------
+        n_leptons_max : int, optional
+            Number of hardest leptons for which the four-momenta are saved. Default value: 2.
+
+        n_photons_max : int, optional
+            Number of hardest photons for which the four-momenta are saved. Default value: 2.
+
+        n_jets_max : int, optional
+            Number of hardest jets for which the four-momenta are saved. Default value: 2.
+
+        include_met : bool, optional
+            Whether the missing energy observables are stored. Default value: True.
+
+        include_visible_sum : bool, optional
+            Whether observables characterizing the sum of all particles are stored. Default value: True.
+
+        include_numbers : bool, optional
+            Whether the number of leptons, photons, and jets is saved as observable. Default value: True.
+
+        include_charge : bool, optional
+            Whether the lepton charge is saved as observable. Default value: True.
+
+        Returns
+        -------
+            None
+        """
+
+        logger.debug("Adding default observables")
+
+        # ETMiss
+        if include_met:
+            self.add_observable("et_miss", "met.pt", required=True)
+            self.add_observable("phi_miss", "met.phi", required=True)
+
+        # Sum of visible particles
+        if include_visible_sum:
+            self.add_observable("e_visible", "visible.e", required=True)
+            self.add_observable("eta_visible", "visible.eta", required=True)
+
+        # Individual observed particles
+        for n, symbol, include_this_charge in zip(
+            [n_leptons_max, n_photons_max, n_jets_max], ["l", "a", "j"], [False, False, include_charge]
+        ):
+            if include_numbers:
+                self.add_observable(f"n_{symbol}s", f"len({symbol})", required=True)
+
+            for i in range(n):
+                self.add_observable(f"e_{symbol}{i+1}", f"{symbol}[{i}].e", required=False, default=0.0)
+                self.add_observable(f"pt_{symbol}{i+1}", f"{symbol}[{i}].pt", required=False, default=0.0)
+                self.add_observable(f"eta_{symbol}{i+1}", f"{symbol}[{i}].eta", required=False, default=0.0)
+                self.add_observable(f"phi_{symbol}{i+1}", f"{symbol}[{i}].phi", required=False, default=0.0)
+
+                if include_this_charge and symbol == "l":
+                    self.add_observable(
+                        f"charge_{symbol}{i+1}",
+                        f"{symbol}[{i}].charge",
+                        required=False,
+                        default=0.0,
+                    )
+
+    def add_cut(self, definition, required=False, region=None):
+        """
+        Adds a cut as a string that can be parsed by Python's `eval()` function and returns a bool.
+
+        Parameters
+        ----------
+        definition : str
+            An expression that can be parsed by Python's `eval()` function and returns a bool: True for the event
+            to pass this cut, False for it to be rejected. In the definition, all visible particles can be
+            used: `e`, `mu`, `j`, `a`, and `l` provide lists of electrons, muons, jets, photons, and leptons (electrons
+            and muons combined), in each case sorted by descending transverse momentum. `met` provides a missing ET
+            object. `visible` and `all` provide access to the sum of all visible particles and the sum of all visible
+            particles plus MET, respectively. In addition, `MadMinerParticle` have  properties `charge` and `pdg_id`,
+            which return the charge in units of elementary charges (i.e. an electron has `e[0].charge = -1.`), and the
+            PDG particle ID. For instance, `"len(e) >= 2"` requires at least two electrons passing the acceptance cuts,
+            while `"mu[0].charge > 0."` specifies that the hardest muon is positively charged.
+
+        required : bool, optional
+            Whether the cut is passed if the observable cannot be parsed. Default value: False.
+
+        region : str or None, optional
+            If not None, the cut only applies to the selection region with this name (e.g. a signal region or a
+            sideband), which is created with its first cut. All regions are evaluated in the same pass over the Delphes
+            files, on top of the cuts without a region, and the events of every region are saved to their own file
+            (see `get_region_filename()`). Default value: None.
+
+        Returns
+        -------
+            None
+        """
+
+        logger.debug("Adding cut %s%s", definition, "" if region is None else f" to region {region}")
+
+        cut = Cut(
+            name="CUT",
+            val_expression=definition,
+            is_required=required,
+        )
+
+        if region is None:
+            self.cuts.append(cut)
+        else:
+            self.regions.setdefault(region, []).append(cut)
+
+    def reset_observables(self):
+        """Resets all observables and intermediates."""
+
+        logger.debug("Resetting observables")
+        self.observables = OrderedDict()
+        self.intermediates = OrderedDict()
+
+    def reset_cuts(self):
+        """Resets all cuts."""
+
+        logger.debug("Resetting cuts")
+        self.cuts = []
+        self.regions = OrderedDict()
+
+    def analyse_delphes_samples(
+        self,
+        generator_truth=False,
+        delete_delphes_files=False,
+        reference_benchmark=None,
+        parse_lhe_events_as_xml=True,
+        engine="loop",
+        chunk_size=None,
+        n_workers=1,
+        cache=False,
+        prefetch=0,
+        stream_lhe_weights=False,
+        output_filename=None,
+    ):
+        """
+        Main function that parses the Delphes samples (ROOT files), checks acceptance and cuts, and extracts
+        the observables and weights.
+
+        For every sample, a cutflow and timing report (events read and passing, time spent decoding each Delphes
+        collection and evaluating each observable and cut, pass counts per cut, and time spent parsing the LHE
+        weights) is collected in `sample_reports` and saved together with the events by `save()`.
+
+        If selection regions were defined with `add_cut(..., region=...)`, the events of every region are collected in
+        `region_readers`, a DelphesReader per region with the cuts of the region added to the common ones, and saved to
+        one file per region.
+
+        Parameters
+        ----------
+        generator_truth : bool, optional
+            If True, the generator truth information (as given out by Pythia) will be parsed. Detector resolution or
+            efficiency effects will not be taken into account.
+
+        delete_delphes_files : bool, optional
+            If True, the Delphes ROOT files will be deleted after extracting the information from them. Default value:
+            False.
+
+        reference_benchmark : str or None, optional
+            The weights at the nuisance benchmarks will be rescaled to some reference theta benchmark:
+            `dsigma(x|theta_sampling(x),nu) -> dsigma(x|theta_ref,nu) = dsigma(x|theta_sampling(x),nu)
+            * dsigma(x|theta_ref,0) / dsigma(x|theta_sampling(x),0)`. This sets the name of the reference benchmark.
+            If None, the first one will be used. Default value: None.
+
+        parse_lhe_events_as_xml : bool, optional
+            Decides whether the LHE events are parsed with an XML parser (more robust, but slower) or a text parser
+            (less robust, faster). Default value: True.
+
+        engine : {"loop", "fused", "adaptive", "columnar"}, optional
+            If "loop", observables and cuts are evaluated event by event on MadMinerParticle objects. "fused" does the
+            same in a single pass over the events and stops working on an event once it fails a cut. "adaptive" also
+            measures how long each observable and cut takes and how many events it rejects on the first events of
+            every Delphes file, and evaluates them in the order that saves the most work for the rest. If "columnar",
+            they are evaluated as array expressions over all events of a Delphes file; observable functions are then
+            used through their `columnar` attribute where it exists. Default value: "loop".
+
+        chunk_size : int or None, optional
+            If not None, the Delphes ROOT files are read in chunks of this many events, and only the events that pass
+            the cuts are kept, which limits the memory used for large files. Default value: None.
+
+        n_workers : int, optional
+            Number of worker processes that parse the samples in parallel. The results are merged in the order in which
+            the samples were added, so the output is the same as with a single process. Observables defined as
+            functions have to be picklable, i.e. defined at the top level of a module. The workers are forked, so
+            that scripts without a `__main__` guard (such as 03a_read_delphes.py) are not run again in every worker,
+            which needs a platform with fork (Linux, macOS). Default value: 1.
+
+        cache : bool, optional
+            If True, the Delphes branches that are read are also stored in a `.npz` file next to each Delphes file
+            and read from there on the next call, as long as the Delphes file has not changed. Default value: False.
+
+        prefetch : int, optional
+            If larger than 0, the input files of the next samples are read on a background thread while the current
+            sample is parsed, at most this many samples ahead: gzipped LHE files are decompressed (to where the LHE
+            parser looks for them, and deleted again after the last sample that reads them), and the Delphes files
+            (and their caches) are read once so that they are in the page cache when they are parsed. The time spent
+            waiting for the prefetched inputs and prefetching them are added to the sample reports as `time_io_wait`
+            and `time_prefetch`. Only used with `n_workers=1`. Default value: 0.
+
+        stream_lhe_weights : bool, optional
+            If True, the weights are read from the LHE files with the bulk reader in
+            `madminer.utils.interfaces.lhe_stream`, which reads the (gzipped) files in large blocks and converts the
+            <rwgt> weights of all events at once, instead of parsing every event with `parse_lhe_file()`. The weights
+            are the same; parse_lhe_events_as_xml is then ignored. Default value: False.
+
+        output_filename : str or None, optional
+            If not None, the events of every sample are appended to resizable datasets in this MadMiner file as soon
+            as the sample is parsed, instead of being kept in memory until `save()`. The memory use then does not grow
+            with the number of samples, and if the job dies, the file holds the samples that were finished. The events
+            are not shuffled, and `observations` and `weights` stay empty, so `save()` is not needed (the sample
+            reports are written next to the file as well). With selection regions, the events of every region are
+            written to `get_region_filename(output_filename, region)` instead. Default value: None.
+
+        Returns
+        -------
+            None
+
+        """
+
+        # Input
+        if reference_benchmark is None:
+            reference_benchmark = self.benchmark_names_phys[0]
+        self.reference_benchmark = reference_benchmark
+
+        # Reset observations
+        self.observations = None
+        self.weights = None
+        self.nuisance_parameters = OrderedDict()
+        self.events_sampling_benchmark_ids = []
+        self.signal_events_per_benchmark = [0 for _ in range(self.n_benchmarks_phys)]
+        self.background_events = 0
+        self.sample_reports = []
+        self.region_readers = OrderedDict((region, self._create_region_reader(region)) for region in self.regions)
+
+        samples = list(
+            zip(
+                self.delphes_sample_filenames,
+                self.hepmc_sample_weight_labels,
+                self.hepmc_is_backgrounds,
+                self.hepmc_sampled_from_benchmark,
+                self.lhe_sample_filenames,
+                self.lhe_sample_filenames_for_weights,
+                self.sample_k_factors,
+                self.sample_systematics,
+            )
+        )
+        sample_args = [
+            (
+                delete_delphes_files,
+                delphes_file,
+                generator_truth,
+                is_background,
+                k_factor,
+                lhe_file,
+                lhe_file_for_weights,
+                parse_lhe_events_as_xml,
+                reference_benchmark,
+                sampling_benchmark,
+                weight_labels,
+                sample_syst_names,
+                engine,
+                chunk_size,
+                cache,
+                stream_lhe_weights,
+            )
+            for (
+                delphes_file,
+                weight_labels,
+                is_background,
+                sampling_benchmark,
+                lhe_file,
+                lhe_file_for_weights,
+                k_factor,
+                sample_syst_names,
+            ) in samples
+        ]
+
+        writer = None
+        region_writers = OrderedDict()
+        if output_filename is not None and self.regions:
+            for region, region_reader in self.region_readers.items():
+                region_filename = get_region_filename(output_filename, region)
+                logger.info("Writing the events of region %s to %s as soon as they are parsed", region, region_filename)
+                region_writers[region] = _EventWriter(
+                    region_filename, self.filename, region_reader.observables, reference_benchmark
+                )
+        elif output_filename is not None:
+            logger.info("Writing the events of every sample to %s as soon as it is parsed", output_filename)
+            writer = _EventWriter(output_filename, self.filename, self.observables, reference_benchmark)
+
+        # Parallel parsing: submit all samples at once, collect the results in the original order below
+        executor = None
+        futures = None
+        if n_workers > 1 and len(samples) > 1:
+            logger.info("Analysing %s Delphes samples with %s worker processes", len(samples), n_workers)
+            # Forked workers inherit the reader and the observables as they are; with spawn or forkserver, every
+            # worker would import the calling script again, and 03a runs its whole analysis at the top level
+            executor = ProcessPoolExecutor(
+                max_workers=min(n_workers, len(samples)), mp_context=multiprocessing.get_context("fork")
+            )
+            futures = [executor.submit(_analyse_delphes_sample_in_worker, self, args) for args in sample_args]
+
+        # Serial parsing: read the inputs of the next samples in the background
+        prefetcher = None
+        if futures is None and prefetch > 0:
+            logger.info("Prefetching the inputs of up to %s samples ahead", prefetch)
+            prefetcher = _SamplePrefetcher(
+                [
+                    [delphes_file, get_cache_filename(delphes_file) if cache else None, lhe_file, lhe_file_for_weights]
+                    for delphes_file, _, _, _, lhe_file, lhe_file_for_weights, _, _ in samples
+                ],
+                prefetch,
+            )
+        start_time = time.perf_counter()
+
+        try:
+            for i_sample, (
+                delphes_file,
+                weight_labels,
+                is_background,
+                sampling_benchmark,
+                lhe_file,
+                lhe_file_for_weights,
+                k_factor,
+                sample_syst_names,
+            ) in enumerate(samples):
+                logger.info(
+                    "Analysing Delphes sample %s: Calculating %s observables, requiring %s selection cuts "
+                    "(%s regions), associated with %s",
+                    delphes_file,
+                    len(self.observables),
+                    len(self.cuts),
+                    len(self.regions),
+                    "no systematics"
+                    if sample_syst_names is None
+                    else "systematics" + ", ".join(list(sample_syst_names)),
+                )
+
+                if futures is None:
+                    if prefetcher is not None:
+                        io_counters = prefetcher.wait(i_sample)
+
+                    this_observations, this_weights, this_n_events, region_filters = self._analyse_delphes_sample(
+                        *sample_args[i_sample]
+                    )
+
+                    if prefetcher is not None:
+                        self.sample_reports[-1].update(io_counters)
+                        prefetcher.release(i_sample)
+                else:
+                    results, nuisance_parameters, sample_reports = futures[i_sample].result()
+                    this_observations, this_weights, this_n_events, region_filters = results
+                    self._merge_nuisance_parameters(nuisance_parameters)
+                    self.sample_reports += sample_reports
+
+                if not self.regions:
+                    self._merge_delphes_sample(
+                        this_observations,
+                        this_weights,
+                        this_n_events,
+                        is_background,
+                        sampling_benchmark,
+                        reference_benchmark,
+                        writer,
+                    )
+
+                # The events of a region are those of the sample that pass its cuts
+                for region, region_reader in self.region_readers.items():
+                    region_observations, region_weights, region_n_events = None, None, None
+                    if this_observations is not None and np.any(region_filters[region]):
+                        region_filter = region_filters[region]
+                        region_observations = OrderedDict((k, v[region_filter]) for k, v in this_observations.items())
+                        region_weights = OrderedDict((k, v[region_filter]) for k, v in this_weights.items())
+                        region_n_events = int(np.sum(region_filter))
+
+                    region_reader._merge_delphes_sample(
+                        region_observations,
+                        region_weights,
+                        region_n_events,
+                        is_background,
+                        sampling_benchmark,
+                        reference_benchmark,
+                        region_writers.get(region),
+                    )
+
+                if output_filename is not None:
+                    self._save_reports(output_filename)
+
+            for this_writer in [writer] + list(region_writers.values()):
+                if this_writer is not None:
+                    this_writer.close(self.nuisance_parameters)
+
+        finally:
+            if executor is not None:
+                for future in futures:
+                    future.cancel()
+                executor.shutdown()
+            if prefetcher is not None:
+                prefetcher.close()
+
+        if prefetcher is not None:
+            time_total = time.perf_counter() - start_time
+            time_io_wait = sum(report.get("time_io_wait", 0.0) for report in self.sample_reports)
+            logger.info(
+                "Spent %.1f s waiting for prefetched inputs and %.1f s parsing them",
+                time_io_wait,
+                time_total - time_io_wait,
+            )
+
+        logger.info("Analysed number of events per sampling benchmark:")
+        for name, n_events in zip(self.benchmark_names_phys, self.signal_events_per_benchmark):
+            if n_events > 0:
+                logger.info("  %s from %s", n_events, name)
+
+        if self.background_events > 0:
+            logger.info("  %s from backgrounds", self.background_events)
+
+        for region, region_reader in self.region_readers.items():
+            n_events = sum(region_reader.signal_events_per_benchmark) + region_reader.background_events
+            logger.info("  %s in region %s", n_events, region)
+
+    def _create_region_reader(self, region):
+        """DelphesReader that collects the events of one selection region, i.e. with the cuts of the region added"""
+
+        region_reader = copy.copy(self)
+        region_reader.cuts = self.cuts + self.regions[region]
+        region_reader.regions = OrderedDict()
+        region_reader.region_readers = OrderedDict()
+        region_reader.observations = None
+        region_reader.weights = None
+        region_reader.events_sampling_benchmark_ids = []
+        region_reader.signal_events_per_benchmark = [0 for _ in range(self.n_benchmarks_phys)]
+        region_reader.background_events = 0
+        region_reader.sample_reports = []
+        return region_reader
+
+    def _merge_delphes_sample(
+        self,
+        this_observations,
+        this_weights,
+        this_n_events,
+        is_background,
+        sampling_benchmark,
+        reference_benchmark,
+        writer=None,
+    ):
+        # No events?
+        if this_observations is None:
+            return
+
+        # Store sampling id for each event
+        if is_background:
+            idx = -1
+            self.background_events += this_n_events
+        else:
+            idx = self.benchmark_names_phys.index(sampling_benchmark)
+            self.signal_events_per_benchmark[idx] += this_n_events
+        this_events_sampling_benchmark_ids = np.array([idx] * this_n_events, dtype=int)
+
+        # Streamed to the output file instead of kept in memory
+        if writer is not None:
+            writer.append(
+                this_observations,
+                this_weights,
+                this_events_sampling_benchmark_ids,
+                self.signal_events_per_benchmark,
+                self.background_events,
+            )
+            return
+
+        # First results
+        if self.observations is None and self.weights is None:
+            self.observations = this_observations
+            self.weights = this_weights
+            self.events_sampling_benchmark_ids = this_events_sampling_benchmark_ids
+            return
+
+        # Following results: check consistency with previous results
+        if len(self.observations) != len(this_observations):
+            raise ValueError(
+                f"Number of observations in different Delphes files incompatible: "
+                f"{len(self.observations)} vs {len(this_observations)}"
+            )
+
+        # Merge weights with previous
+        logging.debug("Merging data extracted from this file with data from previous files")
+        previous_reference_weights = np.copy(self.weights[reference_benchmark])
+        for key in self.weights:
+            if key in this_weights:
+                # Benchmark exists in both samples
+                self.weights[key] = np.hstack([self.weights[key], this_weights[key]])
+                logging.debug("  Weights for benchmark %s exist in both", key)
+            else:
+                # Benchmark only in previous samples
+                self.weights[key] = np.hstack([self.weights[key], this_weights[reference_benchmark]])
+                logging.debug("  Weights for benchmark %s exist only in previous files", key)
+        for key in this_weights:
+            if key in self.weights:
+                continue
+            # Benchmark only in new samples
+            self.weights[key] = np.hstack([previous_reference_weights, this_weights[key]])
+            logging.debug("  Weights for benchmark %s exist only in new file", key)
+
+        # Merge observations with previous (should always be the same observables)
+        for key in self.observations:
+            assert key in this_observations, f"Observable {key} not found in Delphes sample!"
+            self.observations[key] = np.hstack([self.observations[key], this_observations[key]])
+
+        self.events_sampling_benchmark_ids = np.hstack(
+            [self.events_sampling_benchmark_ids, this_events_sampling_benchmark_ids]
+        )
+
+    def _merge_nuisance_parameters(self, nuisance_parameters):
+        for nuisance_param_name, nuisance_param in nuisance_parameters.items():
+            previous = self.nuisance_parameters.get(nuisance_param_name)
+
+            if previous is not None and previous != nuisance_param:
+                raise RuntimeError(
+                    f"Inconsistent information for same nuisance parameter {nuisance_param_name}. "
+                    f"Old: {previous}. "
+                    f"New: {nuisance_param}."
+                )
+
+            self.nuisance_parameters[nuisance_param_name] = nuisance_param
+
+    def _analyse_delphes_sample(
+        self,
+        delete_delphes_files,
+        delphes_file,
+        generator_truth,
+        is_background,
+        k_factor,
+        lhe_file,
+        lhe_file_for_weights,
+        parse_lhe_events_as_xml,
+        reference_benchmark,
+        sampling_benchmark,
+        weight_labels,
+        sample_syst_names,
+        engine="loop",
+        chunk_size=None,
+        cache=False,
+        stream_lhe_weights=False,
+    ):
+        # Relevant systematics
+        systematics_used = OrderedDict()
+        if sample_syst_names is None:
+            sample_syst_names = []
+        for key in sample_syst_names:
+            systematics_used[key] = self.systematics[key]
+
+        if len(systematics_used) > 0 and lhe_file_for_weights is None:
+            raise NotImplementedError(
+                "Systematic uncertainties are currently only supported when the weights"
+                " are extracted from the LHE file (instead of the HepMC / Delphes ROOT"
+                " file). Please use the keyword lhe_filename when calling add_sample()."
+            )
+
+        # Read systematics setup from LHE file
+        logger.debug("Extracting nuisance parameter definitions from LHE file")
+        systematics_dict = extract_nuisance_parameters_from_lhe_file(lhe_file, systematics_used)
+        logger.debug("systematics_dict: %s", systematics_dict)
+
+        # systematics_dict has structure
+        # {systematics_name : {nuisance_parameter_name : ((benchmark0, weight0), (benchmark1, weight1), processing)}}
+
+        # Store nuisance parameters
+        for systematics_name, nuisance_info in systematics_dict.items():
+            for nuisance_param_name, ((benchmark0, weight0), (benchmark1, weight1), _) in nuisance_info.items():
+                nuisance_param = self.nuisance_parameters.get(nuisance_param_name)
+
+                if nuisance_param is None:
+                    raise RuntimeError(f"Nuisance parameter {nuisance_param_name} does not exist")
+                if (
+                    nuisance_param.systematic != systematics_name
+                    or nuisance_param.benchmark_pos != benchmark0
+                    or nuisance_param.benchmark_neg != benchmark1
+                ):
+                    raise RuntimeError(
+                        f"Inconsistent information for same nuisance parameter {nuisance_param_name}. "
+                        f"Old: {nuisance_param}. "
+                        f"New: {(systematics_name, benchmark0, benchmark1)}."
+                    )
+
+                self.nuisance_parameters[nuisance_param_name] = NuisanceParameter(
+                    name=nuisance_param_name,
+                    systematic=systematics_name,
+                    benchmark_pos=benchmark0,
+                    benchmark_neg=benchmark1,
+                )
+
+        # Calculate observables and weights in Delphes ROOT file
+        report = OrderedDict(
+            [
+                ("lhe_file", lhe_file_for_weights),
+                ("sampling_benchmark", sampling_benchmark),
+                ("is_background", bool(is_background)),
+            ]
+        )
+        self.sample_reports.append(report)
+
+        region_filters = OrderedDict() if self.regions else None
+        this_observations, this_weights, cut_filter = parse_delphes_root_file(
+            delphes_file,
+            self.observables,
+            self.cuts,
+            weight_labels,
+            use_generator_truth=generator_truth,
+            delete_delphes_sample_file=delete_delphes_files,
+            acceptance_eta_max_a=self.acceptance_eta_max_a,
+            acceptance_eta_max_e=self.acceptance_eta_max_e,
+            acceptance_eta_max_mu=self.acceptance_eta_max_mu,
+            acceptance_eta_max_j=self.acceptance_eta_max_j,
+            acceptance_pt_min_a=self.acceptance_pt_min_a,
+            acceptance_pt_min_e=self.acceptance_pt_min_e,
+            acceptance_pt_min_mu=self.acceptance_pt_min_mu,
+            acceptance_pt_min_j=self.acceptance_pt_min_j,
+            engine=engine,
+            chunk_size=chunk_size,
+            intermediates=self.intermediates,
+            cache=cache,
+            report=report,
+            regions=self.regions,
+            region_filters=region_filters,
+        )
+        # No events found?
+        if this_observations is None:
+            logger.warning("No remaining events in this Delphes file, skipping it")
+            return None, None, None, None
+
+        if this_weights is not None:
+            logger.debug("Found weights %s in Delphes file", list(this_weights.keys()))
+        else:
+            logger.debug("Did not extract weights from Delphes file")
+
+        # Sanity checks
+        n_events = self._check_sample_elements(this_observations, None)
+
+        # Find weights in LHE file
+        if lhe_file_for_weights is not None:
+            logger.debug("Extracting weights from LHE file")
+            start_time = time.perf_counter()
+            if stream_lhe_weights:
+                this_weights = parse_lhe_weights(
+                    filename=lhe_file_for_weights,
+                    sampling_benchmark=sampling_benchmark,
+                    benchmark_names=self.benchmark_names_phys,
+                    is_background=is_background,
+                    systematics_dict=systematics_dict,
+                )
+            else:
+                _, this_weights = parse_lhe_file(
+                    filename=lhe_file_for_weights,
+                    sampling_benchmark=sampling_benchmark,
+                    observables=OrderedDict(),
+                    benchmark_names=self.benchmark_names_phys,
+                    is_background=is_background,
+                    parse_events_as_xml=parse_lhe_events_as_xml,
+                    systematics_dict=systematics_dict,
+                )
+
+            logger.debug("Found weights %s in LHE file", list(this_weights.keys()))
+            report["time_lhe_weights"] = time.perf_counter() - start_time
+
+            # Apply cuts
+            logger.debug("Applying Delphes-based cuts to LHE weights")
+            for key, weights in this_weights.items():
+                this_weights[key] = weights[cut_filter]
+
+        if this_weights is None:
+            raise RuntimeError("Could not extract weights from Delphes ROOT file or LHE file.")
+
+        # Sanity checks
+        n_events = self._check_sample_elements(this_weights, n_events)
+
+        # k factors
+        if k_factor is not None:
+            for key in this_weights:
+                this_weights[key] = k_factor * this_weights[key]
+
+        # Background scenario: we only have one set of weights, but these should be true for all benchmarks
+        if is_background:
+            logger.debug("Sample is background")
+            benchmarks_weight = list(this_weights.values())[0]
+
+            for benchmark_name in self.benchmark_names_phys:
+                this_weights[benchmark_name] = benchmarks_weight
+
+        # Rescale nuisance parameters to reference benchmark
+        reference_weights = this_weights[reference_benchmark]
+        sampling_weights = this_weights[sampling_benchmark]
+        for key in this_weights:
+            if key not in self.benchmark_names_phys:  # Only rescale nuisance benchmarks
+                this_weights[key] = reference_weights / sampling_weights * this_weights[key]
+
+        return this_observations, this_weights, n_events, region_filters
+
+    def save(self, filename_out, shuffle=True):
+        """
+        Saves the observable definitions, observable values, and event weights in a MadMiner file. The parameter,
+        benchmark, and morphing setup is copied from the file provided during initialization. Nuisance benchmarks found
+        in the HepMC file are added.
+
+        Parameters
+        ----------
+        filename_out : str
+            Path to where the results should be saved.
+
+        shuffle : bool, optional
+            If True, events are shuffled before being saved. That's important when there are multiple distinct
+            samples (e.g. signal and background). Default value: True.
+
+        The cutflow and timing reports of the analysed Delphes samples (see `analyse_delphes_samples()`) are saved
+        as a list in a JSON file next to it, with `_report.json` instead of the file extension. With selection regions,
+        the events of every region are saved to `get_region_filename(filename_out, region)` instead of filename_out.
+
+        Returns
+        -------
+            None
+
+        """
+
+        if self.region_readers:
+            for region, region_reader in self.region_readers.items():
+                region_reader.save(get_region_filename(filename_out, region), shuffle)
+            self._save_reports(filename_out)
+            return
+
+        if self.observations is None or self.weights is None:
+            logger.warning("No observations to save!")
+            return
+
+        logger.debug("Loading HDF5 data from %s and saving file to %s", self.filename, filename_out)
+
+        # Save nuisance parameters and benchmarks
+        weight_names = list(self.weights.keys())
+        logger.debug("Weight names: %s", weight_names)
+
+        save_nuisance_setup(
+            file_name=filename_out,
+            file_override=True,
+            nuisance_benchmarks=weight_names,
+            nuisance_parameters=self.nuisance_parameters,
+            reference_benchmark=self.reference_benchmark,
+            copy_from_path=self.filename,
+        )
+
+        # Save events
+        save_events(
+            file_name=filename_out,
+            file_override=True,
+            observables=self.observables,
+            observations=self.observations,
+            weights=self.weights,
+            sampling_benchmarks=self.events_sampling_benchmark_ids,
+            num_signal_events=self.signal_events_per_benchmark,
+            num_background_events=self.background_events,
+        )
+
+        if shuffle:
+            combine_and_shuffle([filename_out], filename_out)
+
+        self._save_reports(filename_out)
+
+    def _save_reports(self, filename_out):
+        if self.sample_reports:
+            report_filename = os.path.splitext(filename_out)[0] + "_report.json"
+            logger.debug("Saving cutflow and timing reports to %s", report_filename)
+            with open(report_filename, "w") as file:
+                json.dump(self.sample_reports, file, indent=2)
+
+
+def get_region_filename(filename, region):
+    """MadMiner file with the events of a selection region: `<filename without extension>_<region><extension>`"""
+
+    stem, extension = os.path.splitext(filename)
+    return f"{stem}_{region}{extension}"
+
+
+def _analyse_delphes_sample_in_worker(reader, args):
+    """
+    Parses one sample in a worker process and returns the results together with the nuisance parameters found and
+    the report of the sample
+    """
+
+    reader.nuisance_parameters = OrderedDict()
+    reader.sample_reports = []
+    results = reader._analyse_delphes_sample(*args)
+    return results, reader.nuisance_parameters, reader.sample_reports
+
+
+class _EventWriter:
+    """
+    Appends the observations and weights of every sample to resizable, chunked datasets in a MadMiner file, in the
+    layout written by `save_events()`. The file is opened only while a sample is appended, so that it is a valid
+    MadMiner file with all samples finished so far at any time.
+
+    The weights of the first sample with events fix the columns of the weights dataset. Later samples without one of
+    these weights get the weights of the reference benchmark instead, as when the samples are merged in memory.
+    """
+
+    def __init__(self, filename, setup_filename, observables, reference_benchmark, chunk_rows=10000):
+        self.filename = filename
+        self.reference_benchmark = reference_benchmark
+        self.chunk_rows = chunk_rows
+        self.weight_names = None
+        self.n_events = 0
+
+        shutil.copyfile(setup_filename, filename)
+        _save_observables(
+            filename, True, [o.name for o in observables.values()], [o.val_expression for o in observables.values()]
+        )
+
+    def append(self, observations, weights, sampling_ids, signal_events_per_benchmark, background_events):
+        if self.weight_names is None:
+            self._create_datasets(len(observations), weights)
+
+        unknown = [name for name in weights if name not in self.weight_names]
+        if unknown:
+            raise RuntimeError(
+                f"Sample has weights {unknown} that the previous samples did not have, which cannot be added to "
+                f"{self.filename} afterwards. Analyse these samples without output_filename and use save() instead."
+            )
+
+        observations = np.column_stack([np.asarray(values, dtype=np.float64) for values in observations.values()])
+        weights = np.column_stack([weights.get(name, weights[self.reference_benchmark]) for name in self.weight_names])
+        n_events = len(sampling_ids)
+
+        with h5py.File(self.filename, "a") as file:
+            for name, values in [
+                ("observations", observations),
+                ("weights", weights),
+                ("sampling_benchmarks", sampling_ids),
+            ]:
+                dataset = file["samples/" + name]
+                dataset.resize(self.n_events + n_events, axis=0)
+                dataset[self.n_events :] = values
+
+        self.n_events += n_events
+        _save_samples_summary(self.filename, True, signal_events_per_benchmark, background_events)
+        logger.debug("Appended %s events to %s, now %s", n_events, self.filename, self.n_events)
+
+    def close(self, nuisance_parameters):
+        if self.n_events == 0:
+            logger.warning("No observations to save!")
+            os.remove(self.filename)
+            return
+
+        if nuisance_parameters:
+            save_nuisance_setup(
+                file_name=self.filename,
+                file_override=True,
+                nuisance_benchmarks=self.weight_names,
+                nuisance_parameters=nuisance_parameters,
+                reference_benchmark=self.reference_benchmark,
+            )
+
+        logger.info("Saved %s events to %s", self.n_events, self.filename)
+
+    def _create_datasets(self, n_observables, weights):
+        save_nuisance_setup(
+            file_name=self.filename,
+            file_override=True,
+            nuisance_benchmarks=list(weights),
+            nuisance_parameters={},
+            reference_benchmark=self.reference_benchmark,
+        )
+
+        # Same column order as save_events()
+        benchmark_names, _, _, _ = _load_benchmarks(self.filename)
+        if all(name in weights for name in benchmark_names):
+            self.weight_names = benchmark_names + sorted(name for name in weights if name not in benchmark_names)
+        else:
+            self.weight_names = list(weights)
+
+        with h5py.File(self.filename, "a") as file:
+            with suppress(KeyError):
+                del file["samples"]
+            for name, n_columns, dtype in [
+                ("observations", n_observables, np.float64),
+                ("weights", len(self.weight_names), np.float64),
+                ("sampling_benchmarks", None, int),
+            ]:
+                shape = (0,) if n_columns is None else (0, n_columns)
+                file.create_dataset(
+                    "samples/" + name,
+                    shape=shape,
+                    maxshape=(None,) + shape[1:],
+                    chunks=(self.chunk_rows,) + shape[1:],
+                    dtype=dtype,
+                )
+
+
+class _SamplePrefetcher:
+    """
+    Prepares the input files of samples in order on a background thread, overlapping the (network) file system I/O
+    with the parsing of the previous samples. Gzipped LHE files are decompressed next to them, where the LHE parsers
+    read them instead of the gzipped files, and all other files are read once so that they are in the page cache. A
+    bounded queue hands the decompressed files of every sample to the parsing thread and keeps the background thread
+    at most n_ahead samples ahead of it. The decompressed files are deleted again once the last sample that reads them
+    has been parsed (release()), or when the prefetcher is closed.
+    """
+
+    def __init__(self, sample_files, n_ahead):
+        self.sample_files = sample_files
+        self._queue = queue.Queue(maxsize=n_ahead)
+        self._stop = threading.Event()
+
+        # Last sample that reads each file, and the files decompressed here that have not been deleted yet
+        self._last_use = {}
+        for i_sample, filenames in enumerate(sample_files):
+            for filename in filenames:
+                if filename is not None:
+                    self._last_use[str(Path(filename).with_suffix(""))] = i_sample
+        self._unzipped_files = []
+
+        self._thread = threading.Thread(target=self._run, name="DelphesReaderPrefetch", daemon=True)
+        self._thread.start()
+
+    def wait(self, i_sample):
+        """Blocks until the files of sample i_sample are prefetched and returns the I/O counters of that sample"""
+
+        start_time = time.perf_counter()
+        j_sample, time_prefetch, n_bytes, unzipped_files = self._queue.get()
+        assert j_sample == i_sample, "Samples have to be parsed in the order in which they are prefetched"
+        logger.debug("Prefetched inputs of sample %s: %s", i_sample, ", ".join(unzipped_files) or "no unzipped files")
+
+        return OrderedDict(
+            [
+                ("time_io_wait", time.perf_counter() - start_time),
+                ("time_prefetch", time_prefetch),
+                ("n_bytes_prefetched", n_bytes),
+            ]
+        )
+
+    def release(self, i_sample):
+        """Deletes the decompressed files that no sample after i_sample reads"""
+
+        for filename in list(self._unzipped_files):
+            if self._last_use.get(filename, -1) <= i_sample:
+                self._delete(filename)
+
+    def close(self):
+        self._stop.set()
+        self._thread.join()
+        for filename in list(self._unzipped_files):
+            self._delete(filename)
+
+    def _delete(self, filename):
+        self._unzipped_files.remove(filename)
+        try:
+            os.remove(filename)
+        except OSError as e:
+            logger.warning("Could not delete prefetched file %s: %s", filename, e)
+
+    def _run(self):
+        for i_sample, filenames in enumerate(self.sample_files):
+            start_time = time.perf_counter()
+            n_bytes = 0
+            unzipped_files = []
+
+            for filename in OrderedDict.fromkeys(filenames):
+                if self._stop.is_set():
+                    return
+                try:
+                    this_n_bytes, unzipped_file = _prefetch_file(filename)
+                except Exception as e:
+                    logger.warning("Could not prefetch %s: %s", filename, e)
+                    continue
+                n_bytes += this_n_bytes
+                if unzipped_file is not None:
+                    unzipped_files.append(unzipped_file)
+                    self._unzipped_files.append(unzipped_file)
+
+            result = (i_sample, time.perf_counter() - start_time, n_bytes, unzipped_files)
+            while not self._stop.is_set():
+                try:
+                    self._queue.put(result, timeout=0.1)
+                    break
+                except queue.Full:
+                    continue
+
+
+def _prefetch_file(filename, block_size=2**24):
+    """
+    Decompresses a gzipped LHE file next to it, where parse_lhe_file() and parse_lhe_weights() look for it before
+    decompressing it themselves, or reads any other file once. Returns the number of bytes read and the decompressed
+    file if it was created here (None otherwise).
+    """
+
+    if filename is None or not os.path.exists(filename):
+        return 0, None
+
+    path = Path(filename)
+    unzipped_file = None
+    if path.suffix == ".gz":
+        unzipped_path = path.with_suffix("")
+        if not unzipped_path.exists():
+            # Decompress to a temporary file first, so that the parser never finds a half-written file
+            temp_path = unzipped_path.with_name(f".{unzipped_path.name}.{os.getpid()}.tmp")
+            unzip_file(path, temp_path)
+            os.replace(temp_path, unzipped_path)
+            unzipped_file = str(unzipped_path)
+        path = unzipped_path
+
+    n_bytes = 0
+    with open(path, "rb") as file:
+        for block in iter(lambda: file.read(block_size), b""):
+            n_bytes += len(block)
+    return n_bytes, unzipped_file
@@ -1,13 +1,27 @@
+import ast
+import hashlib
 import logging
+import operator
 import os
+import time
 
+from abc import abstractmethod
+from collections import ChainMap
+from collections import Counter
 from collections import OrderedDict
+from collections import defaultdict
+from collections.abc import Mapping
+from collections.abc import Sequence
+from contextlib import contextmanager
+from functools import lru_cache
 from typing import Callable
 from typing import Dict
 from typing import List
 
+import awkward as ak
 import numpy as np
 import uproot
+import vector
 
 from particle import Particle
 from madminer.models import Cut
@@ -22,6 +36,40 @@ logger = logging.getLogger(__name__)
 uproot.default_library = "np"
 
 
+ENGINES = ("loop", "fused", "adaptive", "columnar")
+
+# Number of events at the start of a file on which the adaptive engine measures the observables and cuts
+ADAPTIVE_CALIBRATION_EVENTS = 1000
+
+COLLECTIONS = ("e", "mu", "l", "a", "j", "met")
+
+# Collections behind the other names that observables and cuts can use, and the arguments of observable functions
+_DERIVED_OBJECTS = {
+    "visible": ("e", "mu", "a", "j"),
+    "all": ("e", "mu", "a", "j", "met"),
+    "boost_to_com": ("e", "mu", "a", "j", "met"),
+}
+_FUNCTION_ARGUMENTS = ("l", "a", "j", "met")
+
+# Delphes branches read for each collection, with detector simulation and with generator truth
+_COLLECTION_BRANCHES = {
+    "e": {"Electron": ["PT", "Eta", "Phi", "Charge"]},
+    "mu": {"Muon": ["PT", "Eta", "Phi", "Charge"]},
+    "l": {"Electron": ["PT", "Eta", "Phi", "Charge"], "Muon": ["PT", "Eta", "Phi", "Charge"]},
+    "a": {"Photon": ["PT", "Eta", "Phi", "E"]},
+    "j": {"Jet": ["PT", "Eta", "Phi", "Mass", "TauTag", "BTag"]},
+    "met": {"MissingET": ["MET", "Phi"]},
+}
+_COLLECTION_BRANCHES_TRUTH = {
+    "e": {"Particle": ["E", "PT", "Eta", "Phi", "Charge", "PID"]},
+    "mu": {"Particle": ["E", "PT", "Eta", "Phi", "Charge", "PID"]},
+    "l": {"Particle": ["E", "PT", "Eta", "Phi", "Charge", "PID"]},
+    "a": {"Particle": ["E", "PT", "Eta", "Phi", "Charge", "PID"]},
+    "j": {"GenJet": ["PT", "Eta", "Phi", "Mass", "TauTag", "BTag"]},
+    "met": {"GenMissingET": ["MET", "Phi"]},
+}
+
+
 def parse_delphes_root_file(
     delphes_sample_file,
     observables: Dict[str, Observable],
@@ -37,283 +85,1509 @@ def parse_delphes_root_file(
     acceptance_eta_max_a=None,
     acceptance_eta_max_j=None,
     delete_delphes_sample_file=False,
+    engine="loop",
+    chunk_size=None,
+    intermediates=None,
+    cache=False,
+    report=None,
+    regions=None,
+    region_filters=None,
 ):
-    """Extracts observables and weights from a Delphes ROOT file"""
-
-    logger.debug("Parsing Delphes file %s", delphes_sample_file)
+    """
+    Extracts observables and weights from a Delphes ROOT file
+
+    With engine="loop", the observables and cuts are evaluated event by event on MadMinerParticle instances, which are
+    built from flat per-collection arrays when they are accessed. engine="fused" also works event by event, but builds
+    the objects of each event only once, evaluates every cut as soon as the observables it uses are known, and stops
+    working on an event as soon as a required observable is not finite or a cut fails. Observables of rejected events
+    are then left at NaN and the cuts that were never reached count as failed, which does not change the filter or the
+    returned values. engine="adaptive" works like "fused", but first evaluates every observable and cut on the first
+    ADAPTIVE_CALIBRATION_EVENTS events of the file and then reorders them for the remaining events, so that cheap cuts
+    that reject many events come first (see _CutOrdering). With engine="columnar", the Delphes branches are read as
+    whole (jagged) arrays and the observables and cuts are evaluated as array expressions over all events at once.
+    String definitions are evaluated on columnar particle objects; functions are used through their `columnar`
+    attribute if they have one. Every observable or cut that cannot be evaluated that way falls back to the event
+    loop, so both engines return the same observables, weights, and filter (up to floating-point rounding).
+
+    intermediates maps names to definitions (strings or functions, like observables) of quantities that several
+    observables share, such as the two leading b-jets. They are computed at most once per event (or once per chunk of
+    events with engine="columnar"), and observables, cuts, and other intermediates use them by name: in strings
+    directly, and in functions through additional arguments after `(leptons, photons, jets, met)` that are named after
+    the intermediates.
+
+    Before any particles are built, the acceptance cuts are applied to the Delphes branches as arrays, and events
+    that have fewer particles in a collection than the required observables need (see _get_min_multiplicities(), e.g.
+    two photons for a required "a[1].pt") are dropped. They fail the required observables anyway, so this does not
+    change the returned values or the filter.
+
+    regions maps the names of selection regions (e.g. a signal region and sidebands) to lists of additional cuts. The
+    cuts of all regions are evaluated together with the common cuts, on the same particles and observables, but only
+    the common cuts and the required observables reject events on their own. The returned observables and weights are
+    then those of the events that pass the common cuts and the cuts of at least one region, and the filter selects
+    these events. If region_filters is a dict, it is filled with a mask over the returned events for every region.
+
+    By default all events of the file are read at once. If chunk_size is given, the tree is read in chunks of that
+    many entries, each chunk is parsed with the chosen engine, and only the observables and weights of the events
+    that pass are kept, so that the memory needed depends on the chunk size rather than on the size of the file.
+
+    If cache is True, the decoded branches are stored in a compressed npz file next to the ROOT file (see
+    get_cache_filename()), together with the size, modification time, and SHA-256 hash of the ROOT file. Later calls
+    read the branches from there instead of decoding the ROOT file again, as long as the ROOT file is unchanged.
+    Branches that are not in the cache yet are read from the ROOT file and added to it.
+
+    If report is a dict, it is filled with a cutflow and timing report of the file (see _CutflowReport.to_dict()): the
+    number of events read and passing, the time spent reading and decoding each Delphes collection, building the
+    particles, and evaluating each observable and cut, and how many events pass each cut, alone and after all previous
+    ones. All values are plain numbers, strings, lists, and dicts, so that the report can be stored as JSON.
+    """
+
+    start_time = time.perf_counter()
+    cutflow = _CutflowReport()
+
+    if engine not in ENGINES:
+        raise ValueError(f"Unknown engine {engine}. Has to be one of {', '.join(ENGINES)}.")
+
+    logger.debug("Parsing Delphes file %s with the %s engine", delphes_sample_file, engine)
 
     if weight_labels is None:
         logger.debug("Not extracting weights")
     else:
         logger.debug("Extracting weights %s", weight_labels)
 
+    acceptance = {
+        "pt_min_e": acceptance_pt_min_e,
+        "pt_min_mu": acceptance_pt_min_mu,
+        "pt_min_a": acceptance_pt_min_a,
+        "pt_min_j": acceptance_pt_min_j,
+        "eta_max_e": acceptance_eta_max_e,
+        "eta_max_mu": acceptance_eta_max_mu,
+        "eta_max_a": acceptance_eta_max_a,
+        "eta_max_j": acceptance_eta_max_j,
+    }
+
+    if intermediates is None:
+        intermediates = OrderedDict()
+
+    # The cuts of the regions are evaluated with the common ones, region_cut_indices says which of them are whose
+    region_cut_indices = None
+    if regions:
+        cuts = list(cuts)
+        region_cut_indices = OrderedDict()
+        for region, cuts_this_region in regions.items():
+            region_cut_indices[region] = list(range(len(cuts), len(cuts) + len(cuts_this_region)))
+            cuts += cuts_this_region
+
+    # The order learned by the adaptive engine on the first events is kept for all chunks of the file
+    ordering = _CutOrdering(observables, cuts, ADAPTIVE_CALIBRATION_EVENTS) if engine == "adaptive" else None
+
+    collections = _get_required_collections(observables, cuts, intermediates)
+    logger.debug("Reading collections %s", ", ".join(collections))
+
     # Delphes ROOT file
     root_file = uproot.open(delphes_sample_file)
-    
+
     try:
         tree = root_file["Delphes"]
+        branch_names = _get_branch_names(tree, use_generator_truth, collections, weight_labels is not None)
 
-        # Weights
-        weights = None
-        if weight_labels is not None:
-            try:
-                weights = tree["Weight.Weight"].array()
-
-                n_weights = len(weights[0])
-                n_events = len(weights)
+        if cache:
+            with cutflow.timed("read", "cache"):
+                tree = _load_cached_tree(delphes_sample_file, tree, branch_names)
 
-                logger.debug("Found %s events, %s weights", n_events, n_weights)
+        if chunk_size is None:
+            weights = _get_weights(_TimedTree(tree, cutflow), weight_labels)
+            if weights is None:
+                n_events = tree.num_entries if isinstance(tree, _TreeChunk) else _get_n_events(tree)
+                logger.debug("Found %s events", n_events)
+            else:
+                n_events = weights.shape[1]
+
+            observable_values, weights, combined_filter, region_masks = _parse_events(
+                tree,
+                n_events,
+                weights,
+                observables,
+                cuts,
+                intermediates,
+                use_generator_truth,
+                acceptance,
+                collections,
+                engine,
+                cutflow,
+                ordering,
+                region_cut_indices,
+            )
 
-                weights = np.array(weights).reshape((n_events, n_weights)).T
-            except KeyError:
-                raise RuntimeError(
-                    "Extracting weights from Delphes ROOT file failed. Please install inofficial patches"
-                    " for the MG-Pythia interface and Delphes, available upong request, or parse weights"
-                    " from the LHE file!"
+        else:
+            # Read the tree in chunks of entries, keeping only the events that pass
+            chunk_results = []
+
+            for chunk in _iterate_chunks(tree, branch_names, chunk_size, cutflow):
+                n_events = chunk.num_entries
+
+                weights = _get_weights(_TimedTree(chunk, cutflow), weight_labels)
+                chunk_results.append(
+                    _parse_events(
+                        chunk,
+                        n_events,
+                        weights,
+                        observables,
+                        cuts,
+                        intermediates,
+                        use_generator_truth,
+                        acceptance,
+                        collections,
+                        engine,
+                        cutflow,
+                        ordering,
+                        region_cut_indices,
+                    )
                 )
+
+            observable_values, weights, combined_filter, region_masks = _concatenate_chunks(chunk_results, observables)
+
+        if region_filters is not None and region_masks is not None:
+            region_filters.update(region_masks)
+
+        # Apply filter
+        if combined_filter is not None:
+            n_pass = np.sum(combined_filter)
+            n_fail = np.sum(np.invert(combined_filter))
+
+            if n_pass == 0:
+                logger.warning("  No observations remaining!")
+
+                return None, None, combined_filter
+
+            logger.info("  %s / %s events pass everything", n_pass, n_pass + n_fail)
+
+        # Wrap weights
+        if weights is None:
+            weights_dict = None
         else:
-            n_events = _get_n_events(tree)
-            logger.debug("Found %s events", n_events)
-
-        # Get all particle properties
-        if use_generator_truth:
-            photons_all_events = _get_particles_truth(tree, acceptance_pt_min_a, acceptance_eta_max_a, [22])
-            electrons_all_events = _get_particles_truth(tree, acceptance_pt_min_a, acceptance_eta_max_a, [11, -11])
-            muons_all_events = _get_particles_truth(tree, acceptance_pt_min_a, acceptance_eta_max_a, [13, -13])
-            leptons_all_events = _get_particles_truth_leptons(
-                tree, acceptance_pt_min_e, acceptance_eta_max_e, acceptance_pt_min_mu, acceptance_eta_max_mu
-            )
-            jets_all_events = _get_particles_truth_jets(tree, acceptance_pt_min_j, acceptance_eta_max_j)
-            met_all_events = _get_particles_truth_met(tree)
+            weights_dict = OrderedDict()
+            for weight_label, this_weights in zip(weight_labels, weights):
+                weights_dict[weight_label] = this_weights
+
+        # Delete Delphes file
+        if delete_delphes_sample_file:
+            logger.debug("  Deleting %s", delphes_sample_file)
+            os.remove(delphes_sample_file)
+
+        return observable_values, weights_dict, combined_filter
+
+    finally:
+        # Close ROOT file
+        root_file.close()
+
+        if report is not None:
+            report.update(cutflow.to_dict(delphes_sample_file, engine, observables, cuts, region_cut_indices))
+            if ordering is not None:
+                report["evaluation_order"] = ordering.describe()
+            report["time_total"] = time.perf_counter() - start_time
 
+
+def _get_weights(tree, weight_labels):
+    if weight_labels is None:
+        return None
+
+    try:
+        weights = tree["Weight.Weight"].array()
+
+        n_weights = len(weights[0])
+        n_events = len(weights)
+
+        logger.debug("Found %s events, %s weights", n_events, n_weights)
+
+        return np.array(weights).reshape((n_events, n_weights)).T
+    except KeyError:
+        raise RuntimeError(
+            "Extracting weights from Delphes ROOT file failed. Please install inofficial patches"
+            " for the MG-Pythia interface and Delphes, available upong request, or parse weights"
+            " from the LHE file!"
+        )
+
+
+def _parse_events(
+    tree,
+    n_events,
+    weights,
+    observables,
+    cuts,
+    intermediates,
+    use_generator_truth,
+    acceptance,
+    collections,
+    engine,
+    cutflow=None,
+    ordering=None,
+    region_cut_indices=None,
+):
+    """
+    Evaluates observables and cuts on the events of a tree (or of a chunk of it) and returns the observables and
+    weights of the events that pass, together with the filter. Timings and pass counts are added to cutflow, and with
+    engine="adaptive", the order of evaluation is learned on (and kept in) ordering.
+
+    If region_cut_indices maps region names to the indices of their cuts, only the other cuts are applied to all
+    events, an event passes if it also passes the cuts of at least one region, and the masks of the regions over the
+    passing events are returned as well (otherwise None).
+    """
+
+    if cutflow is None:
+        cutflow = _CutflowReport()
+    tree = _TimedTree(tree, cutflow)
+    cutflow.counts["events"] += n_events
+
+    # Drop the events that cannot have all required observables before any particles are built
+    prefilter = None
+    min_multiplicities = _get_min_multiplicities(observables, intermediates, acceptance)
+
+    if min_multiplicities:
+        with cutflow.timed("particles", "prefilter"):
+            tree = _FilteredTree(tree)
+            prefilter = _get_prefilter(tree, n_events, use_generator_truth, acceptance, min_multiplicities)
+            tree = tree.filter(prefilter)
+
+        n_events_all, n_events = n_events, tree.num_entries
+        logger.debug(
+            "  %s / %s events have at least %s particles",
+            n_events,
+            n_events_all,
+            ", ".join(f"{n} {name}" for name, n in min_multiplicities.items()),
+        )
+
+    cutflow.counts["prefilter"] += n_events
+
+    region_cuts = set()
+    if region_cut_indices is not None:
+        region_cuts = {i_cut for indices in region_cut_indices.values() for i_cut in indices}
+
+    # Observables and cuts
+    if engine == "columnar":
+        observable_values, cut_values = _evaluate_columnar(
+            tree, n_events, observables, cuts, intermediates, use_generator_truth, acceptance, collections, cutflow
+        )
+    elif engine in ("fused", "adaptive"):
+        event_loop = _EventLoop(tree, use_generator_truth, acceptance, collections, intermediates, cutflow)
+        observable_values, cut_values = event_loop.evaluate_fused(observables, cuts, n_events, ordering, region_cuts)
+    else:
+        event_loop = _EventLoop(tree, use_generator_truth, acceptance, collections, intermediates, cutflow)
+        observable_values = event_loop.evaluate_observables(observables, n_events)
+        for name in observables:
+            logger.debug("  First 10 values for observable %s:\n%s", name, observable_values[name][:20])
+
+        cut_values = _evaluate_cuts(cuts, observable_values, n_events, event_loop.evaluate_cut, cutflow)
+
+    # Dropped events get NaN observables and fail all cuts
+    if prefilter is not None:
+        for name, values in observable_values.items():
+            observable_values[name] = np.full(n_events_all, np.nan)
+            observable_values[name][prefilter] = values
+        cut_values = [_unfilter(values, prefilter) for values in cut_values]
+        n_events = n_events_all
+
+    for name in observables:
+        cutflow.counts["finite", name] += int(np.sum(np.isfinite(observable_values[name])))
+
+    # Check for existence of required observables
+    combined_filter = None
+
+    for name, observable in observables.items():
+        if not observable.is_required:
+            continue
+
+        this_filter = np.isfinite(observable_values[name])
+        n_pass = np.sum(this_filter)
+        n_fail = np.sum(np.invert(this_filter))
+
+        logger.debug("  %s / %s events pass required observable %s", n_pass, n_pass + n_fail, name)
+
+        if combined_filter is None:
+            combined_filter = this_filter
         else:
-            photons_all_events = _get_particles_photons(tree, acceptance_pt_min_a, acceptance_eta_max_a)
-            electrons_all_events = _get_particles_charged(
-                tree, "Electron", 0.000511, -11, acceptance_pt_min_e, acceptance_eta_max_e
-            )
-            muons_all_events = _get_particles_charged(tree, "Muon", 0.105, -13, acceptance_pt_min_mu, acceptance_eta_max_mu)
-            leptons_all_events = _get_particles_leptons(
-                tree, acceptance_pt_min_e, acceptance_eta_max_e, acceptance_pt_min_mu, acceptance_eta_max_mu
-            )
-            jets_all_events = _get_particles_jets(tree, acceptance_pt_min_j, acceptance_eta_max_j)
-            met_all_events = _get_particles_met(tree)
+            combined_filter = np.logical_and(combined_filter, this_filter)
 
-        # Prepare variables
-        def get_objects(ievent):
-            visible_momentum = MadMinerParticle.from_xyzt(0.0, 0.0, 0.0, 0.0)
-            for p in (
-                electrons_all_events[ievent]
-                + jets_all_events[ievent]
-                + muons_all_events[ievent]
-                + photons_all_events[ievent]
+    cutflow.counts["required"] += n_events if combined_filter is None else int(np.sum(combined_filter))
+
+    # Check cuts
+    for i_cut, (cut, values_this_cut) in enumerate(zip(cuts, cut_values)):
+        if i_cut in region_cuts:
+            continue
+
+        n_pass = np.sum(values_this_cut)
+        n_fail = np.sum(np.invert(values_this_cut))
+
+        logger.debug("  %s / %s events pass cut %s", n_pass, n_pass + n_fail, cut)
+
+        if combined_filter is None:
+            combined_filter = values_this_cut
+        else:
+            combined_filter = np.logical_and(combined_filter, values_this_cut)
+
+        cutflow.counts["cut", i_cut] += int(n_pass)
+        cutflow.counts["cumulative", i_cut] += int(np.sum(combined_filter))
+
+    # Check the cuts of every region on top of the common ones, and keep the events that are in any region
+    region_filters = None
+
+    if region_cut_indices is not None:
+        common_filter = np.ones(n_events, dtype=bool) if combined_filter is None else combined_filter
+        region_filters = OrderedDict()
+
+        for region, indices in region_cut_indices.items():
+            region_filter = common_filter
+            for i_cut in indices:
+                region_filter = np.logical_and(region_filter, cut_values[i_cut])
+                cutflow.counts["cut", i_cut] += int(np.sum(cut_values[i_cut]))
+                cutflow.counts["cumulative", i_cut] += int(np.sum(region_filter))
+
+            logger.debug("  %s / %s events are in region %s", np.sum(region_filter), n_events, region)
+            cutflow.counts["region", region] += int(np.sum(region_filter))
+            region_filters[region] = region_filter
+
+        combined_filter = np.zeros(n_events, dtype=bool)
+        for region_filter in region_filters.values():
+            combined_filter = np.logical_or(combined_filter, region_filter)
+        for region, region_filter in region_filters.items():
+            region_filters[region] = region_filter[combined_filter]
+
+    cutflow.counts["passed"] += n_events if combined_filter is None else int(np.sum(combined_filter))
+
+    # Apply filter
+    if combined_filter is not None:
+        for obs_name in observable_values:
+            observable_values[obs_name] = observable_values[obs_name][combined_filter]
+
+        if weights is not None:
+            weights = weights[:, combined_filter]
+
+    return observable_values, weights, combined_filter, region_filters
+
+
+def _concatenate_chunks(chunk_results, observables):
+    observable_values = OrderedDict(
+        (name, np.concatenate([values[name] for values, _, _, _ in chunk_results] or [np.zeros(0)]))
+        for name in observables
+    )
+
+    weights = None
+    if chunk_results and chunk_results[0][1] is not None:
+        weights = np.concatenate([weights for _, weights, _, _ in chunk_results], axis=1)
+
+    combined_filter = None
+    if chunk_results and chunk_results[0][2] is not None:
+        combined_filter = np.concatenate([combined_filter for _, _, combined_filter, _ in chunk_results])
+
+    region_filters = None
+    if chunk_results and chunk_results[0][3] is not None:
+        region_filters = OrderedDict(
+            (region, np.concatenate([region_filters[region] for _, _, _, region_filters in chunk_results]))
+            for region in chunk_results[0][3]
+        )
+
+    return observable_values, weights, combined_filter, region_filters
+
+
+class _TreeChunk:
+    """
+    Entries of a Delphes tree held in memory, i.e. a chunk read by TTree.iterate() or the cached branches, accessed with
+    the same tree[branch].array() calls as the full tree
+    """
+
+    def __init__(self, arrays, num_entries):
+        self.arrays = arrays
+        self.num_entries = num_entries
+
+    def __getitem__(self, name):
+        if name not in self.arrays:
+            raise KeyError(name)
+        return _BranchChunk(self.arrays[name])
+
+    def keys(self):
+        return list(self.arrays.keys())
+
+    def slice(self, start, stop):
+        arrays = {name: array[start:stop] for name, array in self.arrays.items()}
+        return _TreeChunk(arrays, stop - start)
+
+
+def _iterate_chunks(tree, branch_names, chunk_size, cutflow):
+    if isinstance(tree, _TreeChunk):
+        for start in range(0, tree.num_entries, chunk_size):
+            stop = min(start + chunk_size, tree.num_entries)
+            logger.debug("  Parsing events %s to %s", start, stop)
+            yield tree.slice(start, stop)
+        return
+
+    iterator = tree.iterate(filter_name=branch_names, step_size=chunk_size, report=True)
+    while True:
+        with cutflow.timed("read", "chunks"):
+            arrays, report = next(iterator, (None, None))
+        if arrays is None:
+            return
+
+        logger.debug("  Parsing events %s to %s", report.tree_entry_start, report.tree_entry_stop)
+        yield _TreeChunk(
+            {name: arrays[name] for name in arrays.fields}, report.tree_entry_stop - report.tree_entry_start
+        )
+
+
+class _BranchChunk:
+    def __init__(self, array):
+        self._array = array
+
+    def array(self, library=None):
+        return self._array
+
+
+class _FilteredTree:
+    """
+    Tree wrapper that only gives the entries selected with filter(), accessed with the same tree[branch].array() calls
+    as the full tree. Every branch is read from the tree only once, also when it is used before and after filtering.
+    """
+
+    def __init__(self, tree, mask=None, arrays=None):
+        self.tree = tree
+        self.mask = mask
+        self.num_entries = None if mask is None else int(np.sum(mask))
+        self._arrays = arrays if arrays is not None else {}
+        self._filtered_arrays = {}
+
+    def __getitem__(self, name):
+        if name not in self._arrays:
+            self._arrays[name] = self.tree[name].array()
+        if self.mask is None:
+            return _BranchChunk(self._arrays[name])
+
+        if name not in self._filtered_arrays:
+            self._filtered_arrays[name] = self._arrays[name][self.mask]
+        return _BranchChunk(self._filtered_arrays[name])
+
+    def keys(self):
+        return self.tree.keys()
+
+    def filter(self, mask):
+        return _FilteredTree(self.tree, mask, self._arrays)
+
+
+def _unfilter(values, mask):
+    """Inverse of values = all_values[mask], with False for the entries that were not selected"""
+
+    all_values = np.zeros(len(mask), dtype=bool)
+    all_values[mask] = values
+    return all_values
+
+
+def _get_branch_names(tree, use_generator_truth, collections, extract_weights):
+    """Branches that the particle and weight parsers need for the given collections, as far as they exist in the tree"""
+
+    collection_branches = _COLLECTION_BRANCHES_TRUTH if use_generator_truth else _COLLECTION_BRANCHES
+
+    branch_names = []
+    for collection in collections:
+        for name, fields in collection_branches[collection].items():
+            branch_names += [f"{name}.{field}" for field in fields]
+    if extract_weights:
+        branch_names.append("Weight.Weight")
+
+    # In Delphes trees the branches are split into subbranches, whose full paths are Collection/Collection.Field. They
+    # are compared by their own names, which filter_name in TTree.iterate() and TTree.arrays() also match, and which
+    # key the arrays these return
+    existing = set(tree.keys(full_paths=False))
+    missing = [branch_name for branch_name in dict.fromkeys(branch_names) if branch_name not in existing]
+    if missing:
+        logger.warning("Branches %s are not in the Delphes tree", ", ".join(missing))
+    return [branch_name for branch_name in dict.fromkeys(branch_names) if branch_name in existing]
+
+
+def _get_required_collections(observables, cuts, intermediates=None):
+    """
+    Finds the particle collections (out of COLLECTIONS) that the observables and cuts refer to, so that only their
+    branches have to be read. String definitions are parsed. Functions state the collections they use in a
+    `collections` attribute, e.g. ("a", "j"), which also covers their `columnar` versions; intermediates that they
+    take as arguments count on their own. If a function does not state its collections, or a string cannot be parsed,
+    all collections are returned.
+    """
+
+    definitions = [observable.val_expression for observable in observables.values()]
+    definitions += [cut.val_expression for cut in cuts]
+    if intermediates is not None:
+        definitions += list(intermediates.values())
+
+    required = set()
+
+    for definition in definitions:
+        if isinstance(definition, str):
+            try:
+                nodes = ast.walk(ast.parse(definition, mode="eval"))
+            except (SyntaxError, ValueError):
+                return COLLECTIONS
+            names = {node.id for node in nodes if isinstance(node, ast.Name)}
+
+        else:
+            names = getattr(definition, "collections", None)
+            if names is None:
+                return COLLECTIONS
+
+        for name in names:
+            if name in COLLECTIONS:
+                required.add(name)
+            required.update(_DERIVED_OBJECTS.get(name, ()))
+
+    return tuple(collection for collection in COLLECTIONS if collection in required)
+
+
+# Prefilter
+
+
+def _get_min_multiplicities(observables, intermediates=None, acceptance=None):
+    """
+    Finds how many particles of each collection (after the acceptance cuts) an event needs at least for all required
+    observables to be finite, e.g. {"a": 2} if "a[1].pt" is required. In string definitions, every index into a
+    collection counts that is always evaluated, i.e. not in the branches of `x if c else y`, `and`, `or`, or in lambdas
+    and comprehensions. Functions can state the minimum they need in a `min_multiplicities` attribute, e.g.
+    {"j": 2}. Intermediates count for the required definitions that use them. Observables with a finite default are
+    skipped, as they never make an event fail.
+    """
+
+    if intermediates is None:
+        intermediates = OrderedDict()
+
+    min_multiplicities = {}
+
+    for observable in observables.values():
+        default = observable.val_default
+        if not observable.is_required or (default is not None and np.isfinite(default)):
+            continue
+
+        for name, n in _get_definition_multiplicities(observable.val_expression, intermediates, set()).items():
+            min_multiplicities[name] = max(min_multiplicities.get(name, 0), n)
+
+    # The event loop applies the electron and muon acceptance to the combined leptons only after sorting them by pT,
+    # so the number of leptons is only known in advance if both acceptances are the same
+    if acceptance is not None and (
+        acceptance["pt_min_e"] != acceptance["pt_min_mu"] or acceptance["eta_max_e"] != acceptance["eta_max_mu"]
+    ):
+        min_multiplicities.pop("l", None)
+
+    return OrderedDict((name, min_multiplicities[name]) for name in COLLECTIONS if name in min_multiplicities)
+
+
+def _get_definition_multiplicities(definition, intermediates, visited):
+    multiplicities = {}
+    used_intermediates = []
+
+    if isinstance(definition, str):
+        try:
+            nodes = _get_unconditional_nodes(ast.parse(definition, mode="eval"))
+        except (SyntaxError, ValueError):
+            return {}
+
+        for node in nodes:
+            if isinstance(node, ast.Name) and node.id in intermediates:
+                used_intermediates.append(node.id)
+            elif (
+                isinstance(node, ast.Subscript)
+                and isinstance(node.value, ast.Name)
+                and node.value.id in COLLECTIONS
+                and node.value.id not in intermediates
+                and node.value.id != "met"
             ):
-                visible_momentum += p
-            all_momentum = visible_momentum + met_all_events[ievent][0]
+                n = _get_index_multiplicity(node.slice)
+                if n is not None:
+                    multiplicities[node.value.id] = max(multiplicities.get(node.value.id, 0), n)
+
+    elif isinstance(definition, Callable):
+        for name, n in getattr(definition, "min_multiplicities", {}).items():
+            if name not in COLLECTIONS:
+                logger.warning("Ignoring minimum multiplicity of unknown collection %s", name)
+                continue
+            multiplicities[name] = max(multiplicities.get(name, 0), n)
+        used_intermediates += [name for name in _get_intermediate_arguments(definition) if name in intermediates]
+
+    for name in used_intermediates:
+        if name in visited:
+            continue
+        visited.add(name)
+
+        for collection, n in _get_definition_multiplicities(intermediates[name], intermediates, visited).items():
+            multiplicities[collection] = max(multiplicities.get(collection, 0), n)
+
+    return multiplicities
+
+
+def _get_unconditional_nodes(node):
+    """Nodes of an expression that are evaluated whenever the expression is evaluated"""
 
-            objects = math_commands()
-            objects.update(
+    if isinstance(node, ast.BoolOp):
+        children = node.values[:1]
+    elif isinstance(node, ast.IfExp):
+        children = [node.test]
+    elif isinstance(node, ast.Compare):
+        children = [node.left, node.comparators[0]]
+    elif isinstance(node, (ast.Lambda, ast.ListComp, ast.SetComp, ast.DictComp, ast.GeneratorExp)):
+        children = []
+    else:
+        children = ast.iter_child_nodes(node)
+
+    nodes = [node]
+    for child in children:
+        nodes += _get_unconditional_nodes(child)
+    return nodes
+
+
+def _get_index_multiplicity(index):
+    """Number of particles that a[index] needs, or None if index is not a constant integer"""
+
+    if isinstance(index, getattr(ast, "Index", ())):  # Python < 3.9
+        index = index.value
+
+    sign = 1
+    if isinstance(index, ast.UnaryOp) and isinstance(index.op, ast.USub):
+        sign, index = -1, index.operand
+
+    if not isinstance(index, ast.Constant) or not isinstance(index.value, int) or isinstance(index.value, bool):
+        return None
+
+    value = sign * index.value
+    return value + 1 if value >= 0 else -value
+
+
+def _get_prefilter(tree, n_events, use_generator_truth, acceptance, min_multiplicities):
+    """Mask of the events with at least the given numbers of particles after the acceptance cuts"""
+
+    collections = _get_columnar_collections(tree, use_generator_truth, acceptance)
+
+    prefilter = np.ones(n_events, dtype=bool)
+    for name, n in min_multiplicities.items():
+        prefilter &= collections[name].count() >= n
+
+    return prefilter
+
+
+# Cutflow report
+
+
+class _CutflowReport:
+    """
+    Timings and pass counts collected while a Delphes file is parsed. Times are exclusive: time spent in a nested
+    section, e.g. decoding a branch while the first observable that needs it is evaluated, only counts there.
+    """
+
+    def __init__(self):
+        self.times = defaultdict(lambda: defaultdict(float))
+        self.counts = Counter()
+        self._nested = []
+
+    @contextmanager
+    def timed(self, section, name):
+        start = time.perf_counter()
+        self._nested.append(0.0)
+        try:
+            yield
+        finally:
+            elapsed = time.perf_counter() - start
+            self.add_time(section, name, elapsed - self._nested.pop(), elapsed)
+
+    def add_time(self, section, name, seconds, elapsed=None):
+        self.times[section][name] += seconds
+        if self._nested:
+            self._nested[-1] += seconds if elapsed is None else elapsed
+
+    def to_dict(self, delphes_sample_file, engine, observables, cuts, region_cut_indices=None):
+        """
+        Report as a dict of plain Python types. Cut pass counts are given for each cut alone and for it together with
+        all required observables and previous cuts (for the cuts of a selection region, the common cuts and the
+        previous cuts of the region). With the fused and adaptive engines, observables and cuts that were
+        skipped for a rejected event count as not finite and failed, so only the numbers of passing events match the
+        other engines there; with the adaptive engine, which ones are skipped also depends on the order it learned.
+        The same holds for all engines for the events that are dropped by the multiplicity prefilter before any
+        observables are evaluated (n_events - n_passed_prefilter).
+        """
+
+        cut_regions = {}
+        for region, indices in (region_cut_indices or {}).items():
+            cut_regions.update((i_cut, region) for i_cut in indices)
+
+        report = {
+            "delphes_file": str(delphes_sample_file),
+            "engine": engine,
+            "n_events": self.counts["events"],
+            "n_passed_prefilter": self.counts["prefilter"],
+            "n_passed_required": self.counts["required"],
+            "n_passed": self.counts["passed"],
+            "time_read": dict(self.times["read"]),
+            "time_decode": dict(self.times["decode"]),
+            "time_particles": dict(self.times["particles"]),
+            "observables": [
                 {
-                    "e": electrons_all_events[ievent],
-                    "j": jets_all_events[ievent],
-                    "a": photons_all_events[ievent],
-                    "mu": muons_all_events[ievent],
-                    "l": leptons_all_events[ievent],
-                    "met": met_all_events[ievent][0],
-                    "visible": visible_momentum,
-                    "all": all_momentum,
-                    "boost_to_com": lambda momentum: momentum.boost(all_momentum.to_Vector3D()),
+                    "name": name,
+                    "is_required": bool(observable.is_required),
+                    "time": self.times["observables"][name],
+                    "n_finite": self.counts["finite", name],
                 }
-            )
+                for name, observable in observables.items()
+            ],
+            "cuts": [
+                {
+                    "expression": str(cut.val_expression),
+                    "is_required": bool(cut.is_required),
+                    "time": self.times["cuts"][i_cut],
+                    "n_passed": self.counts["cut", i_cut],
+                    "n_passed_cumulative": self.counts["cumulative", i_cut],
+                    "region": cut_regions.get(i_cut),
+                }
+                for i_cut, cut in enumerate(cuts)
+            ],
+        }
+        if region_cut_indices is not None:
+            report["n_passed_regions"] = {region: self.counts["region", region] for region in region_cut_indices}
 
-            return objects
+        return report
 
-        # Observations
-        observable_values = OrderedDict()
 
-        for name, observable in observables.items():
-            values_this_observable = []
-            definition = observable.val_expression
-            default = observable.val_default
+class _TimedTree:
+    """Tree wrapper that adds the time spent in tree[branch].array() to the report, per Delphes collection"""
 
-            # Loop over events
-            for event in range(n_events):
-                variables = get_objects(event)
+    def __init__(self, tree, cutflow):
+        self.tree = tree
+        self.cutflow = cutflow
 
-                try:
-                    if isinstance(definition, str):
-                        value = eval(definition, variables)
-                    elif isinstance(definition, Callable):
-                        value = definition(
-                            leptons_all_events[event],
-                            photons_all_events[event],
-                            jets_all_events[event],
-                            met_all_events[event][0],
-                        )
-                    else:
-                        raise TypeError("Not a valid observable")
-                except (IndexError, NameError, RuntimeError, SyntaxError, TypeError, ZeroDivisionError):
-                    value = default if default is not None else np.nan
-                finally:
-                    values_this_observable.append(value)
+    def __getitem__(self, name):
+        return _TimedBranch(self.tree[name], name.split(".")[0], self.cutflow)
 
-            values_this_observable = np.array(values_this_observable, dtype=np.float64)
-            observable_values[name] = values_this_observable
+    def __getattr__(self, name):
+        return getattr(self.tree, name)
 
-            logger.debug("  First 10 values for observable %s:\n%s", name, values_this_observable[:20])
 
-        # Cuts
-        cut_values = []
+class _TimedBranch:
+    def __init__(self, branch, collection, cutflow):
+        self.branch = branch
+        self.collection = collection
+        self.cutflow = cutflow
 
-        for cut in cuts:
-            values_this_cut = []
+    def array(self, *args, **kwargs):
+        with self.cutflow.timed("decode", self.collection):
+            return self.branch.array(*args, **kwargs)
 
-            # Loop over events
-            for event in range(n_events):
-                variables = get_objects(event)
 
-                for obs_name in observable_values:
-                    variables[obs_name] = observable_values[obs_name][event]
+# Column cache
 
-                try:
-                    value = eval(cut.val_expression, variables)
-                except (SyntaxError, NameError, TypeError, ZeroDivisionError, IndexError):
-                    value = cut.is_required
-                finally:
-                    values_this_cut.append(value)
 
-            values_this_cut = np.array(values_this_cut, dtype=bool)
-            cut_values.append(values_this_cut)
+def get_cache_filename(delphes_sample_file):
+    """Path of the file with the cached branches of a Delphes ROOT file"""
+    return os.path.splitext(delphes_sample_file)[0] + "_columns.npz"
 
-        # Check for existence of required observables
-        combined_filter = None
 
-        for name, observable in observables.items():
-            if not observable.is_required:
-                continue
+def _load_cached_tree(delphes_sample_file, tree, branch_names):
+    """Returns the given branches from the cache, reading those that are not cached yet from the tree"""
+
+    cache_file = get_cache_filename(delphes_sample_file)
+    stat = os.stat(delphes_sample_file)
+
+    columns = {}
+    key = None
+    cached_key = None
+
+    if os.path.exists(cache_file):
+        with np.load(cache_file) as data:
+            stored = {name: data[name] for name in data.files}
+        cached_key = (int(stored["__size__"]), int(stored["__mtime__"]), str(stored["__hash__"]))
+        key = _get_cache_key(delphes_sample_file, stat, cached_key)
+
+        if key is None:
+            logger.info("  Cached branches in %s are outdated", cache_file)
+        else:
+            columns = _decode_columns(stored)
+
+    missing = [name for name in branch_names if name not in columns]
+    if missing:
+        logger.debug("  Decoding branches %s", ", ".join(missing))
+        arrays = tree.arrays(filter_name=missing)
+        for name in arrays.fields:
+            columns[name] = arrays[name]
 
-            this_filter = np.isfinite(observable_values[name])
-            n_pass = np.sum(this_filter)
-            n_fail = np.sum(np.invert(this_filter))
+        if key is None:
+            key = (stat.st_size, stat.st_mtime_ns, _hash_file(delphes_sample_file))
 
-            logger.debug("  %s / %s events pass required observable %s", n_pass, n_pass + n_fail, name)
+    if missing or key != cached_key:
+        logger.debug("  Caching branches in %s", cache_file)
+        _save_columns(cache_file, columns, key)
+    else:
+        logger.debug("  Reading cached branches from %s", cache_file)
+
+    return _TreeChunk({name: columns[name] for name in branch_names}, tree.num_entries)
+
+
+def _get_cache_key(filename, stat, cached_key):
+    """Returns the (size, mtime, hash) key of the file if the cache is still valid, else None"""
+
+    size, mtime, digest = cached_key
+    if size != stat.st_size:
+        return None
+    if mtime == stat.st_mtime_ns:
+        return cached_key
+
+    # Same size, new modification time: only the content hash can tell
+    if _hash_file(filename) != digest:
+        return None
+    return stat.st_size, stat.st_mtime_ns, digest
 
-            if combined_filter is None:
-                combined_filter = this_filter
+
+def _hash_file(filename, block_size=2**24):
+    sha256 = hashlib.sha256()
+    with open(filename, "rb") as file:
+        for block in iter(lambda: file.read(block_size), b""):
+            sha256.update(block)
+    return sha256.hexdigest()
+
+
+def _save_columns(cache_file, columns, key):
+    data = {"__size__": np.int64(key[0]), "__mtime__": np.int64(key[1]), "__hash__": np.str_(key[2])}
+
+    for name, array in columns.items():
+        if array.ndim == 1:
+            data[f"{name}/values"] = ak.to_numpy(array)
+        else:
+            data[f"{name}/content"] = ak.to_numpy(ak.flatten(array))
+            data[f"{name}/counts"] = ak.to_numpy(ak.num(array))
+
+    # Write to a temporary file first, so that an interrupted job never leaves a broken cache behind
+    tmp_file = cache_file[: -len(".npz")] + ".tmp.npz"
+    np.savez_compressed(tmp_file, **data)
+    os.replace(tmp_file, cache_file)
+
+
+def _decode_columns(stored):
+    # Keys are <branch>/<kind> (see _save_columns). kind never contains a slash, so splitting at the last one also
+    # works for branch names with slashes, such as the full path Jet/Jet.PT
+    columns = {}
+    for key in stored:
+        name, _, kind = key.rpartition("/")
+        if kind == "values":
+            columns[name] = ak.Array(stored[key])
+        elif kind == "content":
+            columns[name] = ak.unflatten(stored[key], stored[f"{name}/counts"])
+    return columns
+
+
+class _EventLoop:
+    """
+    Per-event evaluation of observables and cuts on MadMinerParticle instances, which are built from the particle
+    stores of the given collections when an observable or cut accesses them. The stores are filled when the first
+    observable or cut is evaluated.
+    """
+
+    def __init__(
+        self, tree, use_generator_truth, acceptance, collections=COLLECTIONS, intermediates=None, cutflow=None
+    ):
+        self.tree = tree
+        self.use_generator_truth = use_generator_truth
+        self.acceptance = acceptance
+        self.collections = collections
+        self.intermediates = intermediates if intermediates is not None else OrderedDict()
+        self.cutflow = cutflow if cutflow is not None else _CutflowReport()
+        self._particles = None
+        self._event_intermediates = {}
+
+    @property
+    def particles(self):
+        if self._particles is None:
+            self._particles = _get_all_particles(
+                self.tree, self.use_generator_truth, self.acceptance, self.collections, self.cutflow
+            )
+        return self._particles
+
+    def get_objects(self, ievent):
+        particles = self.particles
+
+        objects = math_commands()
+        for name in ("e", "j", "a", "mu", "l"):
+            if name in particles:
+                objects[name] = particles[name][ievent]
+        if "met" in particles:
+            objects["met"] = particles["met"][ievent][0]
+
+        if all(name in particles for name in _DERIVED_OBJECTS["visible"]):
+            visible_momentum = MadMinerParticle.from_xyzt(0.0, 0.0, 0.0, 0.0)
+            for p in particles["e"][ievent] + particles["j"][ievent] + particles["mu"][ievent] + particles["a"][ievent]:
+                visible_momentum += p
+            objects["visible"] = visible_momentum
+
+            if "met" in particles:
+                all_momentum = visible_momentum + particles["met"][ievent][0]
+                objects["all"] = all_momentum
+                objects["boost_to_com"] = lambda momentum: momentum.boost(all_momentum.to_Vector3D())
+
+        return objects
+
+    def get_function_arguments(self, ievent):
+        particles = self.particles
+        return [
+            particles["l"][ievent] if "l" in particles else [],
+            particles["a"][ievent] if "a" in particles else [],
+            particles["j"][ievent] if "j" in particles else [],
+            particles["met"][ievent][0] if "met" in particles else None,
+        ]
+
+    def get_intermediates(self, ievent):
+        if ievent not in self._event_intermediates:
+            self._event_intermediates[ievent] = _EventIntermediates(self, ievent)
+        return self._event_intermediates[ievent]
+
+    def evaluate_expression(self, expression, variables, ievent):
+        if self.intermediates:
+            return eval(_compile_expression(expression), variables, self.get_intermediates(ievent))
+        return eval(_compile_expression(expression), variables)
+
+    def evaluate_function(self, function, ievent):
+        arguments = self.get_function_arguments(ievent)
+        names = _get_intermediate_arguments(function)
+        if names:
+            intermediates = self.get_intermediates(ievent)
+            return function(*arguments, **{name: intermediates.get_argument(name) for name in names})
+        return function(*arguments)
+
+    def evaluate_observables(self, observables, n_events):
+        """
+        Evaluates all observables event by event, with the same values as evaluate_observable() for each of them in
+        turn. The intermediates of an event are shared by all observables and released as soon as the event is done,
+        so that memory use does not grow with the number of events.
+        """
+
+        observable_values = OrderedDict((name, np.full(n_events, np.nan)) for name in observables)
+        observable_times = defaultdict(float)
+
+        # Loop over events
+        for event in range(n_events):
+            objects = self.get_objects(event)
+
+            for name, observable in observables.items():
+                start = time.perf_counter()
+                observable_values[name][event] = self._evaluate_observable_in_event(observable, objects, event)
+                observable_times[name] += time.perf_counter() - start
+
+            self._event_intermediates.pop(event, None)
+
+        for name, observable_time in observable_times.items():
+            self.cutflow.add_time("observables", name, observable_time)
+
+        return observable_values
+
+    def evaluate_observable(self, observable, n_events):
+        values_this_observable = []
+
+        # Loop over events
+        for event in range(n_events):
+            variables = self.get_objects(event)
+            values_this_observable.append(self._evaluate_observable_in_event(observable, variables, event))
+            self._event_intermediates.pop(event, None)
+
+        return np.array(values_this_observable, dtype=np.float64)
+
+    def evaluate_cut(self, cut, observable_values, n_events):
+        values_this_cut = []
+
+        # Loop over events
+        for event in range(n_events):
+            variables = self.get_objects(event)
+
+            for obs_name in observable_values:
+                variables[obs_name] = observable_values[obs_name][event]
+
+            values_this_cut.append(self._evaluate_cut_in_event(cut, variables, event))
+            self._event_intermediates.pop(event, None)
+
+        return np.array(values_this_cut, dtype=bool)
+
+    def evaluate_fused(self, observables, cuts, n_events, ordering=None, region_cuts=()):
+        """
+        Evaluates observables and cuts in a single pass over the events. Each cut is scheduled right after the last
+        observable it depends on, and the remaining work for an event is skipped once it is rejected. The cuts in
+        region_cuts only apply to some selection regions, so they are evaluated but do not reject events.
+
+        With an ordering (engine="adaptive"), every observable and cut is evaluated for the events the ordering still
+        needs for its calibration, and the values that the default order would have skipped are reset afterwards.
+        Once the ordering is calibrated, the remaining events are evaluated in its order.
+        """
+
+        default_schedule = _get_fused_schedule(observables, cuts)
+        observable_values = OrderedDict((name, np.full(n_events, np.nan)) for name in observables)
+        cut_values = [np.zeros(n_events, dtype=bool) for _ in cuts]
+        step_times = defaultdict(float)
+
+        # Loop over events
+        for event in range(n_events):
+            objects = self.get_objects(event)
+            variables = dict(objects)
+
+            calibrating = ordering is not None and ordering.schedule is None
+            schedule = default_schedule if ordering is None or calibrating else ordering.schedule
+            calibration_times, calibration_passed = [], []
+
+            for name, i_cut in schedule:
+                start = time.perf_counter()
+
+                if i_cut is None:
+                    observable = observables[name]
+                    values = observable_values[name]
+                    values[event] = self._evaluate_observable_in_event(observable, objects, event)
+                    variables[name] = values[event]
+                    passed = not observable.is_required or np.isfinite(values[event])
+                else:
+                    cut_values[i_cut][event] = self._evaluate_cut_in_event(cuts[i_cut], variables, event)
+                    passed = cut_values[i_cut][event] or i_cut in region_cuts
+
+                elapsed = time.perf_counter() - start
+                step_times[name, i_cut] += elapsed
+                if calibrating:
+                    calibration_times.append(elapsed)
+                    calibration_passed.append(passed)
+                elif not passed:
+                    break
+
+            if calibrating:
+                ordering.add_event(calibration_times, calibration_passed)
+
+                n_evaluated = calibration_passed.index(False) + 1 if False in calibration_passed else len(schedule)
+                for name, i_cut in schedule[n_evaluated:]:
+                    if i_cut is None:
+                        observable_values[name][event] = np.nan
+                    else:
+                        cut_values[i_cut][event] = False
+
+            self._event_intermediates.pop(event, None)
+
+        for (name, i_cut), step_time in step_times.items():
+            if i_cut is None:
+                self.cutflow.add_time("observables", name, step_time)
             else:
-                combined_filter = np.logical_and(combined_filter, this_filter)
+                self.cutflow.add_time("cuts", i_cut, step_time)
 
-        # Check cuts
-        for cut, values_this_cut in zip(cuts, cut_values):
-            n_pass = np.sum(values_this_cut)
-            n_fail = np.sum(np.invert(values_this_cut))
+        return observable_values, cut_values
 
-            logger.debug("  %s / %s events pass cut %s", n_pass, n_pass + n_fail, cut)
+    def _evaluate_observable_in_event(self, observable, variables, event):
+        definition = observable.val_expression
+        default = observable.val_default
 
-            if combined_filter is None:
-                combined_filter = values_this_cut
+        try:
+            if isinstance(definition, str):
+                value = self.evaluate_expression(definition, variables, event)
+            elif isinstance(definition, Callable):
+                value = self.evaluate_function(definition, event)
             else:
-                combined_filter = np.logical_and(combined_filter, values_this_cut)
+                raise TypeError("Not a valid observable")
+        except (IndexError, NameError, RuntimeError, SyntaxError, TypeError, ZeroDivisionError):
+            value = default if default is not None else np.nan
 
-        # Apply filter
-        if combined_filter is not None:
-            n_pass = np.sum(combined_filter)
-            n_fail = np.sum(np.invert(combined_filter))
+        return value
 
-            if n_pass == 0:
-                logger.warning("  No observations remaining!")
+    def _evaluate_cut_in_event(self, cut, variables, event):
+        try:
+            value = self.evaluate_expression(cut.val_expression, variables, event)
+        except (SyntaxError, NameError, TypeError, ZeroDivisionError, IndexError):
+            value = cut.is_required
 
-                return None, None, combined_filter
+        return value
 
-            logger.info("  %s / %s events pass everything", n_pass, n_pass + n_fail)
 
-            for obs_name in observable_values:
-                observable_values[obs_name] = observable_values[obs_name][combined_filter]
+class _Intermediates(Mapping):
+    """
+    Lazily computed intermediates, usable as local namespace in eval(). Every intermediate is computed at most once;
+    an exception raised while computing it is raised again whenever it is used. Subclasses (Mapping is an abstract
+    base class) implement _compute().
+    """
 
-            if weights is not None:
-                weights = weights[:, combined_filter]
+    def __init__(self, definitions):
+        self.definitions = definitions
+        self._values = {}
+        self._errors = {}
+        self._pending = set()
 
-        # Wrap weights
-        if weights is None:
-            weights_dict = None
+    def __getitem__(self, name):
+        if name not in self.definitions:
+            raise KeyError(name)
+
+        if name in self._errors:
+            raise self._errors[name]
+        if name not in self._values:
+            if name in self._pending:
+                raise RuntimeError(f"Intermediate {name} depends on itself")
+
+            self._pending.add(name)
+            try:
+                self._values[name] = self._compute(self.definitions[name])
+            except Exception as e:
+                self._errors[name] = e
+                raise
+            finally:
+                self._pending.discard(name)
+
+        return self._values[name]
+
+    def __iter__(self):
+        return iter(self.definitions)
+
+    def __len__(self):
+        return len(self.definitions)
+
+    def get_argument(self, name):
+        if name not in self.definitions:
+            raise NameError(f"Unknown intermediate {name}")
+        return self[name]
+
+    @abstractmethod
+    def _compute(self, definition):
+        """Value of one definition, evaluated on the particles of the event (or of all events)"""
+
+
+class _EventIntermediates(_Intermediates):
+    """Intermediates of one event, computed on MadMinerParticle instances"""
+
+    def __init__(self, event_loop, ievent):
+        super().__init__(event_loop.intermediates)
+        self.event_loop = event_loop
+        self.ievent = ievent
+
+    def _compute(self, definition):
+        if isinstance(definition, str):
+            objects = self.event_loop.get_objects(self.ievent)
+            return self.event_loop.evaluate_expression(definition, objects, self.ievent)
+        if isinstance(definition, Callable):
+            return self.event_loop.evaluate_function(definition, self.ievent)
+        raise TypeError("Not a valid intermediate")
+
+
+@lru_cache(maxsize=None)
+def _compile_expression(expression):
+    """Compiles the string definition of an observable, cut, or intermediate only once"""
+    return compile(expression, "<string>", "eval")
+
+
+def _get_intermediate_arguments(function):
+    """Names of the arguments of an observable function after (leptons, photons, jets, met)"""
+
+    code = getattr(function, "__code__", None)
+    if code is None:
+        return ()
+    return code.co_varnames[len(_FUNCTION_ARGUMENTS) : code.co_argcount]
+
+
+def _get_fused_schedule(observables, cuts):
+    """
+    Returns the order of evaluation for the fused engine as a list of (observable name, None) and (None, cut index)
+    steps. Every cut comes right after the last observable its expression refers to.
+    """
+
+    observable_names = list(observables.keys())
+    position = {name: i for i, name in enumerate(observable_names)}
+
+    cuts_after = [[] for _ in range(len(observable_names) + 1)]
+    for i_cut, cut in enumerate(cuts):
+        names = _get_cut_observables(cut, observable_names)
+        cuts_after[max((position[name] + 1 for name in names), default=0)].append(i_cut)
+
+    schedule = [(None, i_cut) for i_cut in cuts_after[0]]
+    for i, name in enumerate(observable_names):
+        schedule.append((name, None))
+        schedule += [(None, i_cut) for i_cut in cuts_after[i + 1]]
+
+    return schedule
+
+
+def _get_cut_observables(cut, observable_names):
+    """Observables a cut expression refers to (all of them if the expression cannot be parsed)"""
+    try:
+        nodes = ast.walk(ast.parse(cut.val_expression, mode="eval"))
+        names = {node.id for node in nodes if isinstance(node, ast.Name)}
+    except (SyntaxError, TypeError, ValueError):
+        names = set(observable_names)
+    return [name for name in observable_names if name in names]
+
+
+class _CutOrdering:
+    """
+    Order in which engine="adaptive" evaluates the observables and cuts of a file. For the first n_calibration events,
+    every step of the default fused schedule is evaluated, and the time it takes and whether the event passes it are
+    recorded. The steps are then ordered greedily: the next one is the cut (together with the observables it needs
+    that are not evaluated yet) or required observable that rejects the most of the calibration events still left per
+    second spent on it. Steps that reject none of them follow in the default order. An event is kept only if it passes
+    every step, so the order does not change which events pass or their observables.
+    """
+
+    def __init__(self, observables, cuts, n_calibration):
+        self.cuts = cuts
+        self.default_schedule = _get_fused_schedule(observables, cuts)
+        self.n_calibration = n_calibration
+        self.schedule = None
+
+        # Steps that have to be evaluated for each step, in the default order
+        position = {step: i for i, step in enumerate(self.default_schedule)}
+        self._dependencies = [
+            [i]
+            if i_cut is None
+            else [position[name, None] for name in _get_cut_observables(cuts[i_cut], list(observables))] + [i]
+            for i, (_, i_cut) in enumerate(self.default_schedule)
+        ]
+
+        self._times = []
+        self._passed = []
+
+    def add_event(self, step_times, passed):
+        self._times.append(step_times)
+        self._passed.append(passed)
+
+        if len(self._passed) >= self.n_calibration:
+            self.schedule = self._get_schedule()
+            logger.debug("  Evaluating observables and cuts in the order %s", ", ".join(self.describe()))
+
+    def describe(self):
+        """Names of the observables and expressions of the cuts in the order in which they are evaluated"""
+        schedule = self.default_schedule if self.schedule is None else self.schedule
+        return [name if i_cut is None else str(self.cuts[i_cut].val_expression) for name, i_cut in schedule]
+
+    def _get_schedule(self):
+        times = np.mean(self._times, axis=0)
+        passed = np.array(self._passed, dtype=bool)
+        remaining = np.ones(len(passed), dtype=bool)
+        scheduled = np.zeros(len(self.default_schedule), dtype=bool)
+        order = []
+
+        while True:
+            best_steps, best_rate = None, 0.0
+            for i, dependencies in enumerate(self._dependencies):
+                if scheduled[i]:
+                    continue
+                steps = [step for step in dependencies if not scheduled[step]]
+                n_rejected = np.sum(remaining & ~np.all(passed[:, steps], axis=1))
+                rate = n_rejected / max(np.sum(times[steps]), 1.0e-9)
+                if rate > best_rate:
+                    best_steps, best_rate = steps, rate
+
+            if best_steps is None:
+                break
+            order += best_steps
+            scheduled[best_steps] = True
+            remaining &= np.all(passed[:, best_steps], axis=1)
+
+        order += [i for i in range(len(self.default_schedule)) if not scheduled[i]]
+        return [self.default_schedule[i] for i in order]
+
+
+# Particle store
+
+
+class _ParticleStore(Sequence):
+    """
+    One collection of particles of all events, kept as flat arrays (pt, phi, eta, mass or energy, PDG IDs, tags) and
+    the offsets of the events into them instead of one MadMinerParticle per particle. store[ievent] is a lightweight
+    view of the particles of that event that supports len(), indexing, slicing, iteration, and concatenation with +,
+    like the lists of particles that observables and cuts were written for. MadMinerParticle instances are only built
+    for the particles that are accessed, and the ones of the last event accessed are kept for the next access.
+    """
+
+    def __init__(self, momenta, counts, pdgids, tags=None, energy=False):
+        # momenta are (pt, phi, eta, mass), or (pt, phi, eta, E) with energy=True, and like pdgids either flat arrays
+        # or a single value for all particles. tags are the (tau_tag, b_tag) arrays of jets. The momenta are kept in
+        # double precision: with the float32 of the Delphes branches, the masses of nearly collinear pairs lose most
+        # of their digits in E^2 - p^2 (and the columnar engine computes in double precision as well)
+        self.momenta = tuple(
+            float(values) if np.isscalar(values) else np.asarray(values, dtype=np.float64) for values in momenta
+        )
+        self.pdgids = pdgids if np.isscalar(pdgids) else np.asarray(pdgids)
+        self.tags = None if tags is None else tuple(np.asarray(values, dtype=bool) for values in tags)
+        self.energy = energy
+
+        self.offsets = np.zeros(len(counts) + 1, dtype=np.int64)
+        np.cumsum(counts, out=self.offsets[1:])
+
+        self._momenta_arrays = [(values, isinstance(values, np.ndarray)) for values in self.momenta]
+        self._pdgid_array = isinstance(self.pdgids, np.ndarray)
+        self._ievent = None
+        self._event_particles = None
+
+    @classmethod
+    def from_jagged(cls, momenta, pdgids, tags=None, energy=False):
+        """Store from jagged awkward arrays with the particles of every event; single values are used as they are"""
+
+        def flatten(values):
+            if values is None or np.isscalar(values):
+                return values
+            return ak.to_numpy(ak.flatten(values, axis=1))
+
+        counts = ak.to_numpy(ak.num(momenta[0], axis=1))
+        return cls(
+            [flatten(values) for values in momenta],
+            counts,
+            flatten(pdgids),
+            None if tags is None else [flatten(values) for values in tags],
+            energy,
+        )
+
+    def __len__(self):
+        return len(self.offsets) - 1
+
+    def __getitem__(self, ievent):
+        ievent = operator.index(ievent)
+        if ievent < 0:
+            ievent += len(self)
+        if not 0 <= ievent < len(self):
+            raise IndexError("event index out of range")
+        return _EventParticles(self, ievent, int(self.offsets[ievent + 1] - self.offsets[ievent]))
+
+    def get_particle(self, ievent, i):
+        if ievent != self._ievent:
+            self._ievent = ievent
+            self._event_particles = [None] * int(self.offsets[ievent + 1] - self.offsets[ievent])
+
+        particle = self._event_particles[i]
+        if particle is None:
+            particle = self._event_particles[i] = self._build_particle(int(self.offsets[ievent]) + i)
+        return particle
+
+    def _build_particle(self, index):
+        pt, phi, eta, mass_or_e = (values[index] if is_array else values for values, is_array in self._momenta_arrays)
+        if self.energy:
+            particle = MadMinerParticle.from_rhophietat(pt, phi, eta, mass_or_e)
         else:
-            weights_dict = OrderedDict()
-            for weight_label, this_weights in zip(weight_labels, weights):
-                weights_dict[weight_label] = this_weights
+            particle = MadMinerParticle.from_rhophietatau(pt, phi, eta, mass_or_e)
 
-        # Delete Delphes file
-        if delete_delphes_sample_file:
-            logger.debug("  Deleting %s", delphes_sample_file)
-            os.remove(delphes_sample_file)
+        # Same as particle.set_pdgid(), without looking up the particle every time
+        particle.pdgid = int(self.pdgids[index] if self._pdgid_array else self.pdgids)
+        particle.charge, particle.tau_tag, particle.b_tag, particle.t_tag = _get_pdgid_properties(particle.pdgid)
 
-        return observable_values, weights_dict, combined_filter
-    
-    finally:
-        # Close ROOT file
-        root_file.close()
+        if self.tags is not None:
+            particle.set_tags(self.tags[0][index], self.tags[1][index], False)
 
+        return particle
 
-def _get_n_events(tree):
-    es = tree["Event"].array()
-    n_events = len(es)
-    return n_events
 
+class _EventParticles(Sequence):
+    """Particles of one event in a _ParticleStore, built when they are accessed"""
 
-def _get_particles_truth(tree, pt_min, eta_max, included_pdgids=None):
-    es = tree["Particle.E"].array()
-    pts = tree["Particle.PT"].array()
-    etas = tree["Particle.Eta"].array()
-    phis = tree["Particle.Phi"].array()
-    charges = tree["Particle.Charge"].array()
-    pdgids = tree["Particle.PID"].array()
+    __slots__ = ("store", "ievent", "n_particles")
 
-    all_particles = []
+    def __init__(self, store, ievent, n_particles):
+        self.store = store
+        self.ievent = ievent
+        self.n_particles = n_particles
 
-    for ievent in range(len(pts)):
-        event_particles = []
+    def __len__(self):
+        return self.n_particles
 
-        for e, pt, eta, phi, pdgid in zip(es[ievent], pts[ievent], etas[ievent], phis[ievent], pdgids[ievent]):
-            if pt_min is not None and pt < pt_min:
-                continue
-            if eta_max is not None and abs(eta) > eta_max:
-                continue
-            if (included_pdgids is not None) and (pdgid not in included_pdgids):
-                continue
+    def __getitem__(self, i):
+        if isinstance(i, slice):
+            return [self.store.get_particle(self.ievent, j) for j in range(*i.indices(self.n_particles))]
+        i = operator.index(i)
+        if i < 0:
+            i += self.n_particles
+        if not 0 <= i < self.n_particles:
+            raise IndexError("list index out of range")
+        return self.store.get_particle(self.ievent, i)
 
-            particle = MadMinerParticle.from_rhophietat(pt, phi, eta, e)
-            particle.set_pdgid(pdgid)
-            event_particles.append(particle)
+    def __iter__(self):
+        for i in range(self.n_particles):
+            yield self.store.get_particle(self.ievent, i)
 
-        all_particles.append(event_particles)
+    def __add__(self, other):
+        return list(self) + list(other)
 
-    return all_particles
+    def __radd__(self, other):
+        return list(other) + list(self)
 
+    def __eq__(self, other):
+        if isinstance(other, (list, tuple, _EventParticles)):
+            return list(self) == list(other)
+        return NotImplemented
 
-def _get_particles_charged(tree, name, mass, pdgid_positive_charge, pt_min, eta_max):
-    pts = tree[f"{name}.PT"].array()
-    etas = tree[f"{name}.Eta"].array()
-    phis = tree[f"{name}.Phi"].array()
-    charges = tree[f"{name}.Charge"].array()
+    def __repr__(self):
+        return repr(list(self))
 
-    all_particles = []
 
-    for ievent in range(len(pts)):
-        event_particles = []
+@lru_cache(maxsize=None)
+def _get_pdgid_properties(pdgid):
+    """Charge and tags that MadMinerParticle.set_pdgid() derives from a PDG ID"""
+    particle = MadMinerParticle.from_xyzt(0.0, 0.0, 0.0, 0.0)
+    particle.set_pdgid(pdgid)
+    return particle.charge, particle.tau_tag, particle.b_tag, particle.t_tag
 
-        for pt, eta, phi, charge in zip(pts[ievent], etas[ievent], phis[ievent], charges[ievent]):
-            if pt_min is not None and pt < pt_min:
-                continue
-            if eta_max is not None and abs(eta) > eta_max:
-                continue
 
-            pdgid = pdgid_positive_charge if charge >= 0.0 else -pdgid_positive_charge
+def _get_all_particles(tree, use_generator_truth, acceptance, collections=COLLECTIONS, cutflow=None):
+    if use_generator_truth:
+        builders = {
+            "e": lambda: _get_particles_truth(tree, acceptance["pt_min_a"], acceptance["eta_max_a"], [11, -11]),
+            "mu": lambda: _get_particles_truth(tree, acceptance["pt_min_a"], acceptance["eta_max_a"], [13, -13]),
+            "l": lambda: _get_particles_truth_leptons(
+                tree, acceptance["pt_min_e"], acceptance["eta_max_e"], acceptance["pt_min_mu"], acceptance["eta_max_mu"]
+            ),
+            "a": lambda: _get_particles_truth(tree, acceptance["pt_min_a"], acceptance["eta_max_a"], [22]),
+            "j": lambda: _get_particles_truth_jets(tree, acceptance["pt_min_j"], acceptance["eta_max_j"]),
+            "met": lambda: _get_particles_truth_met(tree),
+        }
 
-            particle = MadMinerParticle.from_rhophietatau(pt, phi, eta, mass)
-            particle.set_pdgid(pdgid)
-            event_particles.append(particle)
+    else:
+        builders = {
+            "e": lambda: _get_particles_charged(
+                tree, "Electron", 0.000511, -11, acceptance["pt_min_e"], acceptance["eta_max_e"]
+            ),
+            "mu": lambda: _get_particles_charged(
+                tree, "Muon", 0.105, -13, acceptance["pt_min_mu"], acceptance["eta_max_mu"]
+            ),
+            "l": lambda: _get_particles_leptons(
+                tree, acceptance["pt_min_e"], acceptance["eta_max_e"], acceptance["pt_min_mu"], acceptance["eta_max_mu"]
+            ),
+            "a": lambda: _get_particles_photons(tree, acceptance["pt_min_a"], acceptance["eta_max_a"]),
+            "j": lambda: _get_particles_jets(tree, acceptance["pt_min_j"], acceptance["eta_max_j"]),
+            "met": lambda: _get_particles_met(tree),
+        }
+
+    if cutflow is None:
+        cutflow = _CutflowReport()
+
+    particles = {}
+    for name in collections:
+        with cutflow.timed("particles", name):
+            particles[name] = builders[name]()
+    return particles
+
+
+def _get_n_events(tree):
+    es = tree["Event"].array()
+    n_events = len(es)
+    return n_events
+
+
+def _get_particles_truth(tree, pt_min, eta_max, included_pdgids=None):
+    fields = {
+        "pt": tree["Particle.PT"].array(),
+        "eta": tree["Particle.Eta"].array(),
+        "pdgid": tree["Particle.PID"].array(),
+    }
+    accepted = _acceptance_mask(fields, pt_min, eta_max)
+    if included_pdgids is not None:
+        accepted = accepted & _pdgid_mask(fields, included_pdgids)
+
+    es = tree["Particle.E"].array()[accepted]
+    pts = fields["pt"][accepted]
+    etas = fields["eta"][accepted]
+    phis = tree["Particle.Phi"].array()[accepted]
+    pdgids = fields["pdgid"][accepted]
 
-        all_particles.append(event_particles)
+    return _ParticleStore.from_jagged((pts, phis, etas, es), pdgids, energy=True)
 
-    return all_particles
+
+def _get_particles_charged(tree, name, mass, pdgid_positive_charge, pt_min, eta_max):
+    pts = tree[f"{name}.PT"].array()
+    etas = tree[f"{name}.Eta"].array()
+    accepted = _acceptance_mask({"pt": pts, "eta": etas}, pt_min, eta_max)
+
+    pts = pts[accepted]
+    etas = etas[accepted]
+    phis = tree[f"{name}.Phi"].array()[accepted]
+    charges = tree[f"{name}.Charge"].array()[accepted]
+    pdgids = ak.where(charges >= 0.0, pdgid_positive_charge, -pdgid_positive_charge)
+
+    return _ParticleStore.from_jagged((pts, phis, etas, mass), pdgids)
 
 
 def _get_particles_leptons(tree, pt_min_e, eta_max_e, pt_min_mu, eta_max_mu):
@@ -329,10 +1603,13 @@ def _get_particles_leptons(tree, pt_min_e, eta_max_e, pt_min_mu, eta_max_mu):
     phi_e = tree["Electron.Phi"].array()
     charge_e = tree["Electron.Charge"].array()
 
-    all_particles = []
+    # Flat lists of the accepted leptons of all events, and the number of them in every event
+    momenta = ([], [], [], [])
+    all_pdgids = []
+    counts = []
 
     for ievent in range(len(pt_mu)):
-        event_particles = []
+        n_before = len(all_pdgids)
 
         # Combined muons and electrons (convert awkward arrays to numpy)
         event_pts = np.concatenate((np.array(pt_mu[ievent]), np.array(pt_e[ievent])))
@@ -350,7 +1627,7 @@ def _get_particles_leptons(tree, pt_min_e, eta_max_e, pt_min_mu, eta_max_mu):
         event_etas = event_etas[order]
         event_phis = event_phis[order]
 
-        # Create particles
+        # Collect particles
         for pt, eta, phi, mass, charge, pdgid_positive_charge in zip(
             event_pts, event_etas, event_phis, event_masses, event_charges, event_pdgid_positive_charges
         ):
@@ -372,188 +1649,723 @@ def _get_particles_leptons(tree, pt_min_e, eta_max_e, pt_min_mu, eta_max_mu):
                 logger.warning("Delphes ROOT file has lepton with PDG ID %s, ignoring it", pdgid)
                 continue
 
-            particle = MadMinerParticle.from_rhophietatau(pt, phi, eta, mass)
-            particle.set_pdgid(pdgid)
-            event_particles.append(particle)
+            for values, value in zip(momenta, (pt, phi, eta, mass)):
+                values.append(value)
+            all_pdgids.append(int(pdgid))
 
-        all_particles.append(event_particles)
+        counts.append(len(all_pdgids) - n_before)
 
-    return all_particles
+    return _ParticleStore(momenta, counts, np.array(all_pdgids, dtype=np.int64))
 
 
 def _get_particles_truth_leptons(tree, pt_min_e, eta_max_e, pt_min_mu, eta_max_mu):
     ids_e = {int(p.pdgid) for p in Particle.findall(pdg_name="e")}
     ids_mu = {int(p.pdgid) for p in Particle.findall(pdg_name="mu")}
-    es = tree["Particle.E"].array()
-    pts = tree["Particle.PT"].array()
-    etas = tree["Particle.Eta"].array()
-    phis = tree["Particle.Phi"].array()
-    charges = tree["Particle.Charge"].array()
-    pdgids = tree["Particle.PID"].array()
-
-    all_particles = []
-
-    for ievent in range(len(pts)):
-        event_particles = []
-
-        for e, pt, eta, phi, pdgid in zip(es[ievent], pts[ievent], etas[ievent], phis[ievent], pdgids[ievent]):
-            if pdgid not in {*ids_e, *ids_mu}:
-                continue
-            if pdgid in ids_e and (pt_min_e is not None and pt < pt_min_e):
-                continue
-            if pdgid in ids_e and (eta_max_e is not None and abs(eta) > eta_max_e):
-                continue
-            if pdgid in ids_mu and (pt_min_mu is not None and pt < pt_min_mu):
-                continue
-            if pdgid in ids_mu and (eta_max_mu is not None and abs(eta) > eta_max_mu):
-                continue
+    fields = {
+        "pt": tree["Particle.PT"].array(),
+        "eta": tree["Particle.Eta"].array(),
+        "pdgid": tree["Particle.PID"].array(),
+    }
+    accepted_e = _acceptance_mask(fields, pt_min_e, eta_max_e) & _pdgid_mask(fields, ids_e)
+    accepted_mu = _acceptance_mask(fields, pt_min_mu, eta_max_mu) & _pdgid_mask(fields, ids_mu)
+    accepted = accepted_e | accepted_mu
 
-            particle = MadMinerParticle.from_rhophietat(pt, phi, eta, e)
-            particle.set_pdgid(pdgid)
-            event_particles.append(particle)
+    es = tree["Particle.E"].array()[accepted]
+    pts = fields["pt"][accepted]
+    etas = fields["eta"][accepted]
+    phis = tree["Particle.Phi"].array()[accepted]
+    pdgids = fields["pdgid"][accepted]
 
-        all_particles.append(event_particles)
-
-    return all_particles
+    return _ParticleStore.from_jagged((pts, phis, etas, es), pdgids, energy=True)
 
 
 def _get_particles_photons(tree, pt_min, eta_max):
     pts = tree["Photon.PT"].array()
     etas = tree["Photon.Eta"].array()
-    phis = tree["Photon.Phi"].array()
-    es = tree["Photon.E"].array()
+    accepted = _acceptance_mask({"pt": pts, "eta": etas}, pt_min, eta_max)
 
-    all_particles = []
+    pts = pts[accepted]
+    etas = etas[accepted]
+    phis = tree["Photon.Phi"].array()[accepted]
+    es = tree["Photon.E"].array()[accepted]
 
-    for ievent in range(len(pts)):
-        event_particles = []
-
-        for pt, eta, phi, e in zip(pts[ievent], etas[ievent], phis[ievent], es[ievent]):
-            if pt_min is not None and pt < pt_min:
-                continue
-            if eta_max is not None and abs(eta) > eta_max:
-                continue
-
-            particle = MadMinerParticle.from_rhophietat(pt, phi, eta, e)
-            particle.set_pdgid(22)
-            event_particles.append(particle)
-
-        all_particles.append(event_particles)
-
-    return all_particles
+    return _ParticleStore.from_jagged((pts, phis, etas, es), 22, energy=True)
 
 
 def _get_particles_jets(tree, pt_min, eta_max):
     pts = tree["Jet.PT"].array()
     etas = tree["Jet.Eta"].array()
-    phis = tree["Jet.Phi"].array()
-    masses = tree["Jet.Mass"].array()
+    accepted = _acceptance_mask({"pt": pts, "eta": etas}, pt_min, eta_max)
+
+    pts = pts[accepted]
+    etas = etas[accepted]
+    phis = tree["Jet.Phi"].array()[accepted]
+    masses = tree["Jet.Mass"].array()[accepted]
     try:
-        tau_tags = tree["Jet.TauTag"].array()
+        tau_tags = tree["Jet.TauTag"].array()[accepted]
     except:
         logger.warning("Did not find tau-tag information in Delphes ROOT file.")
-        tau_tags = [0] * len(pts)
+        tau_tags = _jagged_full(pts, 0, np.int64)
     try:
-        b_tags = tree["Jet.BTag"].array()
+        b_tags = tree["Jet.BTag"].array()[accepted]
     except:
         logger.warning("Did not find b-tag information in Delphes ROOT file.")
-        b_tags = [0] * len(pts)
+        b_tags = _jagged_full(pts, 0, np.int64)
 
-    all_particles = []
-
-    for ievent in range(len(pts)):
-        event_particles = []
-
-        for pt, eta, phi, mass, tau_tag, b_tag in zip(
-            pts[ievent], etas[ievent], phis[ievent], masses[ievent], tau_tags[ievent], b_tags[ievent]
-        ):
-            if pt_min is not None and pt < pt_min:
-                continue
-            if eta_max is not None and abs(eta) > eta_max:
-                continue
-
-            particle = MadMinerParticle.from_rhophietatau(pt, phi, eta, mass)
-            particle.set_pdgid(9)
-            particle.set_tags(tau_tag >= 1, b_tag >= 1, False)
-            event_particles.append(particle)
-
-        all_particles.append(event_particles)
-
-    return all_particles
+    return _ParticleStore.from_jagged((pts, phis, etas, masses), 9, tags=(tau_tags >= 1, b_tags >= 1))
 
 
 def _get_particles_truth_jets(tree, pt_min, eta_max):
     pts = tree["GenJet.PT"].array()
     etas = tree["GenJet.Eta"].array()
-    phis = tree["GenJet.Phi"].array()
-    masses = tree["GenJet.Mass"].array()
+    accepted = _acceptance_mask({"pt": pts, "eta": etas}, pt_min, eta_max)
+
+    pts = pts[accepted]
+    etas = etas[accepted]
+    phis = tree["GenJet.Phi"].array()[accepted]
+    masses = tree["GenJet.Mass"].array()[accepted]
     try:
-        tau_tags = tree["GenJet.TauTag"].array()
+        tau_tags = tree["GenJet.TauTag"].array()[accepted]
     except:
         logger.warning("Did not find tau-tag information for GenJets in Delphes ROOT file.")
-        tau_tags = [0] * len(pts)
+        tau_tags = _jagged_full(pts, 0, np.int64)
     try:
-        b_tags = tree["GenJet.BTag"].array()
+        b_tags = tree["GenJet.BTag"].array()[accepted]
     except:
         logger.warning("Did not find b-tag information for GenJets in Delphes ROOT file.")
-        b_tags = [0] * len(pts)
+        b_tags = _jagged_full(pts, 0, np.int64)
+
+    return _ParticleStore.from_jagged((pts, phis, etas, masses), 9, tags=(tau_tags >= 1, b_tags >= 1))
+
 
-    all_particles = []
+def _get_particles_truth_met(tree):
+    mets = tree["GenMissingET.MET"].array()
+    phis = tree["GenMissingET.Phi"].array()
 
-    for ievent in range(len(pts)):
-        event_particles = []
+    return _ParticleStore.from_jagged((mets, phis, 0.0, 0.0), 0)
 
-        for pt, eta, phi, mass, tau_tag, b_tag in zip(
-            pts[ievent], etas[ievent], phis[ievent], masses[ievent], tau_tags[ievent], b_tags[ievent]
+
+def _get_particles_met(tree):
+    mets = tree["MissingET.MET"].array()
+    phis = tree["MissingET.Phi"].array()
+
+    return _ParticleStore.from_jagged((mets, phis, 0.0, 0.0), 0)
+
+
+# Compiled cuts
+
+_CUT_BINARY_OPERATORS = {
+    ast.Add: operator.add,
+    ast.Sub: operator.sub,
+    ast.Mult: operator.mul,
+    ast.Div: operator.truediv,
+    ast.Pow: operator.pow,
+}
+_CUT_UNARY_OPERATORS = {
+    ast.UAdd: operator.pos,
+    ast.USub: operator.neg,
+    ast.Not: np.logical_not,
+}
+_CUT_COMPARISONS = {
+    ast.Eq: operator.eq,
+    ast.NotEq: operator.ne,
+    ast.Lt: operator.lt,
+    ast.LtE: operator.le,
+    ast.Gt: operator.gt,
+    ast.GtE: operator.ge,
+}
+_CUT_BOOLEAN_OPERATORS = {
+    ast.And: np.logical_and,
+    ast.Or: np.logical_or,
+}
+_CUT_FUNCTIONS = {
+    "abs": np.abs,
+}
+_CUT_CONSTANTS = {
+    "pi": np.pi,
+}
+
+
+def _evaluate_cuts(cuts, observable_values, n_events, evaluate_cut, cutflow=None):
+    """
+    Evaluates cuts as boolean masks over the observable arrays where the cut expression can be compiled, and with
+    evaluate_cut(cut, observable_values, n_events) otherwise
+    """
+
+    if cutflow is None:
+        cutflow = _CutflowReport()
+
+    cut_values = []
+    compiled, not_compiled = [], []
+
+    for i_cut, cut in enumerate(cuts):
+        with cutflow.timed("cuts", i_cut):
+            values_this_cut = None
+            compiled_cut = _compile_cut(cut.val_expression, observable_values.keys())
+
+            if compiled_cut is not None:
+                try:
+                    with np.errstate(divide="ignore", invalid="ignore", over="ignore"):
+                        value = compiled_cut(observable_values)
+                    values_this_cut = np.array(np.broadcast_to(np.asarray(value, dtype=bool), (n_events,)))
+                except (ArithmeticError, TypeError, ValueError) as e:
+                    logger.debug("  Compiled cut %s failed: %s", cut.val_expression, e)
+
+            if values_this_cut is None:
+                values_this_cut = evaluate_cut(cut, observable_values, n_events)
+                not_compiled.append(cut.val_expression)
+            else:
+                compiled.append(cut.val_expression)
+
+        cut_values.append(values_this_cut)
+
+    logger.debug("  Cuts evaluated as array masks: %s", ", ".join(compiled) if compiled else "none")
+    logger.debug("  Cuts evaluated event by event: %s", ", ".join(not_compiled) if not_compiled else "none")
+
+    return cut_values
+
+
+def _compile_cut(expression, observable_names):
+    """
+    Compiles a cut expression that only uses observables, numbers, arithmetic, comparisons, boolean operators, and
+    abs() into a function of the dict of observable arrays. Returns None for any other expression.
+    """
+
+    observable_names = set(observable_names)
+
+    def compile_node(node):
+        if isinstance(node, ast.Expression):
+            return compile_node(node.body)
+
+        if isinstance(node, ast.Constant) and isinstance(node.value, (bool, int, float)):
+            value = node.value
+            return lambda values: value
+
+        if isinstance(node, ast.Name):
+            name = node.id
+            if name in observable_names:
+                return lambda values: values[name]
+            if name in _CUT_CONSTANTS:
+                value = _CUT_CONSTANTS[name]
+                return lambda values: value
+            return None
+
+        if isinstance(node, ast.BinOp) and type(node.op) in _CUT_BINARY_OPERATORS:
+            op = _CUT_BINARY_OPERATORS[type(node.op)]
+            left, right = compile_node(node.left), compile_node(node.right)
+            if left is None or right is None:
+                return None
+            return lambda values: op(left(values), right(values))
+
+        if isinstance(node, ast.UnaryOp) and type(node.op) in _CUT_UNARY_OPERATORS:
+            op = _CUT_UNARY_OPERATORS[type(node.op)]
+            operand = compile_node(node.operand)
+            if operand is None:
+                return None
+            return lambda values: op(operand(values))
+
+        if isinstance(node, ast.Compare) and all(type(op) in _CUT_COMPARISONS for op in node.ops):
+            ops = [_CUT_COMPARISONS[type(op)] for op in node.ops]
+            operands = [compile_node(operand) for operand in [node.left] + node.comparators]
+            if any(operand is None for operand in operands):
+                return None
+
+            def compare(values):
+                evaluated = [operand(values) for operand in operands]
+                result = True
+                for op, left, right in zip(ops, evaluated[:-1], evaluated[1:]):
+                    result = np.logical_and(result, op(left, right))
+                return result
+
+            return compare
+
+        if isinstance(node, ast.BoolOp) and type(node.op) in _CUT_BOOLEAN_OPERATORS:
+            op = _CUT_BOOLEAN_OPERATORS[type(node.op)]
+            operands = [compile_node(operand) for operand in node.values]
+            if any(operand is None for operand in operands):
+                return None
+
+            def combine(values):
+                result = operands[0](values)
+                for operand in operands[1:]:
+                    result = op(result, operand(values))
+                return result
+
+            return combine
+
+        if (
+            isinstance(node, ast.Call)
+            and isinstance(node.func, ast.Name)
+            and node.func.id in _CUT_FUNCTIONS
+            and node.func.id not in observable_names
+            and len(node.args) == 1
+            and not node.keywords
         ):
-            if pt_min is not None and pt < pt_min:
-                continue
-            if eta_max is not None and abs(eta) > eta_max:
-                continue
+            function = _CUT_FUNCTIONS[node.func.id]
+            argument = compile_node(node.args[0])
+            if argument is None:
+                return None
+            return lambda values: function(argument(values))
 
-            particle = MadMinerParticle.from_rhophietatau(pt, phi, eta, mass)
-            particle.set_pdgid(9)
-            particle.set_tags(tau_tag >= 1, b_tag >= 1, False)
-            event_particles.append(particle)
+        return None
 
-        all_particles.append(event_particles)
+    try:
+        tree = ast.parse(expression, mode="eval")
+    except (SyntaxError, TypeError, ValueError):
+        return None
 
-    return all_particles
+    return compile_node(tree)
 
 
-def _get_particles_truth_met(tree):
-    mets = tree["GenMissingET.MET"].array()
-    phis = tree["GenMissingET.Phi"].array()
+# Columnar engine
 
-    all_particles = []
 
-    for ievent in range(len(mets)):
-        event_particles = []
+def _evaluate_columnar(
+    tree,
+    n_events,
+    observables,
+    cuts,
+    intermediates,
+    use_generator_truth,
+    acceptance,
+    collections=COLLECTIONS,
+    cutflow=None,
+):
+    """Evaluates observables and cuts as array expressions over all events, falling back to the event loop"""
 
-        for met, phi in zip(mets[ievent], phis[ievent]):
-            particle = MadMinerParticle.from_rhophietatau(met, phi, 0.0, 0.0)
-            particle.set_pdgid(0)
-            event_particles.append(particle)
+    if cutflow is None:
+        cutflow = _CutflowReport()
 
-        all_particles.append(event_particles)
+    columnar_collections = _get_columnar_collections(tree, use_generator_truth, acceptance)
+    objects = dict(columnar_collections)
+    objects["met"] = columnar_collections["met"][0]
+    columnar_intermediates = _ColumnarIntermediates(intermediates, objects)
 
-    return all_particles
+    event_loop = _EventLoop(tree, use_generator_truth, acceptance, collections, intermediates, cutflow)
 
+    with np.errstate(divide="ignore", invalid="ignore"):
+        # Observations
+        observable_values = OrderedDict()
 
-def _get_particles_met(tree):
-    mets = tree["MissingET.MET"].array()
-    phis = tree["MissingET.Phi"].array()
+        for name, observable in observables.items():
+            definition = observable.val_expression
+            default = observable.val_default if observable.val_default is not None else np.nan
+
+            with cutflow.timed("observables", name):
+                try:
+                    value = columnar_intermediates.evaluate(definition)
+                    values_this_observable = _to_event_array(value, n_events, np.float64, default)
+                except Exception as e:
+                    logger.debug("  Evaluating observable %s event by event: %s", name, e)
+                    values_this_observable = event_loop.evaluate_observable(observable, n_events)
+
+            observable_values[name] = values_this_observable
+
+            logger.debug("  First 10 values for observable %s:\n%s", name, values_this_observable[:20])
+
+        # Cuts
+        def evaluate_cut(cut, observable_values, n_events):
+            variables = dict(objects)
+            variables.update(observable_values)
+
+            try:
+                value = eval(cut.val_expression, _columnar_math_commands(), ChainMap(variables, columnar_intermediates))
+                return _to_event_array(value, n_events, bool, cut.is_required)
+            except Exception as e:
+                logger.debug("  Evaluating cut %s event by event: %s", cut.val_expression, e)
+                return event_loop.evaluate_cut(cut, observable_values, n_events)
+
+        cut_values = _evaluate_cuts(cuts, observable_values, n_events, evaluate_cut, cutflow)
+
+    return observable_values, cut_values
+
+
+class _ColumnarIntermediates(_Intermediates):
+    """Intermediates of all events, computed on columnar particle objects"""
+
+    def __init__(self, definitions, objects):
+        super().__init__(definitions)
+        self.objects = objects
+
+    def evaluate(self, definition):
+        if isinstance(definition, str):
+            return eval(definition, _columnar_math_commands(), ChainMap(self.objects, self))
+
+        function = getattr(definition, "columnar", None)
+        if not isinstance(function, Callable):
+            raise TypeError("No columnar definition")
+
+        arguments = [self.objects["l"], self.objects["a"], self.objects["j"], self.objects["met"]]
+        names = _get_intermediate_arguments(function)
+        return function(*arguments, **{name: self.get_argument(name) for name in names})
+
+    def _compute(self, definition):
+        return self.evaluate(definition)
+
+
+def _columnar_math_commands():
+    """Array versions of math_commands(), which propagate the mask of missing particles"""
+    return {
+        "acos": np.ma.arccos,
+        "asin": np.ma.arcsin,
+        "atan": np.ma.arctan,
+        "atan2": np.ma.arctan2,
+        "ceil": np.ma.ceil,
+        "cos": np.ma.cos,
+        "cosh": np.ma.cosh,
+        "exp": np.ma.exp,
+        "floor": np.ma.floor,
+        "log": np.ma.log,
+        "pi": np.pi,
+        "pow": np.ma.power,
+        "sin": np.ma.sin,
+        "sinh": np.ma.sinh,
+        "sqrt": np.ma.sqrt,
+        "tan": np.ma.tan,
+        "tanh": np.ma.tanh,
+        "len": _columnar_len,
+    }
+
+
+def _columnar_len(obj):
+    if isinstance(obj, _ColumnarCollection):
+        return obj.count()
+    return len(obj)
+
+
+def _to_event_array(value, n_events, dtype, fill_value):
+    """Converts the result of a columnar expression to one value per event, filling in missing entries"""
+
+    if isinstance(value, (_ColumnarCollection, _ColumnarParticle)):
+        raise TypeError("Expression returns particles instead of one number per event")
+    if isinstance(value, ak.Array):
+        value = ak.to_numpy(value, allow_missing=True)
+
+    values = np.asarray(np.ma.filled(np.ma.asarray(value).astype(dtype), fill_value))
+
+    if values.ndim == 0:
+        values = np.full(n_events, values, dtype=dtype)
+    if values.shape != (n_events,):
+        raise ValueError(f"Expression returns shape {values.shape} instead of one number per event")
+
+    return values
+
+
+class _ColumnarCollection:
+    """
+    Particles of one type (e.g. all photons) in all events, stored as jagged arrays with one list per event and
+    loaded on first access. `a[0]` is the hardest photon of every event, `a.pt` the jagged transverse momenta,
+    `len(a)` or `a.count()` the number of photons per event, `j[j.b_tag]` the b-tagged jets, and
+    `j[j.count() >= 2]` the jets of events with at least two jets (the other events keep an empty list).
+    """
+
+    def __init__(self, load_fields):
+        self._load_fields = load_fields
+        self._fields = None
+        self._particles = {}
+
+    @property
+    def fields(self):
+        if self._fields is None:
+            self._fields = self._load_fields()
+        return self._fields
+
+    def count(self):
+        return ak.to_numpy(ak.num(self.fields["pt"], axis=1))
+
+    def __getattr__(self, name):
+        if name.startswith("_"):
+            raise AttributeError(name)
+        try:
+            return self.fields[name]
+        except KeyError:
+            raise AttributeError(f"Columnar particles have no field {name}")
+
+    def __getitem__(self, item):
+        if isinstance(item, (int, np.integer)):
+            if item < 0:
+                raise IndexError("Columnar particles only support non-negative indices")
+            if item not in self._particles:
+                self._particles[item] = _ColumnarParticle(lambda: _get_columnar_particle_data(self.fields, int(item)))
+            return self._particles[item]
+
+        return _ColumnarCollection(lambda: _select_columnar_fields(self.fields, item))
+
+    def __len__(self):
+        raise TypeError("Columnar particles have one length per event, use count()")
+
+    def __iter__(self):
+        raise TypeError("Columnar particles cannot be iterated over")
+
+
+class _ColumnarParticle:
+    """
+    One particle per event (e.g. the hardest photon of every event), stored as a vector.MomentumNumpy4D together with
+    the mask of events in which the particle exists. Properties return masked arrays; sums, differences, and methods
+    like deltaR() combine the masks of all particles involved.
+    """
+
+    def __init__(self, load_data):
+        self._load_data = load_data
+        self._data = None
+
+    @classmethod
+    def from_data(cls, momentum, valid, tags):
+        particle = cls(None)
+        particle._data = (momentum, valid, tags)
+        return particle
+
+    @property
+    def data(self):
+        if self._data is None:
+            self._data = self._load_data()
+        return self._data
+
+    def __getattr__(self, name):
+        if name.startswith("_"):
+            raise AttributeError(name)
+
+        momentum, valid, tags = self.data
+        if name in tags:
+            return np.ma.masked_array(tags[name], mask=~valid)
+
+        attribute = getattr(momentum, name)
+        if not callable(attribute):
+            return _wrap_columnar(attribute, valid)
+
+        def method(*args):
+            this_valid = valid
+            this_args = []
+            for arg in args:
+                if isinstance(arg, _ColumnarParticle):
+                    arg_momentum, arg_valid, _ = arg.data
+                    this_valid = this_valid & arg_valid
+                    this_args.append(arg_momentum)
+                else:
+                    this_args.append(arg)
+            return _wrap_columnar(attribute(*this_args), this_valid)
+
+        return method
+
+    def __add__(self, other):
+        return self._combine(other, 1)
+
+    def __sub__(self, other):
+        return self._combine(other, -1)
+
+    def _combine(self, other, sign):
+        if not isinstance(other, _ColumnarParticle):
+            return NotImplemented
+
+        momentum, valid, tags = self.data
+        other_momentum, other_valid, other_tags = other.data
+
+        return _ColumnarParticle.from_data(
+            momentum + other_momentum if sign > 0 else momentum - other_momentum,
+            valid & other_valid,
+            {
+                "b_tag": tags["b_tag"] | other_tags["b_tag"],
+                "tau_tag": tags["tau_tag"] | other_tags["tau_tag"],
+                "charge": tags["charge"] + sign * other_tags["charge"],
+            },
+        )
+
+
+def _select_columnar_fields(fields, mask):
+    if isinstance(mask, np.ndarray) and mask.ndim == 1:
+        # One flag per event: keep or drop all particles of that event
+        counts = ak.to_numpy(ak.num(fields["pt"], axis=1))
+        mask = ak.unflatten(np.repeat(np.ma.filled(mask, False), counts), counts)
+    return {key: values[mask] for key, values in fields.items()}
+
+
+def _wrap_columnar(value, valid):
+    if isinstance(value, vector.Vector):
+        return _ColumnarParticle.from_data(value, valid, {})
+    return np.ma.masked_array(np.asarray(value), mask=~valid)
 
-    all_particles = []
 
-    for ievent in range(len(mets)):
-        event_particles = []
+def _get_columnar_particle_data(fields, index):
+    """Momentum, existence mask, and tags of the particle at position index in every event"""
 
-        for met, phi in zip(mets[ievent], phis[ievent]):
-            particle = MadMinerParticle.from_rhophietatau(met, phi, 0.0, 0.0)
-            particle.set_pdgid(0)
-            event_particles.append(particle)
+    def column(values, dtype, fill_value):
+        this_values = ak.pad_none(values, index + 1, axis=1, clip=True)[:, index]
+        return np.ma.filled(np.ma.asarray(ak.to_numpy(this_values, allow_missing=True)).astype(dtype), fill_value)
 
-        all_particles.append(event_particles)
+    valid = ak.to_numpy(ak.num(fields["pt"], axis=1)) > index
 
-    return all_particles
+    kinematics = {
+        "pt": column(fields["pt"], np.float64, np.nan),
+        "eta": column(fields["eta"], np.float64, np.nan),
+        "phi": column(fields["phi"], np.float64, np.nan),
+    }
+    if "e" in fields:
+        kinematics["E"] = column(fields["e"], np.float64, np.nan)
+    else:
+        kinematics["mass"] = column(fields["mass"], np.float64, np.nan)
+
+    tags = {
+        "b_tag": column(fields["b_tag"], bool, False),
+        "tau_tag": column(fields["tau_tag"], bool, False),
+        "charge": column(fields["charge"], np.float64, 0.0),
+        "pdgid": column(fields["pdgid"], np.int64, 0),
+    }
+
+    return vector.array(kinematics), valid, tags
+
+
+def _get_columnar_collections(tree, use_generator_truth, acceptance):
+    """Columnar versions of the particle lists e, mu, l, a, j, and met built by _get_all_particles()"""
+
+    branches = {}
+
+    def branch(name):
+        if name not in branches:
+            branches[name] = tree[name].array(library="ak")
+        return branches[name]
+
+    def charged(name, mass, pdgid_positive_charge, pt_min, eta_max):
+        pts = branch(f"{name}.PT")
+        sign = 2 * (branch(f"{name}.Charge") >= 0.0) - 1
+        fields = {
+            "pt": pts,
+            "eta": branch(f"{name}.Eta"),
+            "phi": branch(f"{name}.Phi"),
+            "mass": _jagged_full(pts, mass, np.float64),
+            "b_tag": _jagged_full(pts, False, bool),
+            "tau_tag": _jagged_full(pts, False, bool),
+            "charge": 1.0 * sign,
+            "pdgid": pdgid_positive_charge * sign,
+        }
+        return _apply_acceptance(fields, _acceptance_mask(fields, pt_min, eta_max))
+
+    def leptons():
+        # Muons first, then electrons, sorted by descending pT as in _get_particles_leptons. Like there, only pT, eta
+        # and phi are reordered, while mass, charge and PDG ID stay in the muons-then-electrons order
+        muons = charged("Muon", 0.105, -13, acceptance["pt_min_mu"], acceptance["eta_max_mu"])
+        electrons = charged("Electron", 0.000511, -11, acceptance["pt_min_e"], acceptance["eta_max_e"])
+        fields = {key: ak.concatenate([muons[key], electrons[key]], axis=1) for key in muons}
+        order = ak.argsort(fields["pt"], axis=1, ascending=False, stable=True)
+        return {key: values[order] if key in ("pt", "eta", "phi") else values for key, values in fields.items()}
+
+    def photons():
+        pts = branch("Photon.PT")
+        fields = {
+            "pt": pts,
+            "eta": branch("Photon.Eta"),
+            "phi": branch("Photon.Phi"),
+            "e": branch("Photon.E"),
+            "b_tag": _jagged_full(pts, False, bool),
+            "tau_tag": _jagged_full(pts, False, bool),
+            "charge": _jagged_full(pts, 0.0, np.float64),
+            "pdgid": _jagged_full(pts, 22, np.int64),
+        }
+        return _apply_acceptance(fields, _acceptance_mask(fields, acceptance["pt_min_a"], acceptance["eta_max_a"]))
+
+    def jets(name):
+        pts = branch(f"{name}.PT")
+        fields = {
+            "pt": pts,
+            "eta": branch(f"{name}.Eta"),
+            "phi": branch(f"{name}.Phi"),
+            "mass": branch(f"{name}.Mass"),
+            "charge": _jagged_full(pts, 0.0, np.float64),
+            "pdgid": _jagged_full(pts, 9, np.int64),
+        }
+        for tag in ("TauTag", "BTag"):
+            key = "tau_tag" if tag == "TauTag" else "b_tag"
+            try:
+                fields[key] = branch(f"{name}.{tag}") >= 1
+            except KeyError:
+                logger.warning("Did not find %s information for %s in Delphes ROOT file.", tag, name)
+                fields[key] = _jagged_full(pts, False, bool)
+        return _apply_acceptance(fields, _acceptance_mask(fields, acceptance["pt_min_j"], acceptance["eta_max_j"]))
+
+    def met(name):
+        mets = branch(f"{name}.MET")
+        return {
+            "pt": mets,
+            "eta": _jagged_full(mets, 0.0, np.float64),
+            "phi": branch(f"{name}.Phi"),
+            "mass": _jagged_full(mets, 0.0, np.float64),
+            "b_tag": _jagged_full(mets, False, bool),
+            "tau_tag": _jagged_full(mets, False, bool),
+            "charge": _jagged_full(mets, 0.0, np.float64),
+            "pdgid": _jagged_full(mets, 0, np.int64),
+        }
+
+    def truth_fields():
+        pts = branch("Particle.PT")
+        return {
+            "pt": pts,
+            "eta": branch("Particle.Eta"),
+            "phi": branch("Particle.Phi"),
+            "e": branch("Particle.E"),
+            "b_tag": _jagged_full(pts, False, bool),
+            "tau_tag": _jagged_full(pts, False, bool),
+            "charge": 1.0 * branch("Particle.Charge"),
+            "pdgid": branch("Particle.PID"),
+        }
+
+    def truth(pdgids, pt_min, eta_max):
+        fields = truth_fields()
+        mask = _acceptance_mask(fields, pt_min, eta_max) & _pdgid_mask(fields, pdgids)
+        return _apply_acceptance(fields, mask)
+
+    def truth_leptons():
+        fields = truth_fields()
+        mask_e = _acceptance_mask(fields, acceptance["pt_min_e"], acceptance["eta_max_e"]) & _pdgid_mask(
+            fields, [11, -11]
+        )
+        mask_mu = _acceptance_mask(fields, acceptance["pt_min_mu"], acceptance["eta_max_mu"]) & _pdgid_mask(
+            fields, [13, -13]
+        )
+        return _apply_acceptance(fields, mask_e | mask_mu)
+
+    if use_generator_truth:
+        # The truth electrons and muons use the photon acceptance, as in _get_all_particles()
+        return {
+            "e": _ColumnarCollection(lambda: truth([11, -11], acceptance["pt_min_a"], acceptance["eta_max_a"])),
+            "mu": _ColumnarCollection(lambda: truth([13, -13], acceptance["pt_min_a"], acceptance["eta_max_a"])),
+            "l": _ColumnarCollection(truth_leptons),
+            "a": _ColumnarCollection(lambda: truth([22], acceptance["pt_min_a"], acceptance["eta_max_a"])),
+            "j": _ColumnarCollection(lambda: jets("GenJet")),
+            "met": _ColumnarCollection(lambda: met("GenMissingET")),
+        }
+
+    return {
+        "e": _ColumnarCollection(
+            lambda: charged("Electron", 0.000511, -11, acceptance["pt_min_e"], acceptance["eta_max_e"])
+        ),
+        "mu": _ColumnarCollection(
+            lambda: charged("Muon", 0.105, -13, acceptance["pt_min_mu"], acceptance["eta_max_mu"])
+        ),
+        "l": _ColumnarCollection(leptons),
+        "a": _ColumnarCollection(photons),
+        "j": _ColumnarCollection(lambda: jets("Jet")),
+        "met": _ColumnarCollection(lambda: met("MissingET")),
+    }
+
+
+def _jagged_full(like, value, dtype):
+    return ak.unflatten(np.full(len(ak.flatten(like, axis=1)), value, dtype=dtype), ak.num(like, axis=1))
+
+
+def _acceptance_mask(fields, pt_min, eta_max):
+    mask = _jagged_full(fields["pt"], True, bool)
+    if pt_min is not None:
+        mask = mask & ~(fields["pt"] < pt_min)
+    if eta_max is not None:
+        mask = mask & ~(abs(fields["eta"]) > eta_max)
+    return mask
+
+
+def _pdgid_mask(fields, pdgids):
+    mask = _jagged_full(fields["pt"], False, bool)
+    for pdgid in pdgids:
+        mask = mask | (fields["pdgid"] == pdgid)
+    return mask
+
+
+def _apply_acceptance(fields, mask):
+    return {key: values[mask] for key, values in fields.items()}
@@ -0,0 +1,309 @@
+import gzip
+import logging
+import re
+
+from collections import OrderedDict
+from pathlib import Path
+
+import numpy as np
+
+logger = logging.getLogger(__name__)
+
+_EVENT_START = re.compile(rb"<event[\s>]")
+_EVENT_END = b"</event>"
+_EVENT_WEIGHT = re.compile(rb"<event[^>]*>\s*\S+\s+\S+\s+(\S+)")
+_RWGT_WEIGHT = re.compile(rb"<wgt\s+id\s*=\s*['\"]([^'\"]*)['\"][^>]*>\s*(\S+)\s*</wgt>")
+_RUN_CARD = re.compile(rb"<MGRunCard>(.*?)</MGRunCard>", re.DOTALL)
+_HIGGS_LINE = re.compile(
+    rb"^[ \t]*25[ \t]+-?\d+[ \t]+" + rb"\S+[ \t]+" * 4 + rb"(\S+)[ \t]+(\S+)[ \t]+(\S+)[ \t]+(\S+)" + rb"[ \t]+\S+" * 3,
+    re.MULTILINE,
+)
+
+HH_OBSERVABLES = ["m_hh", "pt_hh", "h1_pt", "h2_pt", "h1_eta", "h2_eta", "deltaR_hh"]
+
+
+def read_lhe_events(filename, sampling_benchmark, out=None, hh_observables=False, block_size=64 * 1024 * 1024):
+    """
+    Reads the event weights of a LHE file in bulk, without building an XML tree or particle objects.
+
+    The file is read in blocks of block_size bytes (through gzip if it is compressed and not unzipped next to it yet).
+    The weight of every event and the <wgt> entries of its <rwgt> block are found with regular expressions over the
+    whole block and converted to floats in one go, straight into the rows of a (n_events, n_weights) array.
+
+    Parameters
+    ----------
+    filename : str
+        Path to the LHE file ('.lhe' or '.lhe.gz').
+
+    sampling_benchmark : str
+        Name given to the event weight (XWGTUP), unless a <wgt> entry has the same id.
+
+    out : ndarray or None, optional
+        Preallocated float array of shape (n_events_max, n_weights) to fill, for instance a numpy.memmap. If None, an
+        array sized from the `nevents` entry of the run card is allocated (and grown if needed). Default value: None.
+
+    hh_observables : bool, optional
+        If True, parton-level observables of the two Higgs bosons (see HH_OBSERVABLES) are computed as well. They
+        are NaN for events without exactly two Higgs bosons. Default value: False.
+
+    block_size : int, optional
+        Number of bytes read at once. Default value: 64 MB.
+
+    Returns
+    -------
+    weight_names : list of str
+        Names of the columns of weights.
+
+    weights : ndarray
+        Weights with shape (n_events, n_weights), a view of out if it was given.
+
+    run_card : dict
+        Entries of the MadGraph run card in the header.
+
+    observations : OrderedDict or None
+        Parton-level observables with shape (n_events,), or None if hh_observables is False.
+
+    """
+
+    unzipped_filename = Path(filename).with_suffix("")
+    if Path(filename).suffix == ".gz" and not unzipped_filename.exists():
+        file = gzip.open(filename, "rb")
+    else:
+        file = open(unzipped_filename if Path(filename).suffix == ".gz" else filename, "rb")
+
+    run_card = {}
+    weight_names = None
+    weights = out
+    n_events = 0
+    hh_momenta = [] if hh_observables else None
+
+    with file:
+        buffer = b""
+        header_done = False
+
+        while True:
+            block = file.read(block_size)
+            buffer += block
+
+            if not header_done:
+                first_event = _EVENT_START.search(buffer)
+                if first_event is None and block:
+                    continue
+                header_end = len(buffer) if first_event is None else first_event.start()
+                run_card = _parse_run_card(buffer[:header_end])
+                buffer = buffer[header_end:]
+                header_done = True
+
+            # Only complete events are parsed, the rest is kept for the next block
+            end = buffer.rfind(_EVENT_END)
+            if end < 0:
+                if block:
+                    continue
+                break
+            end += len(_EVENT_END)
+            events, buffer = buffer[:end], buffer[end:]
+
+            block_names, block_weights, block_positions = _parse_weights(events, sampling_benchmark)
+            if weight_names is None:
+                weight_names = block_names
+                if weights is None:
+                    n_expected = int(float(run_card.get("nevents", 0)))
+                    weights = np.empty((max(n_expected, len(block_weights)), len(weight_names)))
+                elif weights.ndim != 2 or weights.shape[1] != len(weight_names):
+                    raise ValueError(
+                        f"Output array has shape {weights.shape}, but the LHE file has {len(weight_names)} weights"
+                    )
+            elif block_names != weight_names:
+                raise RuntimeError(f"Events in {filename} have different weights: {block_names} vs {weight_names}")
+
+            n_block = len(block_weights)
+            if n_events + n_block > len(weights):
+                if out is not None:
+                    raise ValueError(f"Output array has room for {len(out)} events, but {filename} has more")
+                n_more = max(n_events + n_block, 2 * len(weights)) - len(weights)
+                weights = np.concatenate((weights, np.empty((n_more, weights.shape[1]))))
+            weights[n_events : n_events + n_block] = block_weights
+            n_events += n_block
+
+            if hh_observables:
+                hh_momenta.append(_higgs_momenta(events, block_positions))
+
+            if not block:
+                break
+
+    if _EVENT_START.search(buffer) is not None:
+        logger.warning("Ignoring incomplete last event in %s", filename)
+
+    if weight_names is None:
+        logger.warning("No events found in %s", filename)
+        return [], np.empty((0, 0)), run_card, (OrderedDict() if hh_observables else None)
+
+    weights = weights[:n_events]
+
+    n_negative = np.sum(np.any(weights < 0.0, axis=1))
+    if n_negative > 0:
+        logger.warning("Found %s events with negative weights in %s", n_negative, filename)
+
+    observations = None
+    if hh_observables:
+        observations = _hh_observables(*[np.concatenate(components) for components in zip(*hh_momenta)])
+
+    return weight_names, weights, run_card, observations
+
+
+def parse_lhe_weights(
+    filename,
+    sampling_benchmark,
+    benchmark_names,
+    is_background=False,
+    k_factor=1.0,
+    systematics_dict=None,
+    out=None,
+):
+    """
+    Drop-in replacement for the weights returned by madminer.utils.interfaces.lhe.parse_lhe_file() without
+    observables or cuts, based on read_lhe_events(): the weights are normalized the same way (event_norm and nevents
+    in the run card, k_factor), and mapped the same way to the benchmarks and nuisance benchmarks.
+
+    Returns
+    -------
+    weights : OrderedDict
+        Weights with shape (n_events,) for every benchmark and nuisance benchmark.
+
+    """
+
+    if is_background and benchmark_names is None:
+        raise RuntimeError("Parsing background LHE files required benchmark names to be provided.")
+
+    weight_names, weights, run_card, _ = read_lhe_events(filename, sampling_benchmark, out=out)
+
+    # If necessary, rescale by number of events
+    if "event_norm" not in run_card:
+        logger.warning(
+            "Cannot read weight normalization mode (entry 'event_norm') from LHE file header. "
+            "MadMiner will continue assuming that events are properly normalized. "
+            "Please check this!"
+        )
+    elif run_card["event_norm"] == "average":
+        if "nevents" not in run_card:
+            raise RuntimeError(
+                "LHE weights have to be normalized, "
+                "but MadMiner cannot read number of events (entry 'nevents') from LHE file header."
+            )
+        k_factor = k_factor / float(run_card["nevents"])
+
+    if k_factor != 1.0:
+        weights *= k_factor
+    columns = OrderedDict(zip(weight_names, weights.T))
+
+    output_weights = OrderedDict()
+    for benchmark_name in benchmark_names:
+        output_weights[benchmark_name] = columns[sampling_benchmark if is_background else benchmark_name]
+
+    for syst_data in (systematics_dict or {}).values():
+        for (nuisance_benchmark0, weight_name0), (nuisance_benchmark1, weight_name1), processing in syst_data.values():
+            if processing is not None and not isinstance(processing, float):
+                raise RuntimeError(f"Unknown nuisance processing {processing}")
+            factor = 1.0 if processing is None else processing
+
+            if weight_name0 is None:
+                weight_name0 = sampling_benchmark
+            output_weights[nuisance_benchmark0] = factor * columns[weight_name0]
+
+            if nuisance_benchmark1 is None or weight_name1 is None:
+                continue
+            output_weights[nuisance_benchmark1] = factor * columns[weight_name1]
+
+    return output_weights
+
+
+def _parse_run_card(header):
+    run_card = {}
+    match = _RUN_CARD.search(header)
+    if match is None:
+        return run_card
+
+    for line in match.group(1).decode(errors="replace").splitlines():
+        line = line.split("!")[0]
+        if line.count("=") != 1:
+            continue
+        value, key = line.split("=")
+        run_card[key.strip()] = value.strip()
+
+    return run_card
+
+
+def _parse_weights(events, sampling_benchmark):
+    """Weight names, (n_events, n_weights) weights, and start positions of the events in a block of complete events"""
+
+    starts = [match.start() for match in _EVENT_START.finditer(events)]
+    n_events = len(starts)
+    event_weights = _EVENT_WEIGHT.findall(events)
+    rwgt = _RWGT_WEIGHT.findall(events)
+
+    if len(event_weights) != n_events:
+        raise RuntimeError("Could not find the weight of every event in the LHE file")
+
+    # The <rwgt> block of every event lists the same weights in the same order, which is checked here
+    n_rwgt = len(rwgt) // n_events if n_events else 0
+    rwgt_names = [name.decode() for name, _ in rwgt[:n_rwgt]]
+    if len(rwgt) != n_events * n_rwgt or [name for name, _ in rwgt] != [name for name, _ in rwgt[:n_rwgt]] * n_events:
+        raise RuntimeError("Events in the LHE file have different <rwgt> blocks, which is not supported here")
+
+    values = np.array([value for _, value in rwgt], dtype=bytes).astype(np.float64).reshape(n_events, n_rwgt)
+
+    if sampling_benchmark in rwgt_names:
+        return rwgt_names, values, np.array(starts)
+
+    event_weights = np.array(event_weights, dtype=bytes).astype(np.float64)
+    return [sampling_benchmark] + rwgt_names, np.column_stack((event_weights, values)), np.array(starts)
+
+
+def _higgs_momenta(events, starts):
+    """(px, py, pz, e) of the first two Higgs bosons of every event in a block, NaN where there are not exactly two"""
+
+    matches = list(_HIGGS_LINE.finditer(events))
+    positions = np.array([match.start() for match in matches], dtype=np.int64)
+    momenta = np.array([match.groups() for match in matches], dtype=bytes).reshape(-1, 4).astype(np.float64)
+    event_ids = np.searchsorted(starts, positions, side="right") - 1
+
+    n_events = len(starts)
+    has_two = np.bincount(event_ids, minlength=n_events) == 2
+    first = np.searchsorted(event_ids, np.flatnonzero(has_two))
+
+    h1 = np.full((n_events, 4), np.nan)
+    h2 = np.full((n_events, 4), np.nan)
+    h1[has_two] = momenta[first]
+    h2[has_two] = momenta[first + 1]
+    return h1, h2
+
+
+def _hh_observables(h1, h2):
+    pt1 = np.hypot(h1[:, 0], h1[:, 1])
+    pt2 = np.hypot(h2[:, 0], h2[:, 1])
+
+    # Order the Higgs bosons by pT
+    swap = pt2 > pt1
+    h1[swap], h2[swap] = h2[swap], h1[swap]
+    pt1, pt2 = np.where(swap, pt2, pt1), np.where(swap, pt1, pt2)
+
+    eta1 = np.arcsinh(h1[:, 2] / pt1)
+    eta2 = np.arcsinh(h2[:, 2] / pt2)
+    phi1 = np.arctan2(h1[:, 1], h1[:, 0])
+    phi2 = np.arctan2(h2[:, 1], h2[:, 0])
+    dphi = (phi1 - phi2 + np.pi) % (2.0 * np.pi) - np.pi
+
+    hh = h1 + h2
+    m2 = hh[:, 3] ** 2 - hh[:, 0] ** 2 - hh[:, 1] ** 2 - hh[:, 2] ** 2
+
+    return OrderedDict(
+        [
+            ("m_hh", np.sqrt(np.maximum(m2, 0.0))),
+            ("pt_hh", np.hypot(hh[:, 0], hh[:, 1])),
+            ("h1_pt", pt1),
+            ("h2_pt", pt2),
+            ("h1_eta", eta1),
+            ("h2_eta", eta2),
+            ("deltaR_hh", np.hypot(eta1 - eta2, dphi)),
+        ]
+    )
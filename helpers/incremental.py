@@ -0,0 +1,191 @@
+"""
+Bookkeeping for the incremental mode of 03a_read_delphes.py (--incremental).
+
+Every run directory (run_XX or run_XX_decayed_1) gets a small JSON state file. It records the size and modification
+time of the HepMC file that Delphes was last run on and of the Delphes file it wrote, and, for the last parse, of the
+Delphes and LHE files that were read, a fingerprint of the observables and cuts, and the file with the parsed events of
+the run. plan_run() compares this with the files on disk and decides whether a run needs Delphes, only the parse, or
+nothing. Runs that were processed before the state files existed are picked up from their Delphes files.
+"""
+
+import hashlib
+import inspect
+import json
+import os
+import re
+from pathlib import Path
+
+import uproot
+
+STATE_FILENAME = "03a_state.json"
+EVENTS_FILENAME = "03a_events.h5"
+
+RUN_DELPHES = "delphes"
+PARSE = "parse"
+
+
+def find_run_dirs(events_dir, decayed, start=None, stop=None):
+    """Run directories run_XX (or run_XX_decayed_1 for decayed signal events) in events_dir, sorted by run number"""
+
+    pattern = re.compile(r"run_(\d+)_decayed_1" if decayed else r"run_(\d+)")
+
+    run_dirs = []
+    for path in Path(events_dir).iterdir():
+        match = pattern.fullmatch(path.name)
+        if match is None or not path.is_dir():
+            continue
+        run_id = int(match.group(1))
+        if (start is not None and run_id < start) or (stop is not None and run_id > stop):
+            continue
+        run_dirs.append((run_id, str(path)))
+
+    return [run_dir for _, run_dir in sorted(run_dirs)]
+
+
+def file_signature(filename):
+    """Size and modification time of a file, or None if it does not exist"""
+
+    if filename is None or not os.path.isfile(filename):
+        return None
+    stat = os.stat(filename)
+    return {"size": stat.st_size, "mtime_ns": stat.st_mtime_ns}
+
+
+def load_state(run_dir):
+    try:
+        with open(os.path.join(run_dir, STATE_FILENAME), "r") as file:
+            return json.load(file)
+    except (OSError, ValueError):
+        return {}
+
+
+def save_state(run_dir, state):
+    # Write to a temporary file first, so that a job that is killed never leaves a broken state file
+    filename = os.path.join(run_dir, STATE_FILENAME)
+    temp_filename = f"{filename}.{os.getpid()}.tmp"
+    with open(temp_filename, "w") as file:
+        json.dump(state, file, indent=2)
+    os.replace(temp_filename, filename)
+
+
+def analysis_fingerprint(reader):
+    """SHA-256 of everything in a DelphesReader that changes the parsed events: observables, cuts, and acceptance"""
+
+    setup = {
+        "observables": [
+            [name, _definition_source(o.val_expression), o.val_default, o.is_required]
+            for name, o in reader.observables.items()
+        ],
+        "intermediates": [[name, _definition_source(d)] for name, d in getattr(reader, "intermediates", {}).items()],
+        "cuts": [[c.val_expression, c.is_required] for c in reader.cuts],
+        "acceptance": {
+            key: getattr(reader, key)
+            for key in sorted(vars(reader))
+            if key.startswith("acceptance_") and isinstance(getattr(reader, key), (int, float, type(None)))
+        },
+    }
+    return hashlib.sha256(json.dumps(setup, sort_keys=True, default=str).encode()).hexdigest()
+
+
+def _definition_source(definition):
+    if isinstance(definition, str):
+        return definition
+
+    sources = []
+    for function in (definition, getattr(definition, "columnar", None)):
+        if function is None:
+            continue
+        try:
+            sources.append(inspect.getsource(function))
+        except (OSError, TypeError):
+            sources.append(function.__code__.co_code.hex())
+    sources.append(repr(getattr(definition, "min_multiplicities", None)))
+    return sources
+
+
+def is_complete_delphes_file(filename):
+    """Whether a Delphes ROOT file can be opened and has events, i.e. was not left behind by a Delphes job that died"""
+
+    try:
+        with uproot.open(filename) as root_file:
+            return root_file["Delphes"].num_entries > 0
+    except Exception:
+        return False
+
+
+def plan_run(state, hepmc_file, lhe_file, delphes_file, fingerprint):
+    """
+    Decides what has to be done for a run: RUN_DELPHES (which implies parsing), PARSE, or None. Returns the decision
+    and the reason for it.
+    """
+
+    hepmc = file_signature(hepmc_file)
+    delphes = file_signature(delphes_file)
+
+    # Delphes
+    if delphes is None:
+        if hepmc is None:
+            return None, "neither HepMC nor Delphes file found"
+        return RUN_DELPHES, "no Delphes file"
+
+    if state.get("delphes") != delphes:
+        if state.get("hepmc") is not None and hepmc is not None and state["hepmc"] != hepmc:
+            return RUN_DELPHES, "HepMC file changed since Delphes was run"
+        if hepmc is not None and hepmc["mtime_ns"] > delphes["mtime_ns"]:
+            return RUN_DELPHES, "HepMC file is newer than the Delphes file"
+        if not is_complete_delphes_file(delphes_file):
+            if hepmc is None:
+                return None, "Delphes file is incomplete and there is no HepMC file to rerun Delphes on"
+            return RUN_DELPHES, "Delphes file is incomplete"
+
+    # Parse
+    parsed = state.get("parsed")
+    if parsed is None:
+        return PARSE, "not parsed yet"
+    if parsed.get("delphes") != delphes or parsed.get("lhe") != file_signature(lhe_file):
+        return PARSE, "Delphes or LHE file changed since the last parse"
+    if parsed.get("fingerprint") != fingerprint:
+        return PARSE, "observables or cuts changed since the last parse"
+    if parsed.get("n_events", 0) > 0 and file_signature(parsed.get("events_file")) != parsed.get("events"):
+        return PARSE, "parsed events are missing or were changed"
+
+    return None, "up to date"
+
+
+def update_batch_file(events_files, output_filename, force=False):
+    """
+    Combines and shuffles the parsed events of the runs into the batch file, together with their cutflow reports. This
+    is skipped if the batch file was built from the same run files before (as recorded in <output>_state.json), unless
+    force is True. Returns whether the batch file was rebuilt.
+    """
+
+    from madminer.sampling import combine_and_shuffle
+
+    stem = os.path.splitext(output_filename)[0]
+    batch_state = {"events_files": [[filename, file_signature(filename)] for filename in events_files]}
+
+    try:
+        with open(f"{stem}_state.json", "r") as file:
+            previous_batch_state = json.load(file)
+    except (OSError, ValueError):
+        previous_batch_state = None
+
+    if not force and os.path.exists(output_filename) and previous_batch_state == batch_state:
+        return False
+
+    combine_and_shuffle(events_files, output_filename)
+
+    reports = []
+    for filename in events_files:
+        try:
+            with open(os.path.splitext(filename)[0] + "_report.json", "r") as file:
+                reports += json.load(file)
+        except (OSError, ValueError):
+            pass
+    with open(f"{stem}_report.json", "w") as file:
+        json.dump(reports, file, indent=2)
+
+    with open(f"{stem}_state.json", "w") as file:
+        json.dump(batch_state, file, indent=2)
+
+    return True
@@ -0,0 +1,81 @@
+"""
+Four-vector kernels for arrays of particles (or single particles), compiled with numba where it is installed.
+
+All functions take and return plain floats or numpy arrays, one entry per particle (or per event), and broadcast like
+numpy ufuncs. Momenta are in the (pt, eta, phi, m) or (px, py, pz, E) convention used by Delphes and MadMiner; missing
+particles can be passed as NaN and give NaN.
+"""
+
+import numpy as np
+
+try:
+    from numba import njit
+except ImportError:  # the kernels are plain numpy expressions and also work without numba
+
+    def njit(*args, **kwargs):
+        if len(args) == 1 and callable(args[0]):
+            return args[0]
+        return lambda function: function
+
+
+@njit(cache=True, error_model="numpy")
+def to_cartesian(pt, eta, phi, m):
+    """(pt, eta, phi, m) -> (px, py, pz, E)"""
+    px = pt * np.cos(phi)
+    py = pt * np.sin(phi)
+    pz = pt * np.sinh(eta)
+    e = np.sqrt(px * px + py * py + pz * pz + m * m)
+    return px, py, pz, e
+
+
+@njit(cache=True, error_model="numpy")
+def transverse_momentum(px, py):
+    return np.sqrt(px * px + py * py)
+
+
+@njit(cache=True, error_model="numpy")
+def momentum(px, py, pz):
+    return np.sqrt(px * px + py * py + pz * pz)
+
+
+@njit(cache=True, error_model="numpy")
+def pseudorapidity(px, py, pz):
+    return np.arcsinh(pz / np.sqrt(px * px + py * py))
+
+
+@njit(cache=True, error_model="numpy")
+def azimuth(px, py):
+    return np.arctan2(py, px)
+
+
+@njit(cache=True, error_model="numpy")
+def rapidity(pz, e):
+    return 0.5 * np.log((e + pz) / (e - pz))
+
+
+@njit(cache=True, error_model="numpy")
+def invariant_mass(px, py, pz, e):
+    """Invariant mass, with a negative m^2 (from rounding) giving 0"""
+    m2 = e * e - px * px - py * py - pz * pz
+    return np.sqrt(np.maximum(m2, 0.0))
+
+
+@njit(cache=True, error_model="numpy")
+def delta_phi(phi1, phi2):
+    """phi1 - phi2, wrapped into [-pi, pi)"""
+    return (phi1 - phi2 + np.pi) % (2.0 * np.pi) - np.pi
+
+
+@njit(cache=True, error_model="numpy")
+def delta_r(eta1, phi1, eta2, phi2):
+    deta = eta1 - eta2
+    dphi = delta_phi(phi1, phi2)
+    return np.sqrt(deta * deta + dphi * dphi)
+
+
+@njit(cache=True, error_model="numpy")
+def pair_pt(pt1, phi1, pt2, phi2):
+    """Transverse momentum of the sum of two particles"""
+    px = pt1 * np.cos(phi1) + pt2 * np.cos(phi2)
+    py = pt1 * np.sin(phi1) + pt2 * np.sin(phi2)
+    return np.sqrt(px * px + py * py)
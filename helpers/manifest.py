@@ -0,0 +1,125 @@
+"""
+Bookkeeping for 03b_compile.py and 03b_compile_separate.py: which batch files a compiled file was built from.
+
+The batch files are found by their names (<prefix>_batch_<index>.h5, written by 03a_read_delphes.py). The compiled file
+stores a manifest of them in the dataset "batch_manifest": for every batch its path relative to the compiled file, its
+size, modification time, SHA-256, number of events and k-factor, and the settings that change the compiled file
+(layout). If the manifest of the batch files on disk matches the stored one, the compiled file is up to date and 03b
+does not shuffle again.
+
+Hashing all batch files would take as long as reading them. A batch whose size and modification time are the same as
+in the stored manifest therefore keeps its stored hash and number of events without being read; only new batches, and
+batches whose size or modification time changed, are hashed. A batch that was only touched matches again through its
+hash (the modification time is not compared).
+"""
+
+import hashlib
+import json
+import os
+import re
+from pathlib import Path
+
+import h5py
+
+MANIFEST_DATASET = "batch_manifest"
+
+
+def find_batches(directory, prefix, stop=None):
+    """Batch files <prefix>_batch_<index>.h5 in directory (with index < stop if given), sorted by index"""
+
+    pattern = re.compile(re.escape(prefix) + r"_batch_(\d+)\.h5")
+
+    batches = []
+    for path in Path(directory).iterdir():
+        match = pattern.fullmatch(path.name)
+        if match is None or not path.is_file():
+            continue
+        index = int(match.group(1))
+        if stop is not None and index >= stop:
+            continue
+        batches.append((index, str(path)))
+
+    return [filename for _, filename in sorted(batches)]
+
+
+def file_hash(filename, block_size=16 * 1024 * 1024):
+    sha256 = hashlib.sha256()
+    with open(filename, "rb") as file:
+        for block in iter(lambda: file.read(block_size), b""):
+            sha256.update(block)
+    return sha256.hexdigest()
+
+
+def make_manifest(output_filename, input_filenames, k_factors=None, settings=None, stored_manifest=None):
+    """
+    Manifest of the batch files that output_filename is compiled from, see the module docstring. The batches of
+    stored_manifest with the same size and modification time are not read again.
+    """
+
+    if k_factors is None:
+        k_factors = [1.0 for _ in input_filenames]
+
+    stored_batches = {batch["path"]: batch for batch in (stored_manifest or {}).get("batches", [])}
+
+    output_dir = os.path.dirname(os.path.abspath(output_filename))
+    batches = []
+    for filename, k_factor in zip(input_filenames, k_factors):
+        path = os.path.relpath(os.path.abspath(filename), output_dir)
+        stat = os.stat(filename)
+
+        stored = stored_batches.get(path, {})
+        if stored.get("size") == stat.st_size and stored.get("mtime") == stat.st_mtime_ns:
+            sha256, n_events = stored["sha256"], stored["n_events"]
+        else:
+            sha256 = file_hash(filename)
+            with h5py.File(filename, "r") as file:
+                n_events = len(file["samples/observations"])
+
+        batches.append(
+            {
+                "path": path,
+                "size": stat.st_size,
+                "mtime": stat.st_mtime_ns,
+                "sha256": sha256,
+                "n_events": n_events,
+                "k_factor": float(k_factor),
+            }
+        )
+
+    return {"batches": batches, "settings": settings or {}}
+
+
+def same_batch(batch, other):
+    """Whether two manifest entries describe the same batch, whatever the modification times"""
+    return batch is not None and other is not None and _without_mtime(batch) == _without_mtime(other)
+
+
+def same_manifest(manifest, other):
+    """Whether two manifests describe the same batches (in the same order) and settings"""
+
+    if manifest is None or other is None or manifest["settings"] != other["settings"]:
+        return False
+    if len(manifest["batches"]) != len(other["batches"]):
+        return False
+    return all(same_batch(batch, other_batch) for batch, other_batch in zip(manifest["batches"], other["batches"]))
+
+
+def load_manifest(filename):
+    """Manifest stored in a compiled file, or None if the file or the manifest does not exist"""
+
+    try:
+        with h5py.File(filename, "r") as file:
+            return json.loads(file[MANIFEST_DATASET].asstr()[()])
+    except (OSError, KeyError, ValueError):
+        return None
+
+
+def _without_mtime(batch):
+    return {key: value for key, value in batch.items() if key != "mtime"}
+
+
+def save_manifest(filename, manifest):
+    with h5py.File(filename, "a") as file:
+        if MANIFEST_DATASET in file:
+            del file[MANIFEST_DATASET]
+        file.create_dataset(MANIFEST_DATASET, data=json.dumps(manifest, indent=2))
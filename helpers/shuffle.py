@@ -0,0 +1,762 @@
+"""
+Out-of-core version of madminer.sampling.combine_and_shuffle() for 03b_compile.py and 03b_compile_separate.py
+(--out_of_core).
+
+combine_and_shuffle() loads the observations and weights of all batch files into memory before shuffling them, which
+no longer fits on a node once there are enough batches. combine_and_shuffle_out_of_core() instead does a two-pass
+bucketed shuffle with a bounded memory use:
+
+1. Every batch file is read in blocks of rows, and every row is sent to one of n_buckets temporary files, chosen at
+   random. With n_workers > 1, a pool of worker processes reads, checks, and scatters the batch files in parallel,
+   each into its own set of bucket files.
+2. A single writer (the calling process) reads the buckets back one at a time, shuffles them in memory, and appends
+   them to the output file.
+
+Since every row lands in a bucket independently and uniformly, and the order within each bucket is a uniform random
+permutation, the order of the output is a uniform random permutation of all rows, as with combine_and_shuffle(). The
+output file has the same MadMiner layout: the setup is copied from the first batch file, and the sample summary is
+recalculated from the sampling benchmarks of the events. Its datasets are resizable, so that append_and_shuffle() can
+add the events of new batch files later without reading the earlier batch files again. It still rewrites every chunk
+of the compiled file that receives a new event, which is most of the file once there are more new events than chunks.
+
+The storage layout of the compiled files can be chosen: the datasets are chunked in blocks of chunk_rows events, and
+the weights can be compressed (see get_compression_options()). copy_with_layout() writes an existing file with another
+layout, 03f_benchmark_layouts.py compares how fast MadMiner reads each of them.
+
+compile_batches() picks one of these (or MadMiner's combine_and_shuffle()) from the command line options that
+add_compile_arguments() adds, and is shared by both 03b scripts.
+"""
+
+import logging
+import math
+import multiprocessing
+import os
+import re
+import shutil
+import tempfile
+import time
+from concurrent.futures import ProcessPoolExecutor
+from contextlib import suppress
+
+import h5py
+import numpy as np
+
+from madminer.utils.interfaces.hdf5 import load_madminer_settings
+
+from helpers.manifest import load_manifest, make_manifest, same_batch, same_manifest, save_manifest
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_MAX_MEMORY = 2 * 1024**3
+CHUNK_ROWS = 10000
+COMPRESSIONS = ["none", "lzf", "gzip", "blosc"]
+
+
+def combine_and_shuffle_out_of_core(
+    input_filenames,
+    output_filename,
+    k_factors=None,
+    max_memory=DEFAULT_MAX_MEMORY,
+    n_buckets=None,
+    block_rows=100000,
+    tmp_dir=None,
+    seed=None,
+    n_workers=1,
+    chunk_rows=CHUNK_ROWS,
+    compression=None,
+    in_memory=False,
+):
+    """
+    Combines MadMiner files into one and shuffles the events, like combine_and_shuffle(), without holding all events
+    in memory (unless in_memory is True).
+
+    Parameters
+    ----------
+    input_filenames : list of str
+        MadMiner files with the events to combine. They have to share the setup (benchmarks, observables, nuisance
+        parameters), which is copied from the first one.
+
+    output_filename : str
+        Path to the combined MadMiner file.
+
+    k_factors : float or list of float, optional
+        Factors that the weights of every input file are multiplied with, as in combine_and_shuffle(). Default value:
+        None.
+
+    max_memory : int, optional
+        Memory in bytes that a bucket may take up while it is shuffled (a bucket and its shuffled copy are in memory
+        at the same time). Sets n_buckets if that is None. Default value: 2 GB.
+
+    n_buckets : int or None, optional
+        Number of temporary buckets. Default value: None.
+
+    block_rows : int, optional
+        Number of rows read from an input file at once in the first pass. Default value: 100000.
+
+    tmp_dir : str or None, optional
+        Directory for the buckets, which together take up as much space as the output file. If None, a temporary
+        directory next to the output file is used (and removed afterwards). Default value: None.
+
+    seed : int or None, optional
+        Seed of the random numbers for the bucket assignment and the shuffles. The output only depends on the seed,
+        not on n_workers. Default value: None.
+
+    n_workers : int, optional
+        Number of worker processes that read the input files in the first pass. Every worker checks that the
+        observables, benchmarks, and weights of its file match the first file, and that the sample summary of the file
+        matches the sampling benchmarks of its events (a mismatch is logged as a warning, the summary of the output is
+        recalculated anyway). Default value: 1.
+
+    chunk_rows : int, optional
+        Number of events per chunk of the output datasets. Default value: 10000.
+
+    compression : str or None, optional
+        Compression of the weights in the output, see get_compression_options(). Default value: None.
+
+    in_memory : bool, optional
+        If True, the rows of all input files are collected in memory (from the workers with n_workers > 1) and
+        shuffled at once, like in combine_and_shuffle(), instead of going through bucket files on disk. The output is
+        the same as with n_buckets=1. Default value: False.
+
+    Returns
+    -------
+    file_stats : list of dict
+        For every input file: the filename, the number of events, the number of bytes read, and the seconds spent
+        reading it.
+    """
+
+    if len(input_filenames) <= 0:
+        raise ValueError("Need to provide at least one input filename")
+
+    if k_factors is None:
+        k_factors = [1.0 for _ in input_filenames]
+    elif isinstance(k_factors, float):
+        k_factors = [k_factors for _ in input_filenames]
+
+    if len(input_filenames) != len(k_factors):
+        raise RuntimeError(
+            f"Inconsistent length of input filenames and k factors: {len(input_filenames)} vs {len(k_factors)}"
+        )
+
+    n_benchmarks = len(load_madminer_settings(input_filenames[0], include_nuisance_benchmarks=False)[1])
+    row_dtype, n_rows = _get_row_dtype(input_filenames)
+
+    if in_memory:
+        n_buckets = 1
+    elif n_buckets is None:
+        n_buckets = max(1, math.ceil(2 * n_rows * row_dtype.itemsize / max_memory))
+    logger.info(
+        "Shuffling %s events (%.1f GB) from %s files %s",
+        n_rows,
+        n_rows * row_dtype.itemsize / 1024**3,
+        len(input_filenames),
+        "in memory" if in_memory else f"through {n_buckets} buckets",
+    )
+
+    # Every input file gets its own random numbers, so that the result does not depend on which process reads it
+    seeds = np.random.SeedSequence(seed).spawn(len(input_filenames) + 1)
+    rng = np.random.default_rng(seeds[-1])
+    bucket_dir = None
+    if not in_memory:
+        bucket_dir = tempfile.mkdtemp(
+            prefix=".shuffle_", dir=tmp_dir or os.path.dirname(os.path.abspath(output_filename))
+        )
+
+    try:
+        # First pass: scatter the rows of every input file over its own bucket files (or collect them in memory)
+        setup = _get_setup(input_filenames[0])
+        scatter_args = [
+            (
+                filename,
+                k_factor,
+                None
+                if in_memory
+                else [os.path.join(bucket_dir, f"bucket_{i_bucket}_{i_file}.bin") for i_bucket in range(n_buckets)],
+                row_dtype,
+                input_filenames[0],
+                setup,
+                n_benchmarks,
+                block_rows,
+                seeds[i_file],
+            )
+            for i_file, (filename, k_factor) in enumerate(zip(input_filenames, k_factors))
+        ]
+
+        if n_workers > 1 and len(input_filenames) > 1:
+            logger.info("Reading %s files with %s worker processes", len(input_filenames), n_workers)
+            # Forked, so that the 03b scripts, which have no __main__ guard, are not run again in every worker
+            with ProcessPoolExecutor(
+                max_workers=min(n_workers, len(input_filenames)), mp_context=multiprocessing.get_context("fork")
+            ) as executor:
+                file_stats = list(executor.map(_scatter_file, scatter_args))
+        else:
+            file_stats = [_scatter_file(args) for args in scatter_args]
+
+        sampling_id_counts = np.sum([stats.pop("sampling_id_counts") for stats in file_stats], axis=0)
+
+        # Second pass: shuffle every bucket in memory and append it to the output
+        shutil.copyfile(input_filenames[0], output_filename)
+
+        with h5py.File(output_filename, "a") as file:
+            with suppress(KeyError):
+                del file["samples"]
+            observations, weights, sampling_ids = _create_samples(file, n_rows, row_dtype, chunk_rows, compression)
+
+            n_written = 0
+            for i_bucket in range(n_buckets):
+                if in_memory:
+                    rows = np.concatenate([stats.pop("rows") for stats in file_stats])
+                else:
+                    bucket_filenames = [args[2][i_bucket] for args in scatter_args]
+                    rows = np.concatenate([np.fromfile(filename, dtype=row_dtype) for filename in bucket_filenames])
+                    for filename in bucket_filenames:
+                        os.remove(filename)
+                rows = rows[rng.permutation(len(rows))]
+                logger.debug("Writing bucket %s / %s with %s events", i_bucket + 1, n_buckets, len(rows))
+
+                observations[n_written : n_written + len(rows)] = rows["observations"]
+                weights[n_written : n_written + len(rows)] = rows["weights"]
+                sampling_ids[n_written : n_written + len(rows)] = rows["sampling_ids"]
+                n_written += len(rows)
+
+            if n_written != n_rows:
+                raise RuntimeError(f"Wrote {n_written} events to {output_filename}, but expected {n_rows}")
+
+            with suppress(KeyError):
+                del file["sample_summary"]
+            if n_rows > 0:
+                file.create_dataset("sample_summary/signal_events", data=sampling_id_counts[1:])
+                file.create_dataset("sample_summary/background_events", data=sampling_id_counts[0])
+
+    finally:
+        if bucket_dir is not None:
+            shutil.rmtree(bucket_dir, ignore_errors=True)
+
+    return file_stats
+
+
+def append_and_shuffle(
+    compiled_filename,
+    input_filenames,
+    k_factors=None,
+    block_rows=100000,
+    seed=None,
+    chunk_rows=CHUNK_ROWS,
+    compression=None,
+):
+    """
+    Adds the events of new MadMiner files to a file compiled by combine_and_shuffle() or
+    combine_and_shuffle_out_of_core(), keeping its events uniformly shuffled without rewriting them.
+
+    The new events are inserted with the inside-out Fisher-Yates shuffle: the j-th new event goes to a random
+    position among the first n + j + 1 ones (n events were in the file), and the event that was there moves to the
+    end. Applied to uniformly shuffled events, this gives uniformly shuffled events again. The sample summary is
+    updated with the new events.
+
+    The earlier batch files are not read again, and memory is only needed for the new events and one chunk at a time.
+    But every chunk that holds a replaced position is read and written back in full, so that m new events in a file of
+    n events with chunks of c rows read and write O(min(n, m c)) rows: adding more events than there are chunks
+    rewrites most of the file, which saves the scatter pass and the reads of the old batches compared to a full
+    recompile, but not the writes. Smaller chunks lower the cost of adding few events.
+
+    If the datasets of the compiled file are not resizable (files written by MadMiner's combine_and_shuffle()), the
+    file is rewritten once with resizable datasets first, with the layout given by chunk_rows and compression.
+    Otherwise the file keeps its layout.
+
+    Parameters
+    ----------
+    compiled_filename : str
+        Compiled MadMiner file, which is changed in place.
+
+    input_filenames : list of str
+        MadMiner files with the new events. They have to have the same observables and benchmarks as the compiled
+        file.
+
+    k_factors : float or list of float, optional
+        Factors that the weights of every input file are multiplied with. Default value: None.
+
+    block_rows : int, optional
+        Number of rows copied at once if the compiled file has to be rewritten. Default value: 100000.
+
+    seed : int or None, optional
+        Seed of the random positions. Default value: None.
+
+    chunk_rows : int, optional
+        Number of events per chunk if the file has to be rewritten. Default value: 10000.
+
+    compression : str or None, optional
+        Compression of the weights if the file has to be rewritten, see get_compression_options(). Default value:
+        None.
+
+    Returns
+    -------
+    n_new : int
+        Number of events added.
+    """
+
+    if k_factors is None:
+        k_factors = [1.0 for _ in input_filenames]
+    elif isinstance(k_factors, float):
+        k_factors = [k_factors for _ in input_filenames]
+
+    if len(input_filenames) != len(k_factors):
+        raise RuntimeError(
+            f"Inconsistent length of input filenames and k factors: {len(input_filenames)} vs {len(k_factors)}"
+        )
+
+    row_dtype, _ = _get_row_dtype([compiled_filename] + list(input_filenames))
+    setup = _get_setup(compiled_filename)
+    n_benchmarks = len(load_madminer_settings(compiled_filename, include_nuisance_benchmarks=False)[1])
+
+    # New events, with their weights multiplied with the k factors
+    new_rows = []
+    for filename, k_factor in zip(input_filenames, k_factors):
+        if _get_setup(filename) != setup:
+            raise RuntimeError(f"{filename} has different observables or benchmarks than {compiled_filename}")
+        for rows in _read_rows(filename, row_dtype, block_rows):
+            rows["weights"] *= k_factor
+            new_rows.append(rows)
+    new_rows = np.concatenate(new_rows) if new_rows else np.empty(0, dtype=row_dtype)
+    if np.any((new_rows["sampling_ids"] < -1) | (new_rows["sampling_ids"] >= n_benchmarks)):
+        raise RuntimeError("New events have invalid sampling benchmarks")
+
+    _make_resizable(compiled_filename, block_rows, chunk_rows, compression)
+
+    with h5py.File(compiled_filename, "a") as file:
+        datasets = _get_samples(file)
+        n, m = len(datasets[0]), len(new_rows)
+        logger.info(
+            "Adding %s events from %s files to the %s events in %s", m, len(input_filenames), n, compiled_filename
+        )
+
+        # Inside-out Fisher-Yates: which event ends up at each of the m new rows at the end, and which new event
+        # replaces each of the old events that moved there. Old events are labelled 0...n-1, new events n...n+m-1
+        targets = np.random.default_rng(seed).integers(0, n + np.arange(1, m + 1))
+        tail = np.empty(m, dtype=np.int64)
+        replaced = {}
+        for j, target in enumerate(targets.tolist()):
+            if target == n + j:
+                tail[j] = n + j
+            elif target >= n:
+                tail[j] = tail[target - n]
+                tail[target - n] = n + j
+            else:
+                tail[j] = replaced.get(target, target)
+                replaced[target] = n + j
+
+        # Every old event that moves to the end is replaced by a new one in the same row. These rows are updated one
+        # chunk of rows at a time, which is much faster than h5py's point selections
+        positions = np.sort(np.fromiter(replaced.keys(), dtype=np.int64, count=len(replaced)))
+        replacements = new_rows[np.array([replaced[position] for position in positions.tolist()], dtype=np.int64) - n]
+        is_old = tail < n
+        tail_rows = np.empty(m, dtype=row_dtype)
+        tail_rows[~is_old] = new_rows[tail[~is_old] - n]
+        moved_rows = np.empty(len(positions), dtype=row_dtype)
+
+        chunk_rows = datasets[0].chunks[0]
+        boundaries = np.searchsorted(positions, np.arange(0, n + chunk_rows, chunk_rows))
+        for name, dataset in zip(row_dtype.names, datasets):
+            for start, end in zip(boundaries[:-1], boundaries[1:]):
+                if end == start:
+                    continue
+                offset = positions[start] // chunk_rows * chunk_rows
+                block = dataset[offset : offset + chunk_rows]
+                moved_rows[name][start:end] = block[positions[start:end] - offset]
+                block[positions[start:end] - offset] = replacements[name][start:end]
+                dataset[offset : offset + chunk_rows] = block
+
+            tail_rows[name][is_old] = moved_rows[name][np.searchsorted(positions, tail[is_old])]
+            dataset.resize(n + m, axis=0)
+            dataset[n:] = tail_rows[name]
+
+        # Sample summary
+        counts = np.bincount(new_rows["sampling_ids"] + 1, minlength=n_benchmarks + 1)
+        if "sample_summary" in file:
+            counts[1:] += file["sample_summary/signal_events"][()]
+            counts[0] += file["sample_summary/background_events"][()]
+            del file["sample_summary"]
+        elif n > 0:
+            counts += np.bincount(datasets[2][()] + 1, minlength=n_benchmarks + 1)
+        file.create_dataset("sample_summary/signal_events", data=counts[1:])
+        file.create_dataset("sample_summary/background_events", data=counts[0])
+
+    return len(new_rows)
+
+
+def copy_with_layout(input_filename, output_filename, chunk_rows=CHUNK_ROWS, compression=None, block_rows=100000):
+    """
+    Copies a MadMiner file, writing its events to resizable datasets with chunks of chunk_rows events and the weights
+    compressed with compression (see get_compression_options()). Everything else is copied as it is.
+    """
+
+    row_dtype, n_rows = _get_row_dtype([input_filename])
+
+    with h5py.File(input_filename, "r") as file, h5py.File(output_filename, "w") as output_file:
+        output_file.attrs.update(file.attrs)
+        for key in file:
+            if key != "samples":
+                file.copy(key, output_file)
+
+        datasets = _create_samples(output_file, n_rows, row_dtype, chunk_rows, compression)
+        for old, new in zip(_get_samples(file), datasets):
+            for start in range(0, n_rows, block_rows):
+                new[start : start + block_rows] = old[start : start + block_rows]
+
+
+def get_compression_options(compression):
+    """
+    Arguments of h5py's create_dataset() for a compression of the weights: None or "none", "lzf", "gzip" (with the
+    level as "gzip:<level>", 4 by default), or "blosc" (LZ4 in Blosc, "blosc:<level>", 5 by default). lzf and gzip
+    come with h5py and are used with the byte shuffle filter. blosc needs the hdf5plugin package, which also has to be
+    imported wherever the files are read.
+    """
+
+    name, _, level = (compression or "none").partition(":")
+
+    if name == "none":
+        return {}
+    if name == "lzf":
+        return {"compression": "lzf", "shuffle": True}
+    if name == "gzip":
+        return {"compression": "gzip", "compression_opts": int(level or 4), "shuffle": True}
+    if name == "blosc":
+        try:
+            import hdf5plugin
+        except ImportError:
+            raise ImportError("Blosc compression needs the hdf5plugin package (pip install hdf5plugin)")
+        return dict(hdf5plugin.Blosc(cname="lz4", clevel=int(level or 5), shuffle=hdf5plugin.Blosc.SHUFFLE))
+
+    raise ValueError(f"Unknown compression {compression}, choose from {', '.join(COMPRESSIONS)}")
+
+
+def add_compile_arguments(parser):
+    """Options of compile_batches() for the argparse parser of 03b_compile.py and 03b_compile_separate.py"""
+
+    parser.add_argument(
+        "-out_of_core",
+        "--out_of_core",
+        action="store_true",
+        help="Shuffle through temporary buckets on disk next to the output file, so that the batches do not have to "
+        "fit into memory together",
+    )
+    parser.add_argument(
+        "-max_memory",
+        "--max_memory",
+        type=float,
+        default=2,
+        help="With --out_of_core, memory in GB for the events shuffled at once",
+    )
+    parser.add_argument(
+        "-n_workers",
+        "--n_workers",
+        type=int,
+        default=1,
+        help="Number of processes that read and check the batch files in parallel, while this process writes the "
+        "output",
+    )
+    parser.add_argument(
+        "-chunk_rows",
+        "--chunk_rows",
+        type=int,
+        default=None,
+        help=f"Store the compiled events in chunks of this many events ({CHUNK_ROWS} by default)",
+    )
+    parser.add_argument(
+        "-compression",
+        "--compression",
+        default=None,
+        help="Compress the weights of the compiled file: none, lzf, gzip[:level], or blosc[:level] (needs hdf5plugin "
+        "to write and read)",
+    )
+    parser.add_argument(
+        "-append_from",
+        "--append_from",
+        type=int,
+        default=None,
+        help="Add the batches that the existing compiled file was not built from (all with this index or above) at "
+        "random positions, instead of recompiling all batches. Compiles all batches if the earlier ones or the layout "
+        "have changed",
+    )
+    parser.add_argument(
+        "-force",
+        "--force",
+        action="store_true",
+        help="Compile even if the compiled file was built from the same batch files (same sizes and SHA-256) before",
+    )
+
+
+def compile_batches(args, input_filenames, output_filename, k_factors=None):
+    """
+    Combines and shuffles batch files into a compiled file as set by the options of add_compile_arguments() in args:
+    with MadMiner's combine_and_shuffle() by default, with combine_and_shuffle_out_of_core() for --out_of_core,
+    --n_workers, or another layout, or by adding the new batches with append_and_shuffle() for --append_from. The
+    compiled file records the batch files it was built from (see helpers/manifest.py), and is skipped if they have
+    not changed since. Only new batches, and batches whose size or modification time changed, are read to check
+    this (all with --force). With --append_from, the new batches are the ones missing from that record. If any recorded
+    batch has changed or is gone, the layout is different, or there is no record, the file is compiled again from all
+    batches instead.
+    """
+
+    if not input_filenames:
+        raise RuntimeError(f"No batch files found for {output_filename}")
+    if k_factors is None:
+        k_factors = [1.0 for _ in input_filenames]
+
+    # With --force, every batch is hashed again, otherwise only the ones whose size or modification time changed
+    settings = dict(chunk_rows=args.chunk_rows, compression=args.compression)
+    stored_manifest = load_manifest(output_filename)
+    manifest = make_manifest(
+        output_filename,
+        input_filenames,
+        k_factors=k_factors,
+        settings=settings,
+        stored_manifest=None if args.force else stored_manifest,
+    )
+    if not args.force and same_manifest(manifest, stored_manifest):
+        if manifest != stored_manifest:
+            save_manifest(output_filename, manifest)
+        print(
+            f"{output_filename} is up to date with its {len(input_filenames)} batch files, skipping it "
+            "(use --force to compile it again)"
+        )
+        return
+
+    new_batches = None
+    if args.append_from is not None and not args.force:
+        new_batches = _find_new_batches(output_filename, manifest, stored_manifest, args.append_from)
+
+    if new_batches is None:
+        _shuffle_batches(args, input_filenames, output_filename, k_factors)
+    else:
+        n_new = append_and_shuffle(
+            output_filename,
+            [input_filenames[i] for i in new_batches],
+            k_factors=[k_factors[i] for i in new_batches],
+            chunk_rows=args.chunk_rows or CHUNK_ROWS,
+            compression=args.compression,
+        )
+        print(f"Added {n_new:,} events from {len(new_batches)} batches to {output_filename}")
+
+    save_manifest(output_filename, manifest)
+
+
+def _find_new_batches(output_filename, manifest, stored_manifest, append_from):
+    """
+    Indices of the batches in manifest that are missing from stored_manifest, the manifest of the compiled file, if
+    they can be appended to it. Otherwise prints why not and returns None.
+    """
+
+    stored_paths = {batch["path"] for batch in (stored_manifest or {}).get("batches", [])}
+    new_batches = [i for i, batch in enumerate(manifest["batches"]) if batch["path"] not in stored_paths]
+    batches = {batch["path"]: batch for batch in manifest["batches"]}
+
+    if stored_manifest is None:
+        reason = "it does not exist or has no batch manifest"
+    elif stored_manifest["settings"] != manifest["settings"]:
+        reason = f"its layout {stored_manifest['settings']} differs from {manifest['settings']}"
+    elif not all(same_batch(batches.get(batch["path"]), batch) for batch in stored_manifest["batches"]):
+        reason = "batches it was compiled from have changed or are gone"
+    elif any(
+        int(re.search(r"_batch_(\d+)\.h5$", manifest["batches"][i]["path"]).group(1)) < append_from
+        for i in new_batches
+    ):
+        reason = f"it does not contain all batches below index {append_from}"
+    else:
+        return new_batches
+
+    print(f"Cannot append to {output_filename} because {reason}, compiling it from all batches")
+    return None
+
+
+def _shuffle_batches(args, input_filenames, output_filename, k_factors):
+    layout = dict(chunk_rows=args.chunk_rows or CHUNK_ROWS, compression=args.compression)
+
+    if not args.out_of_core and args.n_workers <= 1 and args.chunk_rows is None and args.compression is None:
+        from madminer.sampling import combine_and_shuffle
+
+        combine_and_shuffle(input_filenames, output_filename, k_factors=k_factors)
+        return
+
+    # without --out_of_core, all events are shuffled in memory at once
+    start_time = time.perf_counter()
+    file_stats = combine_and_shuffle_out_of_core(
+        input_filenames,
+        output_filename,
+        k_factors=k_factors,
+        max_memory=int(args.max_memory * 1024**3),
+        n_workers=args.n_workers,
+        in_memory=not args.out_of_core,
+        **layout,
+    )
+    time_total = time.perf_counter() - start_time
+
+    for stats in file_stats:
+        mb = stats["n_bytes"] / 1024**2
+        print(
+            f"  {stats['filename']}: {stats['n_events']:,} events, {mb:.1f} MB read in {stats['time']:.2f} s "
+            f"({mb / max(stats['time'], 1e-9):.1f} MB/s)"
+        )
+    mb = sum(stats["n_bytes"] for stats in file_stats) / 1024**2
+    print(
+        f"Compiled {len(file_stats)} files ({mb:.1f} MB) into {output_filename} in {time_total:.1f} s "
+        f"({mb / time_total:.1f} MB/s)"
+    )
+
+
+def _create_samples(file, n_rows, row_dtype, chunk_rows=CHUNK_ROWS, compression=None):
+    """Resizable datasets for the observations, weights, and sampling benchmarks of n_rows events"""
+
+    return [
+        file.create_dataset(
+            f"samples/{dataset_name}",
+            (n_rows,) + row_dtype[name].shape,
+            row_dtype[name].base,
+            maxshape=(None,) + row_dtype[name].shape,
+            chunks=(chunk_rows,) + row_dtype[name].shape,
+            **(get_compression_options(compression) if name == "weights" else {}),
+        )
+        for name, dataset_name in zip(row_dtype.names, ["observations", "weights", "sampling_benchmarks"])
+    ]
+
+
+def _get_samples(file):
+    return [file["samples/observations"], file["samples/weights"], file["samples/sampling_benchmarks"]]
+
+
+def _make_resizable(filename, block_rows, chunk_rows, compression):
+    """Rewrites a MadMiner file whose event datasets cannot be resized (e.g. from save_events()) with resizable ones"""
+
+    with h5py.File(filename, "r") as file:
+        if all(dataset.maxshape[0] is None for dataset in _get_samples(file)):
+            return
+
+    logger.info("Rewriting %s once with resizable datasets, so that events can be added", filename)
+    temp_filename = f"{filename}.{os.getpid()}.tmp"
+
+    try:
+        copy_with_layout(filename, temp_filename, chunk_rows, compression, block_rows)
+        os.replace(temp_filename, filename)
+    finally:
+        with suppress(OSError):
+            os.remove(temp_filename)
+
+
+def _scatter_file(args):
+    """
+    First pass for one input file: checks it against the setup of the first file, and sends its rows to the bucket
+    files at random, or returns them all if bucket_filenames is None. Runs in a worker process with n_workers > 1.
+    """
+
+    filename, k_factor, bucket_filenames, row_dtype, reference_filename, setup, n_benchmarks, block_rows, seed = args
+    start_time = time.perf_counter()
+
+    if _get_setup(filename) != setup:
+        raise RuntimeError(f"{filename} has different observables or benchmarks than {reference_filename}")
+
+    rng = np.random.default_rng(seed)
+    sampling_id_counts = np.zeros(n_benchmarks + 1, dtype=np.int64)
+    n_rows = 0
+
+    blocks = [] if bucket_filenames is None else None
+    bucket_files = [open(bucket_filename, "wb") for bucket_filename in bucket_filenames or []]
+    try:
+        for rows in _read_rows(filename, row_dtype, block_rows):
+            if not np.all((rows["sampling_ids"] >= -1) & (rows["sampling_ids"] < n_benchmarks)):
+                raise RuntimeError(f"{filename} has events with invalid sampling benchmarks")
+            rows["weights"] *= k_factor
+            sampling_id_counts += np.bincount(rows["sampling_ids"] + 1, minlength=n_benchmarks + 1)
+            n_rows += len(rows)
+
+            if blocks is not None:
+                blocks.append(rows)
+                continue
+
+            buckets = rng.integers(len(bucket_files), size=len(rows))
+            order = np.argsort(buckets, kind="stable")
+            boundaries = np.searchsorted(buckets[order], np.arange(len(bucket_files) + 1))
+            for bucket_file, start, end in zip(bucket_files, boundaries[:-1], boundaries[1:]):
+                if end > start:
+                    rows[order[start:end]].tofile(bucket_file)
+    finally:
+        for bucket_file in bucket_files:
+            bucket_file.close()
+
+    # The sample summary of the file is not used, but should agree with its events
+    with h5py.File(filename, "r") as file:
+        with suppress(KeyError):
+            signal_events = file["sample_summary/signal_events"][()]
+            background_events = file["sample_summary/background_events"][()]
+            if list(signal_events) != list(sampling_id_counts[1:]) or background_events != sampling_id_counts[0]:
+                logger.warning(
+                    "Sample summary of %s (%s signal events per benchmark, %s background events) does not match its "
+                    "events (%s, %s)",
+                    filename,
+                    list(signal_events),
+                    background_events,
+                    list(sampling_id_counts[1:]),
+                    sampling_id_counts[0],
+                )
+
+    stats = {
+        "filename": filename,
+        "n_events": n_rows,
+        "n_bytes": n_rows * row_dtype.itemsize,
+        "time": time.perf_counter() - start_time,
+        "sampling_id_counts": sampling_id_counts,
+    }
+    if blocks is not None:
+        stats["rows"] = np.concatenate(blocks) if blocks else np.empty(0, dtype=row_dtype)
+    return stats
+
+
+def _get_setup(filename):
+    """Names of the observables and benchmarks of a MadMiner file, which have to agree between the combined files"""
+
+    with h5py.File(filename, "r") as file:
+        return {
+            "observables": [name.decode() for name in file["observables/names"][()]],
+            "benchmarks": [name.decode() for name in file["benchmarks/names"][()]],
+        }
+
+
+def _get_row_dtype(input_filenames):
+    """Structured dtype of one event (observations, weights, sampling benchmark) and the total number of events"""
+
+    n_rows = 0
+    shapes = None
+    for filename in input_filenames:
+        with h5py.File(filename, "r") as file:
+            if "samples/sampling_benchmarks" not in file:
+                raise RuntimeError(f"{filename} has no sampling benchmarks, which are needed to shuffle it")
+
+            datasets = [file["samples/observations"], file["samples/weights"], file["samples/sampling_benchmarks"]]
+            these_shapes = [(dataset.shape[1:], dataset.dtype) for dataset in datasets]
+            if shapes is None:
+                shapes = these_shapes
+            elif these_shapes != shapes:
+                raise RuntimeError(f"Events in {filename} have a different shape than in {input_filenames[0]}")
+            n_rows += datasets[0].shape[0]
+
+    (observation_shape, observation_dtype), (weight_shape, weight_dtype), (_, sampling_id_dtype) = shapes
+    row_dtype = np.dtype(
+        [
+            ("observations", observation_dtype, observation_shape),
+            ("weights", np.result_type(weight_dtype, np.float64), weight_shape),
+            ("sampling_ids", sampling_id_dtype),
+        ]
+    )
+    return row_dtype, n_rows
+
+
+def _read_rows(filename, row_dtype, block_rows):
+    """Events of a MadMiner file as structured arrays of at most block_rows rows"""
+
+    with h5py.File(filename, "r") as file:
+        n_rows = file["samples/observations"].shape[0]
+        for start in range(0, n_rows, block_rows):
+            end = min(start + block_rows, n_rows)
+            rows = np.empty(end - start, dtype=row_dtype)
+            rows["observations"] = file["samples/observations"][start:end]
+            rows["weights"] = file["samples/weights"][start:end]
+            rows["sampling_ids"] = file["samples/sampling_benchmarks"][start:end]
+            yield rows